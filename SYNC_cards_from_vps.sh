@@ -9,11 +9,11 @@
 # Use same timezones, you'll have less headache
 # The mtime check is just a sanity check, a human should check if it's correct
 #
-# ANY TIME YOU CAN ABORT THE SCRIPT WITH CTRL-C, BUT DABASE CHANGES THAT HAPPENED
-# WILL NOT ROLL BACK!
+# ANY TIME YOU CAN ABORT THE SCRIPT WITH CTRL-C. Each table is imported in single
+# transaction, but if UID table was already imported, it stays imported.
 #
-# Then it will show diff of cards existing and to be imported in vimdiff
-# Overview and use !q to exit
+# Then it will show which cards will be removed (-) and added (+), nick change
+# shows as removal and addition of the same UID
 #
 # Script will ask 3 times, Enter is accept, Ctrl-C is abort:
 # 1) do you agree with the mtimes, are they corre
@@ -96,15 +96,12 @@ sftp -i "$SSH_PRIVATE_KEY" "$USERNAME@$SERVER":cards/"cards*.txt" . || error "SF
 
 echo -e "$RED"
 echo "---!--- Accepted, downloaded 2 files, for UID cards and Desfire cards."
-echo "---!--- Now we will show differences in vimdiff for UID-only cards first, use :qa! to quit vimdiff or zR to expand complete file, then answer whether you accept changes"
-echo "---!--- Note there a tiny bug in 'sort' vs SQL collate, some members may appear at different order in list"
+echo "---!--- Now we will show differences for UID-only cards first, then answer whether you accept changes"
 echo "---!--- Press ENTER to continue or CTRL-C to ABORT"
 read
 
-
-
-NEW_CARDS_FILE="cards.txt"
-vimdiff <(sqlite3 "$BRMDOOR_SQLITE_DB" 'select nick, uid_hex from authorized_uids order by nick,uid_hex COLLATE RTRIM;') <(LC_ALL=C sort <"$NEW_CARDS_FILE" | sed 's/ /|/')
+echo -e "$WHITE"
+python2 ./import_jendasap_cards.py --dry-run cards.txt "$BRMDOOR_SQLITE_DB" | less -FX
 
 echo -e "$BLUE"
 echo "---!--- Now you have seen difference for UID-based cards"
@@ -114,12 +111,12 @@ echo "---!--- Press ENTER to continue or CTRL-C to ABORT"
 read
 
 echo -e "$RED"
-echo "---!--- We will show differences for *****DESFIRE***** cards, use :qa! to quit vimdiff or zR to expand complete file"
+echo "---!--- We will show differences for *****DESFIRE***** cards"
 echo "---!--- Press ENTER to continue or CTRL-C to ABORT"
 read
 
-NEW_CARDS_FILE="cards_desfire.txt"
-vimdiff <(sqlite3 ~/brmdoor_libnfc/brmdoor.sqlite 'select nick, uid_hex from authorized_desfires order by nick,uid_hex;') <(LC_ALL=C sort <"$NEW_CARDS_FILE" | sed 's/ /|/')
+echo -e "$WHITE"
+python2 ./import_jendasap_cards.py --dry-run --desfire cards_desfire.txt "$BRMDOOR_SQLITE_DB" | less -FX
 
 echo -e "$BLUE"
 echo "---!--- Now you have seen difference for DESFIRE-based cards"
@@ -131,7 +128,7 @@ echo "Now ALL ACCEPTED CHANGES WILL BE COMMITED to brmdoor DB on Enter"
 
 read
 
-python2 ./import_jendasap_cards.py cards.txt brmdoor.sqlite && \
+python2 ./import_jendasap_cards.py cards.txt "$BRMDOOR_SQLITE_DB" && \
     echo "Imported UID-based cards" && \
-    ./import_jendasap_cards.py --desfire cards_desfire.txt brmdoor.sqlite || \
+    python2 ./import_jendasap_cards.py --desfire cards_desfire.txt "$BRMDOOR_SQLITE_DB" || \
     error "Full import failed, check what got b0rked"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+
+"""
+Microbenchmark of Desfire NDEF signature check with and without cache
+of verification results.
+
+Same card is tapped repeatedly on a simulated reader (without bus latency),
+so that the cost measured is JSON parsing, hex decoding and ed25519
+signature verification, which cache hit skips.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+from optparse import OptionParser
+
+import axolotl_curve25519 as curve
+
+from create_authenticator_db import createTables
+from brmdoor_authenticator import AuthIndex, DesfireEd25519Authenthicator, AUTH_NDEF
+from nfc_simulator import SimulatedReader
+from sign_uid import signUid
+
+def timeChecks(authenticator, reader, record, taps):
+    """
+    Tap the card taps times and check its signature.
+    @returns mean latency of a check in microseconds
+    """
+    start = time.time()
+    for i in xrange(taps):
+        reader.scanUID()
+        if authenticator.checkSignatureForRecord(record) is None:
+            raise RuntimeError("Benchmark card was not authorized")
+    return (time.time() - start) / taps * 1e6
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-t", "--taps", action="store", type="int", dest="taps", default=10000,
+        help="Number of taps for each variant, default 10000")
+    parser.add_option("-c", "--cache-size", action="store", type="int", dest="cacheSize", default=256,
+        help="Size of verification cache, default 256")
+    (opts, args) = parser.parse_args()
+
+    privateKey = curve.generatePrivateKey(os.urandom(32))
+    publicKey = curve.generatePublicKey(privateKey)
+    uid_hex = os.urandom(7).encode("hex").upper()
+
+    (fd, dbFname) = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(dbFname)
+        cursor = conn.cursor()
+        createTables(cursor)
+        cursor.execute("INSERT INTO authorized_desfires(uid_hex, nick) VALUES (?, ?)", (uid_hex, "bench_ndef"))
+        conn.commit()
+        conn.close()
+
+        authIndex = AuthIndex(dbFname)
+        record = authIndex.find(uid_hex, AUTH_NDEF)
+        reader = SimulatedReader.fromDict({
+            "interval_ms": 0,
+            "repeat": 0,
+            "taps": [{"uid": uid_hex, "signature_hex": signUid(privateKey, uid_hex.decode("hex")).encode("hex")}],
+        })
+
+        print "%10s %16s" % ("cache", "check [us]")
+        for cacheSize in [0, opts.cacheSize]:
+            authenticator = DesfireEd25519Authenthicator(dbFname, reader, publicKey, authIndex, cacheSize)
+            latency = timeChecks(authenticator, reader, record, opts.taps)
+            print "%10d %16.1f" % (cacheSize, latency)
+            stats = authenticator.cacheStats()
+            if stats is not None:
+                print >> sys.stderr, "cache hits %(hits)d, misses %(misses)d" % stats
+    finally:
+        os.unlink(dbFname)
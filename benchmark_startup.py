@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+
+"""
+Benchmark of daemon startup time.
+
+Each run starts a fresh interpreter which imports brmdoor_nfc_daemon and
+parses the config, so the numbers include interpreter start and loading of
+all modules the daemon imports at load time. Optional modules (irc, ssl,
+paramiko, wiringpi) should not be among them unless the config enables
+the part that needs them. Import time of each of those modules alone is
+reported too.
+
+For cold start (e.g. right after boot on a Raspberry Pi) run as root with
+--drop-caches, which drops page cache before each run.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+from create_authenticator_db import createTables
+
+CONFIG_TEMPLATE = """
+[brmdoor]
+auth_db_filename = %(db)s
+desfire_ed25519_pubkey = 00
+log_file = -
+unlocker = Unlocker
+
+[Unlocker]
+
+[irc]
+enabled = False
+
+[open_switch]
+enabled = False
+spaceapi_status_upload = False
+"""
+
+# Runs in fresh interpreter, prints JSON with times in seconds
+CHILD_SCRIPT = """
+import sys, time, json
+start = time.time()
+sys.path.insert(0, %(repoDir)r)
+import brmdoor_nfc_daemon
+imported = time.time()
+config = brmdoor_nfc_daemon.BrmdoorConfig(%(config)r)
+parsed = time.time()
+print json.dumps({"import": imported - start, "config": parsed - imported, "modules": len(sys.modules),
+    "optional": sorted(name for name in %(optional)r if name in sys.modules)})
+"""
+
+# Modules that are slow to import and needed only by some parts of config
+OPTIONAL_MODULES = ["ssl", "urllib2", "irc.client", "paramiko", "wiringpi"]
+
+def dropCaches():
+    """Drop page cache, so that next run reads modules from disk. Needs root."""
+    subprocess.check_call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+def runChild(script, quiet=False):
+    """
+    Run script in fresh interpreter.
+    @param quiet: discard its stderr
+    @returns (wall time in seconds, stdout)
+    """
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, "-W", "ignore", "-c", script], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE if quiet else None)
+    (out, _) = proc.communicate()
+    wall = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError("Child interpreter failed with exit code %d" % proc.returncode)
+    return (wall, out)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def moduleImportTime(module, runs, drop):
+    """
+    @returns median import time of module in ms, None if it's not installed
+    """
+    script = "import time\nstart = time.time()\nimport %s\nprint time.time() - start\n" % module
+    times = []
+    for i in xrange(runs):
+        if drop:
+            dropCaches()
+        try:
+            (_, out) = runChild(script, quiet=True)
+        except RuntimeError:
+            return None
+        times.append(float(out))
+    return median(times) * 1000
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [brmdoor_nfc.config]")
+    parser.add_option("-r", "--runs", action="store", type="int", dest="runs", default=10,
+        help="Number of startups to measure, default 10")
+    parser.add_option("--drop-caches", action="store_true", dest="dropCaches", default=False,
+        help="Drop page cache before each run to measure cold start, needs root")
+    (opts, args) = parser.parse_args()
+
+    repoDir = os.path.dirname(os.path.abspath(__file__))
+    tmpFiles = []
+    if args:
+        configFname = os.path.abspath(args[0])
+    else:
+        # minimal config without optional parts
+        (fd, dbFname) = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        (fd, configFname) = tempfile.mkstemp(suffix=".config")
+        os.write(fd, CONFIG_TEMPLATE % {"db": dbFname})
+        os.close(fd)
+        tmpFiles = [dbFname, configFname]
+        conn = sqlite3.connect(dbFname)
+        createTables(conn.cursor())
+        conn.commit()
+        conn.close()
+
+    try:
+        script = CHILD_SCRIPT % {"repoDir": repoDir, "config": configFname, "optional": OPTIONAL_MODULES}
+        walls = []
+        imports = []
+        configs = []
+        for i in xrange(opts.runs):
+            if opts.dropCaches:
+                dropCaches()
+            (wall, out) = runChild(script)
+            result = json.loads(out)
+            walls.append(wall)
+            imports.append(result["import"])
+            configs.append(result["config"])
+
+        print "Startup of %d runs (%s), median [ms]:" % (opts.runs, "cold" if opts.dropCaches else "warm")
+        print "%-30s %8.1f" % ("total incl. interpreter", median(walls) * 1000)
+        print "%-30s %8.1f" % ("import brmdoor_nfc_daemon", median(imports) * 1000)
+        print "%-30s %8.1f" % ("parse and validate config", median(configs) * 1000)
+        print "Modules loaded: %d, optional ones among them: %s" % (result["modules"],
+                                                                   ", ".join(result["optional"]) or "none")
+        print
+        print "Import of optional modules alone, median [ms]:"
+        for module in OPTIONAL_MODULES:
+            importMs = moduleImportTime(module, min(opts.runs, 5), opts.dropCaches)
+            if importMs is None:
+                print "%-30s %8s" % (module, "not installed")
+            else:
+                print "%-30s %8.1f" % (module, importMs)
+    finally:
+        for fname in tmpFiles:
+            os.unlink(fname)
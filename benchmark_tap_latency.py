@@ -0,0 +1,235 @@
+#!/usr/bin/env python2
+
+"""
+End-to-end tap-to-unlock latency benchmark.
+
+Drives NFCScanner.actOnUid with the three authenticators through
+a simulated reader and measures time from card entering field (start of
+card detection) until Unlocker.unlock() is called, i.e. GPIO would go high.
+Latency percentiles and throughput are reported per auth method and DB size
+as JSON, so results can be compared between releases.
+
+Simulated bus latencies default to zero, so that only CPU cost of the
+pipeline is measured; set them to model real reader.
+
+Desfire signature verification cache is off by default, so that every
+NDEF tap pays for Ed25519 verification; set --desfire-cache-size to
+measure repeated taps of the same card hitting the cache.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import tempfile
+import platform
+
+from binascii import hexlify
+from optparse import OptionParser
+
+import axolotl_curve25519 as curve
+
+from create_authenticator_db import createTables
+from brmdoor_authenticator import AuthIndex, AUTH_UID, AUTH_HMAC, AUTH_NDEF
+from brmdoor_nfc_daemon import BrmdoorConfig, ReaderConfig, NFCScanner
+from uid_backoff import UidBackoff
+from brmdoor_events import EventBus
+from sign_uid import signUid
+import unlocker
+
+CONFIG_TEMPLATE = """
+[brmdoor]
+auth_db_filename = %(db)s
+desfire_ed25519_pubkey = %(pubkey)s
+log_file = -
+log_level = error
+unlocker = Unlocker
+detect_mode = adaptive
+desfire_layout_cache = %(layoutCache)s
+desfire_cache_size = %(cacheSize)d
+
+[Unlocker]
+
+[irc]
+enabled = False
+
+[open_switch]
+enabled = False
+spaceapi_status_upload = False
+"""
+
+class BenchmarkUnlocker(unlocker.Unlocker):
+    """Unlocker recording when it was asked to unlock, without any timer"""
+
+    def __init__(self, config, section=None):
+        unlocker.Unlocker.__init__(self, config, section)
+        self.unlockTimes = []
+
+    def unlock(self):
+        self.unlockTimes.append(time.time())
+        return True
+
+def percentile(sortedValues, p):
+    """Returns p-th percentile of sorted list using nearest-rank method"""
+    if not sortedValues:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(sortedValues) + 0.5)) - 1)
+    return sortedValues[min(rank, len(sortedValues) - 1)]
+
+def createDb(filename, rows, users):
+    """
+    Create auth DB with rows random cards in each table plus the benchmark users.
+    @param users: dict auth method -> (uid_hex, key_hex or None)
+    """
+    conn = sqlite3.connect(filename)
+    cursor = conn.cursor()
+    createTables(cursor)
+    for table in ["authorized_uids", "authorized_desfires"]:
+        cursor.executemany("INSERT OR IGNORE INTO %s(uid_hex, nick) VALUES (?, ?)" % table,
+                           ((os.urandom(7).encode("hex").upper(), "nick%d" % i) for i in xrange(rows)))
+    cursor.executemany("INSERT OR IGNORE INTO authorized_hmac_keys(uid_hex, nick, key_hex) VALUES (?, ?, ?)",
+                       ((os.urandom(7).encode("hex").upper(), "nick%d" % i, os.urandom(20).encode("hex"))
+                        for i in xrange(rows)))
+    cursor.execute("INSERT INTO authorized_uids(uid_hex, nick) VALUES (?, ?)", (users[AUTH_UID][0], "bench_uid"))
+    cursor.execute("INSERT INTO authorized_hmac_keys(uid_hex, nick, key_hex) VALUES (?, ?, ?)",
+                   (users[AUTH_HMAC][0], "bench_hmac", users[AUTH_HMAC][1]))
+    cursor.execute("INSERT INTO authorized_desfires(uid_hex, nick) VALUES (?, ?)", (users[AUTH_NDEF][0], "bench_ndef"))
+    conn.commit()
+    conn.close()
+
+def tapScript(method, users, privateKey, opts):
+    """Returns simulated reader script tapping benchmark user of given method"""
+    (uid_hex, key_hex) = users[method]
+    tap = {"uid": uid_hex}
+    if method == AUTH_HMAC:
+        tap["hmac_key_hex"] = key_hex
+    elif method == AUTH_NDEF:
+        signature = signUid(privateKey, uid_hex.decode("hex"))
+        tap["signature_hex"] = signature.encode("hex")
+    return {
+        "interval_ms": 0,
+        "scan_latency_ms": opts.scanLatencyMs,
+        "apdu_latency_ms": opts.apduLatencyMs,
+        "ndef_latency_ms": opts.ndefLatencyMs,
+        "repeat": opts.taps,
+        "taps": [tap],
+    }
+
+def runMethod(config, method, script, workDir):
+    """
+    Tap the card from script repeatedly through NFCScanner.actOnUid.
+    @returns dict with latency percentiles in ms and throughput in taps/s
+    """
+    scriptFname = os.path.join(workDir, "taps_%s.json" % method)
+    with open(scriptFname, "w") as f:
+        json.dump(script, f)
+
+    authIndex = AuthIndex(config.authDbFilename)
+    uidBackoff = UidBackoff(config.unknownUidTimeoutSecs, config.unknownUidBackoffFactor,
+                            config.unknownUidBackoffMaxSecs, config.unknownUidTableSize)
+    benchUnlocker = BenchmarkUnlocker(config)
+    reader = ReaderConfig("bench", "sim:" + scriptFname, "Unlocker")
+    scanner = NFCScanner(config, reader, authIndex, uidBackoff, benchUnlocker, EventBus())
+    scanner.setupReader()
+
+    latencies = []
+    start = time.time()
+    while not scanner.nfc.exhausted():
+        tapStart = time.time()
+        uid_hex = hexlify(scanner.detectUID())
+        unlocksBefore = len(benchUnlocker.unlockTimes)
+        scanner.actOnUid(uid_hex)
+        if len(benchUnlocker.unlockTimes) == unlocksBefore:
+            raise RuntimeError("Benchmark card for method %s was not authorized" % method)
+        latencies.append((benchUnlocker.unlockTimes[-1] - tapStart) * 1000)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        "taps": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1],
+        "throughput_taps_per_sec": len(latencies) / elapsed,
+        "apdus_per_tap": float(scanner.nfc.apduCount) / len(latencies),
+        "desfire_layout_hits": scanner.nfc.desfireLayoutHits,
+    }
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-s", "--db-sizes", action="store", type="string", dest="dbSizes", default="100,10000,100000",
+        help="Comma-separated numbers of cards per auth table, default 100,10000,100000")
+    parser.add_option("-t", "--taps", action="store", type="int", dest="taps", default=1000,
+        help="Taps per auth method and DB size, default 1000")
+    parser.add_option("-m", "--methods", action="store", type="string", dest="methods", default="uid,hmac,ndef",
+        help="Comma-separated auth methods to benchmark, default uid,hmac,ndef")
+    parser.add_option("--scan-latency-ms", action="store", type="float", dest="scanLatencyMs", default=0,
+        help="Simulated duration of field probe")
+    parser.add_option("--apdu-latency-ms", action="store", type="float", dest="apduLatencyMs", default=0,
+        help="Simulated duration of APDU exchange")
+    parser.add_option("--ndef-latency-ms", action="store", type="float", dest="ndefLatencyMs", default=0,
+        help="Simulated duration of full Desfire NDEF read")
+    parser.add_option("--desfire-layout-cache", action="store_true", dest="layoutCache", default=False,
+        help="Enable Desfire layout cache of reader")
+    parser.add_option("--desfire-cache-size", action="store", type="int", dest="cacheSize", default=0,
+        help="Size of Desfire signature verification cache, default 0 so that every NDEF tap verifies "
+             "Ed25519 signature (cold path); nonzero measures repeated taps hitting the cache")
+    parser.add_option("-o", "--output", action="store", type="string", dest="output", default="-",
+        help="Output JSON file, default - for stdout")
+    (opts, args) = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+    privateKey = curve.generatePrivateKey(os.urandom(32))
+    publicKey = curve.generatePublicKey(privateKey)
+    users = {
+        AUTH_UID: (os.urandom(4).encode("hex").upper(), None),
+        AUTH_HMAC: (os.urandom(7).encode("hex").upper(), os.urandom(20).encode("hex")),
+        AUTH_NDEF: (os.urandom(7).encode("hex").upper(), None),
+    }
+
+    results = []
+    workDir = tempfile.mkdtemp(prefix="brmdoor_bench")
+    try:
+        for dbSize in [int(size) for size in opts.dbSizes.split(",")]:
+            dbFname = os.path.join(workDir, "auth_%d.sqlite" % dbSize)
+            createDb(dbFname, dbSize, users)
+            configFname = os.path.join(workDir, "bench_%d.config" % dbSize)
+            with open(configFname, "w") as f:
+                f.write(CONFIG_TEMPLATE % {"db": dbFname, "pubkey": hexlify(publicKey),
+                                           "layoutCache": opts.layoutCache, "cacheSize": opts.cacheSize})
+            config = BrmdoorConfig(configFname)
+
+            for method in opts.methods.split(","):
+                script = tapScript(method, users, privateKey, opts)
+                result = runMethod(config, method, script, workDir)
+                result.update({"method": method, "db_size": dbSize})
+                results.append(result)
+                print >> sys.stderr, "%s, %d cards: p50 %.3f ms, p99 %.3f ms, %.0f taps/s" % \
+                    (method, dbSize, result["p50_ms"], result["p99_ms"], result["throughput_taps_per_sec"])
+    finally:
+        shutil.rmtree(workDir)
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "simulated_latency_ms": {
+            "scan": opts.scanLatencyMs,
+            "apdu": opts.apduLatencyMs,
+            "ndef": opts.ndefLatencyMs,
+        },
+        "desfire_layout_cache": opts.layoutCache,
+        "desfire_cache_size": opts.cacheSize,
+        "results": results,
+    }
+    if opts.output == "-":
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        print
+    else:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
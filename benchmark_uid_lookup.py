@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+
+"""
+Benchmark of UID lookup latency in auth DB depending on number of cards.
+
+Compares indexed equality lookup used with schema version 2 against the
+UPPER(uid_hex) full-table scan that was needed with schema version 1.
+Latency of indexed lookup should stay flat as the table grows.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+from optparse import OptionParser
+
+from create_authenticator_db import createTables
+
+def fillTable(cursor, count):
+    """
+    Insert count random 7-byte UIDs into authorized_uids.
+    @returns list of inserted UIDs in uppercase hex
+    """
+    uids = [os.urandom(7).encode("hex").upper() for i in xrange(count)]
+    cursor.executemany("INSERT OR IGNORE INTO authorized_uids(uid_hex, nick) VALUES (?, ?)",
+                       ((uid, "nick%d" % i) for (i, uid) in enumerate(uids)))
+    return uids
+
+def timeLookups(cursor, sql, uids):
+    """
+    Run query for each UID and return mean latency in microseconds.
+    """
+    start = time.time()
+    for uid in uids:
+        cursor.execute(sql, (uid,))
+        cursor.fetchone()
+    return (time.time() - start) / len(uids) * 1e6
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--max-rows", action="store", type="int", dest="maxRows", default=1000000,
+        help="Largest table size to test, default 1000000")
+    parser.add_option("-l", "--lookups", action="store", type="int", dest="lookups", default=10000,
+        help="Number of indexed lookups per table size, default 10000")
+    parser.add_option("-s", "--scan-lookups", action="store", type="int", dest="scanLookups", default=20,
+        help="Number of full-scan lookups per table size, default 20, 0 disables")
+    (opts, args) = parser.parse_args()
+
+    print "%10s %16s %16s" % ("rows", "indexed [us]", "UPPER() [us]")
+    rows = 100
+    while rows <= opts.maxRows:
+        (fd, dbFname) = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(dbFname)
+            cursor = conn.cursor()
+            createTables(cursor)
+            uids = fillTable(cursor, rows)
+            conn.commit()
+
+            # half of the lookups are for unknown cards
+            probes = [uids[i % len(uids)] for i in xrange(opts.lookups / 2)]
+            probes += [os.urandom(7).encode("hex").upper() for i in xrange(opts.lookups - len(probes))]
+
+            indexed = timeLookups(cursor, "SELECT nick FROM authorized_uids WHERE uid_hex=?", probes)
+            if opts.scanLookups > 0:
+                scan = timeLookups(cursor, "SELECT nick FROM authorized_uids WHERE UPPER(uid_hex)=?",
+                                   probes[:opts.scanLookups])
+                print "%10d %16.1f %16.1f" % (rows, indexed, scan)
+            else:
+                print "%10d %16.1f %16s" % (rows, indexed, "-")
+            sys.stdout.flush()
+            conn.close()
+        finally:
+            os.unlink(dbFname)
+        rows *= 10
@@ -10,6 +10,33 @@ import sqlite3
 from optparse import OptionParser
 
 from brmdoor_nfc_daemon import BrmdoorConfig
+from create_authenticator_db import getSchemaVersion, SCHEMA_VERSION
+
+def fetchNick(cursor, table, uid_hex):
+    """
+    Return nick of the user having given UID in table or None if there is none.
+    UIDs are stored as uppercase hex, so this is a lookup in UNIQUE index.
+    """
+    cursor.execute("SELECT nick FROM %s WHERE uid_hex=?" % table, (uid_hex.upper(),))
+    record = cursor.fetchone()
+    return record[0] if record is not None else None
+
+def insertAuth(cursor, table, uid_hex, nick, key_hex=None):
+    """
+    Insert record into given auth table. Exits if the UID is already there.
+    """
+    try:
+        if key_hex is None:
+            sql = "INSERT INTO %s (uid_hex, nick) VALUES (?, ?)" % table
+            sql_data = (uid_hex.upper(), nick)
+        else:
+            sql = "INSERT INTO %s (uid_hex, nick, key_hex) VALUES (?, ?, ?)" % table
+            sql_data = (uid_hex.upper(), nick, key_hex)
+        cursor.execute(sql, sql_data)
+    except sqlite3.IntegrityError:
+        print >> sys.stderr, "UID %s is already present in %s for nick %s" % \
+            (uid_hex, table, fetchNick(cursor, table, uid_hex))
+        sys.exit(1)
 
 def addUidAuth(cursor, uid_hex, nick):
     """
@@ -17,15 +44,10 @@ def addUidAuth(cursor, uid_hex, nick):
     """
     try:
         uid_hex.decode("hex")
-        sql = """INSERT INTO authorized_uids
-            (uid_hex, nick)
-            values (?, ?)
-        """
-        sql_data = (uid_hex, nick)
-        cursor.execute(sql, sql_data)
     except TypeError:
         print >> sys.stderr, "UID must be in proper hex encoding"
         sys.exit(1)
+    insertAuth(cursor, "authorized_uids", uid_hex, nick)
         
 def addHmacAuth(cursor, uid_hex, nick, key_hex):
     """
@@ -37,15 +59,10 @@ def addHmacAuth(cursor, uid_hex, nick, key_hex):
         if len(key_hex.decode("hex")) != 20:
             print >> sys.stderr, "Key must be exactly 20 bytes long!"
             sys.exit(1)
-        sql = """INSERT INTO authorized_hmac_keys
-            (uid_hex, nick, key_hex)
-            VALUES (?, ?, ?)
-        """
-        sql_data = (uid_hex, nick, key_hex)
-        cursor.execute(sql, sql_data)
     except TypeError:
         print >> sys.stderr, "UID and key must be in proper hex encoding"
         sys.exit(1)
+    insertAuth(cursor, "authorized_hmac_keys", uid_hex, nick, key_hex)
 
 def addNdefAuth(cursor, uid_hex, nick):
     """
@@ -53,15 +70,10 @@ def addNdefAuth(cursor, uid_hex, nick):
     """
     try:
         uid_hex.decode("hex")
-        sql = """INSERT INTO authorized_desfires
-            (uid_hex, nick)
-            values (?, ?)
-        """
-        sql_data = (uid_hex, nick)
-        cursor.execute(sql, sql_data)
     except TypeError:
         print >> sys.stderr, "UID must be in proper hex encoding"
         sys.exit(1)
+    insertAuth(cursor, "authorized_desfires", uid_hex, nick)
 
 if __name__ == "__main__":
     parser = OptionParser()
@@ -84,6 +96,11 @@ if __name__ == "__main__":
     config = BrmdoorConfig(opts.config)
     conn = sqlite3.connect(config.authDbFilename)
     cursor = conn.cursor()
+
+    if getSchemaVersion(cursor) < SCHEMA_VERSION:
+        print >> sys.stderr, "Database has old schema, upgrade it first with:"
+        print >> sys.stderr, "create_authenticator_db.py --migrate %s" % config.authDbFilename
+        sys.exit(1)
     
     if opts.authtype == "uid":
         if len(args) < 2:
@@ -104,7 +121,7 @@ if __name__ == "__main__":
             print >> sys.stderr, "Example:"
             print >> sys.stderr, "brmdoor_adduser.py -c brmdoor.config -a ndef 34795FCC SomeUserName"
             sys.exit(1)
-    addNdefAuth(cursor, args[0], args[1])
+        addNdefAuth(cursor, args[0], args[1])
 
     conn.commit()
     conn.close()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python2
+
+"""
+Audit log of door events in SQLite database.
+
+AuditThread consumes DoorUnlocked, CardDenied and SwitchChanged events from
+its own EventQueue and writes them in batches into append-only events
+table, so scanner threads never wait for disk. Database is in WAL mode,
+so the query CLI below can read while daemon writes.
+
+Events older than retention are compacted into daily_rollups table - one
+row per day, event type and UID with count of events.
+
+Run as script to query the history, e.g.:
+
+    brmdoor_audit.py audit.sqlite --since 2019-03-05 --until 2019-03-06
+    brmdoor_audit.py audit.sqlite --nick SomeUserName --limit 10
+    brmdoor_audit.py audit.sqlite --rollups --since 2018-01-01
+"""
+
+import sys
+import time
+import Queue
+import sqlite3
+import logging
+import datetime
+import threading
+
+from optparse import OptionParser
+
+from brmdoor_events import DoorUnlocked, CardDenied, SwitchChanged
+
+# Event types as stored in type column
+EVENT_UNLOCKED = "unlocked"
+EVENT_DENIED = "denied"
+EVENT_SWITCH = "switch"
+
+EVENT_TYPES = [EVENT_UNLOCKED, EVENT_DENIED, EVENT_SWITCH]
+
+def createAuditTables(cursor):
+    """
+    Create tables and indexes of audit DB if they don't exist yet.
+    @param cursor: cursor to sqlite DB
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS events(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        type TEXT NOT NULL,
+        reader TEXT,
+        uid_hex TEXT,
+        nick TEXT,
+        detail TEXT)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS events_ts ON events(ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS events_uid_hex_ts ON events(uid_hex, ts)")
+    # uid_hex and nick are '' for events without card, so that they can be part of primary key
+    cursor.execute("""CREATE TABLE IF NOT EXISTS daily_rollups(
+        day TEXT NOT NULL,
+        type TEXT NOT NULL,
+        uid_hex TEXT NOT NULL,
+        nick TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        first_ts REAL NOT NULL,
+        last_ts REAL NOT NULL,
+        PRIMARY KEY(day, type, uid_hex, nick))
+    """)
+
+def openAuditDb(filename):
+    """
+    Open audit DB in WAL mode, creating tables if necessary.
+    @returns sqlite3 connection in autocommit mode, use explicit transactions
+    """
+    conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # in WAL mode this can lose last transactions on power loss, but not corrupt DB
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    createAuditTables(cursor)
+    return conn
+
+def eventRow(event):
+    """
+    Convert event to row of events table.
+    @returns tuple (ts, type, reader, uid_hex, nick, detail) or None for
+        events that are not audited
+    """
+    if isinstance(event, DoorUnlocked):
+        return (event.timestamp, EVENT_UNLOCKED, event.readerName, event.uid_hex.upper(), event.nick,
+                event.method + (" (already open)" if event.extended else ""))
+    elif isinstance(event, CardDenied):
+        return (event.timestamp, EVENT_DENIED, event.readerName, event.uid_hex.upper(), None,
+                "ignored for %g s" % event.penaltySecs)
+    elif isinstance(event, SwitchChanged):
+        return (event.timestamp, EVENT_SWITCH, None, None, None, "open" if event.isOpen else "closed")
+    return None
+
+def insertEvents(cursor, rows):
+    """Append rows to events table in single transaction"""
+    cursor.execute("BEGIN")
+    try:
+        cursor.executemany("INSERT INTO events(ts, type, reader, uid_hex, nick, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                           rows)
+        cursor.execute("COMMIT")
+    except:
+        cursor.execute("ROLLBACK")
+        raise
+
+def compactEvents(cursor, retentionDays, now=None):
+    """
+    Move events older than retentionDays into daily rollups (by local day).
+    @param retentionDays: how many days of individual events to keep, 0 keeps all
+    @returns number of events compacted
+    """
+    if retentionDays <= 0:
+        return 0
+    cutoff = (now or time.time()) - retentionDays * 86400
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("""SELECT date(ts, 'unixepoch', 'localtime') AS day, type, IFNULL(uid_hex, ''),
+                IFNULL(nick, ''), COUNT(*), MIN(ts), MAX(ts)
+            FROM events WHERE ts < ? GROUP BY day, type, uid_hex, nick""", (cutoff,))
+        rollups = cursor.fetchall()
+        # day may already have rollup if it was compacted in parts
+        for (day, eventType, uid_hex, nick, count, firstTs, lastTs) in rollups:
+            cursor.execute("""UPDATE daily_rollups SET count=count+?, first_ts=MIN(first_ts, ?),
+                last_ts=MAX(last_ts, ?) WHERE day=? AND type=? AND uid_hex=? AND nick=?""",
+                (count, firstTs, lastTs, day, eventType, uid_hex, nick))
+            if cursor.rowcount == 0:
+                cursor.execute("""INSERT INTO daily_rollups(day, type, uid_hex, nick, count, first_ts, last_ts)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""", (day, eventType, uid_hex, nick, count, firstTs, lastTs))
+        cursor.execute("DELETE FROM events WHERE ts < ?", (cutoff,))
+        compacted = cursor.rowcount
+        cursor.execute("COMMIT")
+    except:
+        cursor.execute("ROLLBACK")
+        raise
+    return compacted
+
+class AuditThread(threading.Thread):
+    """
+    Writes audited events from queue into audit DB. Events arriving within
+    flush interval are written in one transaction.
+    """
+
+    # How often events older than retention are compacted
+    compactIntervalSecs = 3600
+
+    def __init__(self, config, eventQueue):
+        """
+        @param config: BrmdoorConfig object
+        @param eventQueue: EventQueue with events to audit
+        """
+        self.config = config
+        self.eventQueue = eventQueue
+        self.conn = None
+        self.lastCompaction = 0
+        self.written = 0
+        threading.Thread.__init__(self, name="audit")
+
+    def takeBatch(self):
+        """
+        Block until there is an event or it's time to compact.
+        @returns list of rows to insert, possibly empty
+        """
+        rows = []
+        try:
+            timeout = max(0.1, self.lastCompaction + self.compactIntervalSecs - time.time())
+            event = self.eventQueue.get(timeout=timeout)
+            deadline = time.time() + self.config.auditFlushIntervalMs / 1000.0
+            while True:
+                row = eventRow(event)
+                if row is not None:
+                    rows.append(row)
+                if len(rows) >= self.config.auditBatchSize:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    event = self.eventQueue.get_nowait()
+                else:
+                    event = self.eventQueue.get(timeout=remaining)
+        except Queue.Empty:
+            pass
+        return rows
+
+    def run(self):
+        rows = []
+        while True:
+            try:
+                if self.conn is None:
+                    self.conn = openAuditDb(self.config.auditDbFilename)
+                    logging.info("Opened audit DB %s", self.config.auditDbFilename)
+                if time.time() - self.lastCompaction >= self.compactIntervalSecs:
+                    start = time.time()
+                    compacted = compactEvents(self.conn.cursor(), self.config.auditRetentionDays)
+                    self.lastCompaction = time.time()
+                    if compacted:
+                        logging.info("Compacted %d audit events into daily rollups in %.1f ms",
+                                     compacted, (time.time() - start) * 1000)
+                # rows of failed batch are kept and retried
+                rows.extend(self.takeBatch())
+                if rows:
+                    insertEvents(self.conn.cursor(), rows)
+                    self.written += len(rows)
+                    logging.debug("Wrote %d audit events", len(rows))
+                    rows = []
+            except sqlite3.Error:
+                logging.exception("Failed to write audit DB %s", self.config.auditDbFilename)
+                if len(rows) > self.config.auditBatchSize * 10:
+                    logging.error("Dropping %d audit events", len(rows))
+                    rows = []
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                time.sleep(5)
+            except Exception:
+                logging.exception("Exception in audit thread")
+                time.sleep(1)
+
+def parseDay(day):
+    """Returns unix timestamp of local midnight starting given YYYY-MM-DD day"""
+    return time.mktime(datetime.datetime.strptime(day, "%Y-%m-%d").timetuple())
+
+def formatTs(ts):
+    """Format unix timestamp as local time"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] audit.sqlite")
+    parser.add_option("-s", "--since", action="store", type="string", dest="since",
+        help="Show events since start of this day, YYYY-MM-DD")
+    parser.add_option("-u", "--until", action="store", type="string", dest="until",
+        help="Show events before start of this day, YYYY-MM-DD")
+    parser.add_option("--uid", action="store", type="string", dest="uid",
+        help="Show only events of this UID (hex)")
+    parser.add_option("--nick", action="store", type="string", dest="nick",
+        help="Show only events of this nick")
+    parser.add_option("-t", "--type", action="store", type="choice", choices=EVENT_TYPES, dest="type",
+        help="Show only events of this type - %s" % ", ".join(EVENT_TYPES))
+    parser.add_option("-l", "--limit", action="store", type="int", dest="limit", default=0,
+        help="Show at most this many newest events")
+    parser.add_option("-r", "--rollups", action="store_true", dest="rollups", default=False,
+        help="Show daily rollups of compacted events instead of events")
+    parser.add_option("--compact", action="store", type="int", dest="compactDays",
+        help="Compact events older than given number of days into daily rollups and exit")
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+
+    conn = openAuditDb(args[0])
+    cursor = conn.cursor()
+
+    if opts.compactDays is not None:
+        print "Compacted %d events" % compactEvents(cursor, opts.compactDays)
+        sys.exit(0)
+
+    conditions = []
+    params = []
+    if opts.uid:
+        conditions.append("uid_hex=?")
+        params.append(opts.uid.upper())
+    if opts.nick:
+        conditions.append("nick=?")
+        params.append(opts.nick)
+    if opts.type:
+        conditions.append("type=?")
+        params.append(opts.type)
+
+    if opts.rollups:
+        if opts.since:
+            conditions.append("day>=?")
+            params.append(opts.since)
+        if opts.until:
+            conditions.append("day<?")
+            params.append(opts.until)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        cursor.execute("SELECT day, type, uid_hex, nick, count, first_ts, last_ts FROM daily_rollups %s "
+                       "ORDER BY day, type, nick" % where, params)
+        for (day, eventType, uid_hex, nick, count, firstTs, lastTs) in cursor:
+            print "%s %-8s %-20s %-16s %5d  %s - %s" % (day, eventType, nick, uid_hex, count,
+                                                      formatTs(firstTs)[11:], formatTs(lastTs)[11:])
+    else:
+        if opts.since:
+            conditions.append("ts>=?")
+            params.append(parseDay(opts.since))
+        if opts.until:
+            conditions.append("ts<?")
+            params.append(parseDay(opts.until))
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        limit = ("LIMIT %d" % opts.limit) if opts.limit > 0 else ""
+        # newest N events, printed oldest first
+        cursor.execute("SELECT * FROM (SELECT ts, type, reader, uid_hex, nick, detail FROM events %s "
+                       "ORDER BY ts DESC %s) ORDER BY ts" % (where, limit), params)
+        for (ts, eventType, reader, uid_hex, nick, detail) in cursor:
+            print "%s %-8s %-10s %-20s %-16s %s" % (formatTs(ts), eventType, reader or "-", nick or "-",
+                                                   uid_hex or "-", detail or "")
+    conn.close()
@@ -1,13 +1,26 @@
 import os
+import time
 import sqlite3
 import hmac
 import hashlib
 import logging
 import json
+import threading
+
+from collections import OrderedDict
 
 import axolotl_curve25519 as curve
 
-from nfc_smartcard import NFCError
+from nfc_reader import NFCError
+from lru_cache import LRUCache
+from create_authenticator_db import getSchemaVersion, SCHEMA_VERSION
+from brmdoor_metrics import registry as metricsRegistry
+from brmdoor_trace import span, addSpan
+
+AUTH_DURATION = metricsRegistry.histogram("brmdoor_auth_duration_seconds",
+    "Time to verify card by its authenticator, including card communication", ["method", "result"])
+AUTH_RELOAD_DURATION = metricsRegistry.histogram("brmdoor_auth_reload_duration_seconds",
+    "Time to reload auth index from DB")
 
 
 class UidRecord(object):
@@ -34,16 +47,246 @@ class UidRecord(object):
         return "<UidRecord: uid: %s, nick: %s>" % \
             (repr(self.uid_hex), repr(self.nick))
 
+# Yubikey OTP applet SELECT, HMAC-SHA1 slot 2 challenge header (CLA INS P1 P2)
+YUBIKEY_SELECT_APDU = "00A4040007A0000005272001".decode("hex")
+YUBIKEY_HMAC_SLOT2_HEADER = "00013800".decode("hex")
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python older than 2.7.7
+    def compare_digest(a, b):
+        """Returns a == b in time independent of where strings differ"""
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+class ChallengePool(object):
+    """
+    Random HMAC challenges with prebuilt Yubikey challenge APDUs, generated
+    in batches so that os.urandom() is not called on every tap. Every
+    challenge is handed out only once.
+    """
+
+    def __init__(self, size, challengeLen=32):
+        """
+        @param size: number of challenges generated at once
+        @param challengeLen: length of challenge in bytes
+        """
+        self.size = max(1, size)
+        self.challengeLen = challengeLen
+        self.apduHeader = YUBIKEY_HMAC_SLOT2_HEADER + chr(challengeLen)
+        self.challenges = []
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Generate new batch of challenges. Called with lock held."""
+        randomness = os.urandom(self.size * self.challengeLen)
+        for i in xrange(0, len(randomness), self.challengeLen):
+            challenge = randomness[i:i + self.challengeLen]
+            self.challenges.append((challenge, self.apduHeader + challenge))
+
+    def get(self):
+        """
+        Returns tuple (challenge, challenge APDU) never returned before.
+        """
+        with self.lock:
+            if not self.challenges:
+                self.refill()
+            return self.challenges.pop()
+
+# Authentication methods, names match the -a option of brmdoor_adduser.py
+AUTH_UID = "uid"
+AUTH_HMAC = "hmac"
+AUTH_NDEF = "ndef"
+
+# Authenticator classes by auth method. Registration order is also the order
+# in which methods are tried for UID present in more auth tables.
+authenticatorRegistry = OrderedDict()
+
+def registerAuthenticator(cls):
+    """
+    Class decorator registering authenticator class for its auth method.
+
+    The class must define authMethod, authTable (table with uid_hex and nick
+    columns), keyColumn (column with hex secret or None), description (used
+    in logs), classmethod fromConfig(config, nfcReader, authIndex) and method
+    verify(record) returning UidRecord if the card in field passed the check.
+    Modules with additional authenticators are listed in auth_plugins config
+    option, so that they get imported and registered by the daemon.
+    """
+    authenticatorRegistry[cls.authMethod] = cls
+    return cls
+
+class AuthRecord(UidRecord):
+    """
+    UidRecord bound to authentication method that has to be used for the UID.
+    """
+
+    def __init__(self, uid_hex, nick, method, key=None):
+        """
+        @param uid_hex: uid in hex
+        @param nick: nickname this UID belongs to
+        @param method: one of AUTH_UID, AUTH_HMAC, AUTH_NDEF
+        @param key: method-specific secret (binary HMAC key), None if unused
+        """
+        UidRecord.__init__(self, uid_hex, nick)
+        self.method = method
+        self.key = key
+
+    def __repr__(self):
+        return "<AuthRecord: uid: %s, nick: %s, method: %s>" % \
+            (repr(self.uid_hex), repr(self.nick), self.method)
+
+class AuthIndex(object):
+    """
+    In-memory index of all authorized UIDs from all auth tables, keyed by
+    binary UID. Lookup is a single dict access instead of table scans.
+
+    The whole DB is re-read when the DB file's inode, mtime or size changes,
+    so cards added by brmdoor_adduser.py or import script are picked up
+    without restarting daemon. Tables are read for every authenticator in
+    authenticatorRegistry. New index is built aside and swapped in with
+    single assignment, lookups running meanwhile use the old one.
+    """
+
+    def __init__(self, filename, checkOnLookup=True):
+        """
+        Loads all records from database given by filename.
+
+        @param checkOnLookup: stat DB file on every lookup and reload it if
+            changed; set to False when someone else calls reloadIfChanged(),
+            e.g. daemon's reload thread
+        """
+        self.filename = filename
+        self.checkOnLookup = checkOnLookup
+        self.records = {}
+        self.fileId = None
+        self.reloadLock = threading.Lock()
+        self.reload()
+
+    def fileIdentity(self):
+        """
+        Returns tuple identifying current version of DB file.
+
+        @throws OSError if file can't be stat-ed
+        """
+        st = os.stat(self.filename)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def reload(self):
+        """
+        Reads all auth tables and replaces the index. Rows with malformed
+        hex are skipped with warning.
+        """
+        with self.reloadLock:
+            start = time.time()
+            fileId = self.fileIdentity()
+            records = {}
+            recordCount = 0
+
+            conn = sqlite3.connect(self.filename)
+            try:
+                cursor = conn.cursor()
+                if getSchemaVersion(cursor) < SCHEMA_VERSION:
+                    logging.warning("Auth DB %s has old schema, migrate it with create_authenticator_db.py --migrate",
+                                    self.filename)
+                for (method, authClass) in authenticatorRegistry.items():
+                    try:
+                        cursor.execute("SELECT uid_hex, nick, %s FROM %s" %
+                                       (authClass.keyColumn or "NULL", authClass.authTable))
+                    except sqlite3.OperationalError, e:
+                        logging.warning("Can't load %s records from table %s: %s", method, authClass.authTable, e)
+                        continue
+                    for (uid_hex, nick, key_hex) in cursor:
+                        try:
+                            uid = uid_hex.decode("hex")
+                            key = key_hex.decode("hex") if key_hex is not None else None
+                        except (TypeError, AttributeError):
+                            logging.warning("Skipping malformed %s record for nick %s", method, nick)
+                            continue
+                        record = AuthRecord(uid_hex, nick, method, key)
+                        records.setdefault(uid, []).append(record)
+                        recordCount += 1
+            finally:
+                conn.close()
+
+            self.records = records
+            self.fileId = fileId
+            duration = time.time() - start
+            AUTH_RELOAD_DURATION.observe(duration)
+            logging.info("Loaded auth index with %d UIDs (%d records) from %s in %.1f ms",
+                         len(records), recordCount, self.filename, duration * 1000)
+
+    def reloadIfChanged(self, force=False):
+        """
+        Reloads index if DB file changed since last load. If the file can't
+        be read, old index is kept.
+
+        @param force: reload even if DB file looks the same
+        @returns True if index was reloaded
+        """
+        try:
+            if force or self.fileIdentity() != self.fileId:
+                self.reload()
+                return True
+        except (OSError, sqlite3.Error), e:
+            logging.error("Could not reload auth index, keeping old one: %s", e)
+        return False
+
+    def lookup(self, uid_hex):
+        """
+        Returns list of AuthRecord instances for given UID, in order in
+        which the methods should be tried. Empty list if UID is unknown.
+
+        @param uid_hex: uid to match in hex
+        """
+        if self.checkOnLookup:
+            self.reloadIfChanged()
+        return self.records.get(uid_hex.decode("hex"), [])
+
+    def find(self, uid_hex, method):
+        """
+        Returns AuthRecord of given method for UID or None if not found.
+
+        @param uid_hex: uid to match in hex
+        @param method: one of AUTH_UID, AUTH_HMAC, AUTH_NDEF
+        """
+        for record in self.lookup(uid_hex):
+            if record.method == method:
+                return record
+        return None
+
+@registerAuthenticator
 class UidAuthenticator(object):
     """Checks UIDs of ISO14443 RFID cards against database."""
+
+    authMethod = AUTH_UID
+    authTable = "authorized_uids"
+    keyColumn = None
+    description = "UID"
     
-    def __init__(self, filename):
+    def __init__(self, filename, authIndex=None):
         """
-        Connects to database by given filename and later checks UIDs
+        Uses index of database by given filename and later checks UIDs
         against that database.
+
+        @param authIndex: AuthIndex shared with other authenticators,
+            created from filename if None
         """
-        #open in autocommit mode - we are not changing anything
-        self.conn = sqlite3.connect(filename, isolation_level=None)
+        self.authIndex = authIndex or AuthIndex(filename)
+
+    @classmethod
+    def fromConfig(cls, config, nfcReader, authIndex):
+        """Create authenticator for AuthRouter from BrmdoorConfig"""
+        return cls(config.authDbFilename, authIndex)
+
+    def verify(self, record):
+        """UID match alone is enough, returns the record"""
+        return record
 
     def fetchUidRecord(self, uid_hex):
         """
@@ -53,86 +296,121 @@ class UidAuthenticator(object):
         @param uid_hex: uid to match in hex
         @returns UidRecord instance if found, None otherwise
         """
-        cursor = self.conn.cursor()
-        sql = "SELECT nick FROM authorized_uids WHERE UPPER(uid_hex)=?"
-        sql_data =(uid_hex.upper(),)
-        
-        cursor.execute(sql, sql_data)
-        record = cursor.fetchone()
-        
-        if record is None:
-            return None
-        
-        nick = record[0]
-        return UidRecord(uid_hex, nick)
+        return self.authIndex.find(uid_hex, AUTH_UID)
     
     def shutdown(self):
-        """Closes connection to database"""
-        self.conn.close()
+        """Nothing to close, index does not keep DB connection open"""
+        pass
 
 
+@registerAuthenticator
 class YubikeyHMACAuthenthicator(object):
     """
     Uses Yubikey Neo's built-in HMAC functionality on slot 2 (needs to be
     configured using Yubikey tools to be on this slot).
     """
-    def __init__(self, filename, nfcReader):
+
+    authMethod = AUTH_HMAC
+    authTable = "authorized_hmac_keys"
+    keyColumn = "key_hex"
+    description = "HMAC"
+
+    def __init__(self, filename, nfcReader, authIndex=None, challengePoolSize=64):
         """
-        Connects to database by given filename and later checks UIDs
+        Uses index of database by given filename and later checks UIDs
         against that database.
+
+        @param authIndex: AuthIndex shared with other authenticators,
+            created from filename if None
+        @param challengePoolSize: how many challenges are generated at once
         """
-        #again autocommit mode
-        self.conn = sqlite3.connect(filename, isolation_level=None)
+        self.authIndex = authIndex or AuthIndex(filename)
         self.nfcReader = nfcReader
-    
+        self.challengePool = ChallengePool(challengePoolSize)
+
+    @classmethod
+    def fromConfig(cls, config, nfcReader, authIndex):
+        """Create authenticator for AuthRouter from BrmdoorConfig"""
+        return cls(config.authDbFilename, nfcReader, authIndex, config.hmacChallengePoolSize)
+
+    def verify(self, record):
+        """Checks HMAC response of the card, see checkHMACforRecord"""
+        return self.checkHMACforRecord(record)
+
     def hmacCheck(self, key, challenge, result):
         """
         Returns true iff HMAC-SHA1 with given key and challenge string
-        transforms into given result.
+        transforms into given result. Comparison takes constant time.
         """
         hashed = hmac.new(key, challenge, hashlib.sha1)
-        #We should use hmac.compare_digest(), but that's in new Python
-        #version only. Here timing side channels are not much of concern.
-        return hashed.digest() == result
+        return compare_digest(hashed.digest(), result)
+
+    def transceive(self, apdu):
+        """
+        Send APDU to card in field.
+        @returns response APDU
+        @throws NFCError if response APDU is malformed
+        """
+        with span("apdu"):
+            rapdu = self.nfcReader.sendAPDU(apdu)
+            addSpan("bus", self.nfcReader.lastApduMs)
+        if not rapdu.valid():
+            raise NFCError("HMAC - invalid response APDU")
+        return rapdu
+
+    def selectApplet(self):
+        """
+        Select Yubikey OTP applet on card in field.
+        @throws NFCError if selection failed
+        """
+        rapdu = self.transceive(YUBIKEY_SELECT_APDU)
+        if rapdu.sw() != 0x9000:
+            raise NFCError("HMAC - applet select SW is 0x%04x" % rapdu.sw())
+
+    def sendChallenge(self, challengeApdu):
+        """
+        Select applet and send HMAC challenge APDU. Every detection of the
+        card activates it anew, so the applet has to be selected on each tap.
+
+        @returns response APDU with SW 0x9000
+        @throws NFCError if communication failed or card refused the challenge
+        """
+        self.selectApplet()
+        rapdu = self.transceive(challengeApdu)
+        if rapdu.sw() != 0x9000:
+            raise NFCError("HMAC - response SW is 0x%04x" % rapdu.sw())
+        return rapdu
 
     def checkHMACforUID(self, uid_hex):
         """
-        Checks if UID is in database. If so
+        Checks if UID is in database. If so, verifies HMAC response of the card.
         @param uid_hex: uid to match in hex
         @returns UidRecord instance if found, None otherwise
         """
-        cursor = self.conn.cursor()
-        sql = "SELECT nick, key_hex FROM authorized_hmac_keys WHERE UPPER(uid_hex)=?"
-        sql_data =(uid_hex.upper(),)
-        
-        cursor.execute(sql, sql_data)
-        record = cursor.fetchone()
+        record = self.authIndex.find(uid_hex, AUTH_HMAC)
         
         if record is None:
             return None
         
-        nick = record[0]
-        secretKey = record[1].decode("hex")
-        
-        challenge = os.urandom(32)
-        
-        # Select HMAC-SHA1 on slot 2 from Yubikey
-        apdusHex = [
-            "00 A4 04 00 07 A0 00 00 05 27 20 01",
-            "00 01 38 00 %02x %s" % (len(challenge), challenge.encode("hex"))
-        ]
+        return self.checkHMACforRecord(record)
+
+    def checkHMACforRecord(self, record):
+        """
+        Verifies HMAC response of card in field with key from record.
+        @param record: AuthRecord of AUTH_HMAC method
+        @returns UidRecord instance if verified, None otherwise
+        """
+        uid_hex = record.uid_hex
+        nick = record.nick
+        secretKey = record.key
         
-        rapdu = None
+        (challenge, challengeApdu) = self.challengePool.get()
         
-        for apduHex in apdusHex:
-            try:
-                apdu = apduHex.replace(" ", "").decode("hex")
-                rapdu = self.nfcReader.sendAPDU(apdu)
-                if not rapdu.valid or rapdu.sw() != 0x9000:
-                    raise NFCError("HMAC - response SW is not 0x9000")
-            except NFCError, e:
-                logging.info("Yubikey HMAC command failed: %s" % e.what())
-                return None
+        try:
+            rapdu = self.sendChallenge(challengeApdu)
+        except NFCError, e:
+            logging.info("Yubikey HMAC command failed: %s" % e.what())
+            return None
             
         if not self.hmacCheck(secretKey, challenge, rapdu.data()):
             logging.info("HMAC check failed for UID %s", uid_hex)
@@ -141,30 +419,105 @@ class YubikeyHMACAuthenthicator(object):
         return UidRecord(uid_hex, nick)
     
     def shutdown(self):
-        """Closes connection to database"""
-        self.conn.close()
+        """Nothing to close, index does not keep DB connection open"""
+        pass
 
+@registerAuthenticator
 class DesfireEd25519Authenthicator(object):
     """
     Reads NDEF message from Desfire and it must be signed binary value of UID
     """
-    def __init__(self, filename, nfcReader, pubKey):
+
+    authMethod = AUTH_NDEF
+    authTable = "authorized_desfires"
+    keyColumn = None
+    description = "Desfire NDEF ed25519"
+
+    def __init__(self, filename, nfcReader, pubKey, authIndex=None, cacheSize=0, cacheTtlSecs=0):
         """
-        Connects to database by given filename and later checks UIDs
+        Uses index of database by given filename and later checks UIDs
         using the pubkey (given as binary string).
+
+        @param authIndex: AuthIndex shared with other authenticators,
+            created from filename if None
+        @param cacheSize: how many verification results to remember, so that
+            repeated tap of the same card skips signature check; 0 disables cache
+        @param cacheTtlSecs: how long verification result stays cached, 0 means forever
         """
-        #again autocommit mode
-        self.conn = sqlite3.connect(filename, isolation_level=None)
+        self.authIndex = authIndex or AuthIndex(filename)
         self.nfcReader = nfcReader
         self.pubKey = pubKey
+        # (pubkey, binary UID, SHA256 of NDEF) -> result of signature check
+        self.verifiedCache = LRUCache(cacheSize, cacheTtlSecs) if cacheSize > 0 else None
+
+    @classmethod
+    def fromConfig(cls, config, nfcReader, authIndex):
+        """Create authenticator for AuthRouter from BrmdoorConfig"""
+        return cls(config.authDbFilename, nfcReader, config.desfirePubkey.decode("hex"), authIndex,
+                   config.desfireCacheSize, config.desfireCacheTtlSecs)
+
+    def verify(self, record):
+        """Checks signature in card's NDEF, see checkSignatureForRecord"""
+        return self.checkSignatureForRecord(record)
+
+    def setPubKey(self, pubKey):
+        """
+        Use different public key for checking signatures. Cached verification
+        results are dropped if the key changed.
+        """
+        if pubKey != self.pubKey:
+            self.pubKey = pubKey
+            if self.verifiedCache is not None:
+                self.verifiedCache.clear()
+
+    def cacheStats(self):
+        """Returns dict with hits, misses, evictions and size of verification
+        cache, None if cache is disabled"""
+        if self.verifiedCache is None:
+            return None
+        return self.verifiedCache.stats()
 
     def signatureCheck(self, uid, signature):
         """
         Returns true iff uid (as binary) is the message signed by signature (binary string)
         """
-        verified = curve.verifySignature(self.pubKey, uid, signature) == 0
+        with span("ed25519"):
+            verified = curve.verifySignature(self.pubKey, uid, signature) == 0
         return verified
 
+    def ndefSignatureCheck(self, uid, ndef):
+        """
+        Returns true iff NDEF message contains valid signature of uid (as binary),
+        using verification cache if enabled.
+
+        @throws TypeError, ValueError, KeyError if NDEF is malformed
+        """
+        if self.verifiedCache is None:
+            return self.parsedSignatureCheck(uid, ndef)
+
+        pubKey = self.pubKey
+        cacheKey = (pubKey, uid, hashlib.sha256(ndef).digest())
+        verified = self.verifiedCache.get(cacheKey)
+        if verified is None:
+            verified = self.parsedSignatureCheck(uid, ndef)
+            self.verifiedCache.put(cacheKey, verified)
+        else:
+            logging.debug("Desfire signature check result for UID %s taken from cache", uid.encode("hex"))
+        return verified
+
+    def parsedSignatureCheck(self, uid, ndef):
+        """
+        Parses signature from NDEF JSON and checks it. Wrong length of
+        signature counts as failed check.
+
+        @throws TypeError, ValueError, KeyError if NDEF is malformed
+        """
+        ndefJson = json.loads(ndef)
+        ndefSignature = ndefJson["brmdoorSignature"].decode("hex")
+        if len(ndefSignature) != 64:
+            logging.error("NDEF signature has wrong length")
+            return False
+        return self.signatureCheck(uid, ndefSignature)
 
     def checkUIDSignature(self, uid_hex):
         """
@@ -172,25 +525,31 @@ class DesfireEd25519Authenthicator(object):
         @param uid_hex: uid to match in hex
         @returns UidRecord instance if found, None otherwise
         """
-        cursor = self.conn.cursor()
-        sql = "SELECT nick FROM authorized_desfires WHERE UPPER(uid_hex)=?"
-        sql_data =(uid_hex.upper(),)
-
-        cursor.execute(sql, sql_data)
-        record = cursor.fetchone()
+        record = self.authIndex.find(uid_hex, AUTH_NDEF)
 
         if record is None:
             return None
 
-        nick = record[0]
+        return self.checkSignatureForRecord(record)
+
+    def checkSignatureForRecord(self, record):
+        """
+        Retrieves NDEF from Desfire in field and checks it's signature of UID from record.
+        @param record: AuthRecord of AUTH_NDEF method
+        @returns UidRecord instance if verified, None otherwise
+        """
+        uid_hex = record.uid_hex
+        nick = record.nick
 
         try:
-            ndefJson = json.loads(self.nfcReader.readDesfireNDEF())
-            ndefSignature = ndefJson["brmdoorSignature"].decode("hex")
-            if len(ndefSignature) != 64:
-                logging.error("NDEF signature has wrong length")
-                return None
-            if self.signatureCheck(uid_hex.decode("hex"), ndefSignature):
+            with span("readDesfireNDEF"):
+                ndef = self.nfcReader.readDesfireNDEF()
+                timing = self.nfcReader.lastDesfireTiming
+                for step in ("getTags", "connect", "version", "select", "auth", "ccRead", "ndefRead"):
+                    addSpan(step, getattr(timing, step + "Ms"))
+            logging.debug("Desfire NDEF read took %.1f ms, %d commands, layout cache hit: %s",
+                          timing.totalMs, timing.roundTrips, timing.cacheHit)
+            if self.ndefSignatureCheck(uid_hex.decode("hex"), ndef):
                 return UidRecord(uid_hex, nick)
             else:
                 logging.info("Signature check failed for Desfire NDEF for UID %s", uid_hex)
@@ -209,8 +568,56 @@ class DesfireEd25519Authenthicator(object):
             return None
 
     def shutdown(self):
-        """Closes connection to database"""
-        self.conn.close()
+        """Nothing to close, index does not keep DB connection open"""
+        pass
+
+class AuthRouter(object):
+    """
+    Resolves UID to its auth method(s) by single index lookup and runs only
+    the authenticator registered for that method.
+    """
+
+    def __init__(self, config, nfcReader, authIndex):
+        """
+        Creates one instance of every registered authenticator.
+
+        @param config: BrmdoorConfig instance
+        @param nfcReader: reader the authenticators talk to card through
+        @param authIndex: AuthIndex shared by authenticators
+        """
+        self.authIndex = authIndex
+        self.authenticators = OrderedDict(
+            (method, authClass.fromConfig(config, nfcReader, authIndex))
+            for (method, authClass) in authenticatorRegistry.items()
+        )
+
+    def authenticate(self, uid_hex):
+        """
+        Checks card with given UID in field by the authenticator of its method.
+
+        @param uid_hex: uid to match in hex
+        @returns (AuthRecord, authenticator) if card was authorized, (None, None) otherwise
+        """
+        with span("lookup"):
+            records = self.authIndex.lookup(uid_hex)
+        for record in records:
+            authenticator = self.authenticators.get(record.method)
+            if authenticator is None:
+                logging.warning("No authenticator registered for method %s", record.method)
+                continue
+            start = time.time()
+            with span("verify:" + record.method):
+                verified = authenticator.verify(record) is not None
+            AUTH_DURATION.labels(method=record.method, result="ok" if verified else "failed").observe(
+                time.time() - start)
+            if verified:
+                return (record, authenticator)
+        return (None, None)
+
+    def shutdown(self):
+        """Shuts down all authenticators"""
+        for authenticator in self.authenticators.values():
+            authenticator.shutdown()
 
 #test routine
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+"""
+Typed events passed between daemon components.
+
+Producers (reader threads, open switch watcher) publish events to EventBus
+without knowing who consumes them. Each consumer (IRC bot, SpaceAPI
+uploader, ...) subscribes its own EventQueue for the event types it cares
+about and blocks on it in its own thread, so it wakes up only when there is
+something to do. Adding a sink means subscribing one more queue.
+"""
+
+import os
+import time
+import fcntl
+import Queue
+import logging
+import threading
+
+class Event(object):
+    """Base class of all events, records when the event happened"""
+
+    def __init__(self):
+        self.timestamp = time.time()
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self.__dict__)
+
+class DoorUnlocked(Event):
+    """Authorized card unlocked the lock or extended time it stays open"""
+
+    def __init__(self, readerName, uid_hex, nick, method, extended=False):
+        """
+        @param readerName: name of reader the card was tapped on
+        @param uid_hex: UID of the card in hex
+        @param nick: nick the card belongs to
+        @param method: description of auth method that authorized the card
+        @param extended: lock was already open, only its open time was extended
+        """
+        Event.__init__(self)
+        self.readerName = readerName
+        self.uid_hex = uid_hex
+        self.nick = nick
+        self.method = method
+        self.extended = extended
+
+class CardDenied(Event):
+    """Unknown or unverified card was denied"""
+
+    def __init__(self, readerName, uid_hex, penaltySecs):
+        """
+        @param readerName: name of reader the card was tapped on
+        @param uid_hex: UID of the card in hex
+        @param penaltySecs: how long the UID will be ignored
+        """
+        Event.__init__(self)
+        self.readerName = readerName
+        self.uid_hex = uid_hex
+        self.penaltySecs = penaltySecs
+
+class SwitchChanged(Event):
+    """OPEN/CLOSED switch changed state (or was read first time)"""
+
+    def __init__(self, status, isOpen):
+        """
+        @param status: raw value read from switch
+        @param isOpen: whether the space is open
+        """
+        Event.__init__(self)
+        self.status = status
+        self.isOpen = isOpen
+
+class EventQueue(Queue.Queue):
+    """
+    Bounded queue of events for one consumer. When the consumer falls behind
+    and the queue is full, new events are dropped instead of blocking producers.
+    """
+
+    def __init__(self, name, maxSize=100):
+        """
+        @param name: consumer name used in logs
+        @param maxSize: maximum number of queued events
+        """
+        Queue.Queue.__init__(self, maxSize)
+        self.name = name
+        self.dropped = 0
+
+    def offer(self, event):
+        """
+        Enqueue event without blocking.
+        @returns False if event was dropped because queue is full
+        """
+        try:
+            self.put_nowait(event)
+            return True
+        except Queue.Full:
+            with self.mutex:
+                self.dropped += 1
+            logging.warning("Event queue %s is full, dropped %r", self.name, event)
+            return False
+
+class WakeupEventQueue(EventQueue):
+    """
+    EventQueue that can be waited on with select() together with sockets.
+    fileno() becomes readable whenever an event is enqueued.
+    """
+
+    def __init__(self, name, maxSize=100):
+        EventQueue.__init__(self, name, maxSize)
+        (self.wakeupReader, self.wakeupWriter) = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def _put(self, item):
+        EventQueue._put(self, item)
+        try:
+            os.write(self.wakeupWriter, "x")
+        except OSError:
+            # pipe full, reader is going to wake up anyway
+            pass
+
+    def fileno(self):
+        """File descriptor for select(), readable while there are unread wakeups"""
+        return self.wakeupReader
+
+    def clearWakeup(self):
+        """Consume pending wakeups, call before draining the queue"""
+        try:
+            while os.read(self.wakeupReader, 4096):
+                pass
+        except OSError:
+            pass
+
+class EventBus(object):
+    """
+    Dispatches published events to queues subscribed for their type.
+    Publishing never blocks, so slow consumer can't stall card reading.
+    """
+
+    def __init__(self):
+        # list of (tuple of event classes, EventQueue)
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, queue, *eventTypes):
+        """
+        Deliver events of given types (including subclasses) to queue.
+        @param queue: EventQueue of the consumer
+        @param eventTypes: Event subclasses, Event for all events
+        """
+        with self.lock:
+            self.subscribers.append((eventTypes, queue))
+
+    def publish(self, event):
+        """Deliver event to all queues subscribed for its type"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for (eventTypes, queue) in subscribers:
+            if isinstance(event, eventTypes):
+                queue.offer(event)
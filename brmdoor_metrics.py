@@ -0,0 +1,249 @@
+"""
+Metrics of the daemon in Prometheus text exposition format.
+
+Modules create their counters, gauges and histograms in the shared
+registry at import time and update them from hot paths - an update is
+just an addition under a lock. Values other components already keep
+(queue depths, cache stats, ...) are read by collector callbacks only when
+metrics are scraped. MetricsServer serves the registry over HTTP, e.g.:
+
+    curl http://127.0.0.1:9105/metrics
+"""
+
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+# Default histogram buckets in seconds, tap handling is milliseconds to seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def escapeLabelValue(value):
+    """Escape label value for text exposition format"""
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def formatLabels(labels):
+    """
+    Format labels as {name="value",...}, empty string for no labels.
+    @param labels: list of (name, value) pairs
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escapeLabelValue(value)) for (name, value) in labels)
+
+def formatValue(value):
+    """Format sample value, integers without decimal point"""
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+class CounterChild(object):
+    """Counter with fixed label values"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class GaugeChild(object):
+    """Gauge with fixed label values"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class HistogramChild(object):
+    """Histogram with fixed label values"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # last slot counts observations above highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for (bound, count) in zip(list(self.buckets) + [float("inf")], counts):
+            cumulative += count
+            samples.append((name + "_bucket", labels + [("le", formatValue(float(bound)))], cumulative))
+        samples.append((name + "_sum", labels, total))
+        samples.append((name + "_count", labels, cumulative))
+        return samples
+
+class Metric(object):
+    """
+    Metric family with optional labels. Metric without labels is updated
+    directly, labeled one through child returned by labels().
+    """
+
+    def __init__(self, name, helpText, metricType, labelNames, childFactory):
+        self.name = name
+        self.helpText = helpText
+        self.metricType = metricType
+        self.labelNames = tuple(labelNames)
+        self.childFactory = childFactory
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelNames:
+            self.children[()] = childFactory()
+
+    def labels(self, **labelValues):
+        """
+        Returns child for given label values. Hot paths should get the child
+        once and keep it.
+        """
+        key = tuple(str(labelValues[name]) for name in self.labelNames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.childFactory())
+        return child
+
+    def __getattr__(self, attr):
+        # inc(), set(), observe() of metric without labels
+        if attr in ("inc", "dec", "set", "observe"):
+            return getattr(self.children[()], attr)
+        raise AttributeError(attr)
+
+    def exposition(self):
+        """Returns lines of text exposition of this metric"""
+        lines = ["# HELP %s %s" % (self.name, self.helpText), "# TYPE %s %s" % (self.name, self.metricType)]
+        for (key, child) in sorted(self.children.items()):
+            labels = zip(self.labelNames, key)
+            for (name, sampleLabels, value) in child.samples(self.name, labels):
+                lines.append("%s%s %s" % (name, formatLabels(sampleLabels), formatValue(value)))
+        return lines
+
+class MetricsRegistry(object):
+    """
+    Holds all metrics of the process and collectors producing metrics on scrape.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        # list of callables returning list of (name, type, help, [(labels dict, value)])
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, name, helpText, metricType, labelNames, childFactory):
+        """Returns metric of given name, creating it if it doesn't exist"""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = Metric(name, helpText, metricType, labelNames, childFactory)
+                self.metrics[name] = metric
+            elif metric.metricType != metricType or metric.labelNames != tuple(labelNames):
+                raise ValueError("Metric %s already registered with different type or labels" % name)
+            return metric
+
+    def counter(self, name, helpText, labelNames=()):
+        return self.register(name, helpText, "counter", labelNames, CounterChild)
+
+    def gauge(self, name, helpText, labelNames=()):
+        return self.register(name, helpText, "gauge", labelNames, GaugeChild)
+
+    def histogram(self, name, helpText, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(name, helpText, "histogram", labelNames, lambda: HistogramChild(buckets))
+
+    def registerCollector(self, collector):
+        """
+        Add callable called on every scrape. It returns list of
+        (name, type, help, samples), where samples is list of (labels dict, value).
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def exposition(self):
+        """Returns all metrics in Prometheus text exposition format"""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self.collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.exposition())
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception:
+                logging.exception("Metrics collector %r failed", collector)
+                continue
+            for (name, metricType, helpText, samples) in families:
+                lines.append("# HELP %s %s" % (name, helpText))
+                lines.append("# TYPE %s %s" % (name, metricType))
+                for (labels, value) in samples:
+                    lines.append("%s%s %s" % (name, formatLabels(sorted(labels.items())), formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+# Registry shared by all modules of the daemon
+registry = MetricsRegistry()
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /metrics of server's registry"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request from %s: %s", self.client_address[0], format % args)
+
+class MetricsServer(threading.Thread):
+    """
+    Thread serving metrics over HTTP. Scrapes are handled one at a time,
+    so slow client can't start many threads.
+    """
+
+    def __init__(self, address, port, metricsRegistry=registry):
+        """
+        @param address: address to listen on, keep it local
+        @param port: TCP port
+        @throws socket.error if port can't be bound
+        """
+        self.httpd = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+        self.httpd.registry = metricsRegistry
+        threading.Thread.__init__(self, name="metrics")
+        self.setDaemon(True)
+
+    def run(self):
+        logging.info("Serving metrics on %s:%d", *self.httpd.server_address[:2])
+        self.httpd.serve_forever()
@@ -7,22 +7,57 @@ import logging.handlers
 import time
 import ConfigParser
 import threading
-import ssl
+import signal
 import Queue
-import json
-import tempfile
-import irc.client
+import select
+import sqlite3
+import importlib
 
 from binascii import hexlify
 from functools import partial
+from optparse import OptionParser
+from collections import OrderedDict
 
-from nfc_smartcard import NFCDevice, NFCError
-from brmdoor_authenticator import UidAuthenticator, YubikeyHMACAuthenthicator, DesfireEd25519Authenthicator
+from nfc_reader import openReader, NFCError, SIMULATOR_PREFIX
+from brmdoor_authenticator import AuthIndex, AuthRouter
 import unlocker
+from uid_backoff import UidBackoff
+from brmdoor_events import EventBus, EventQueue, WakeupEventQueue, DoorUnlocked, CardDenied, SwitchChanged
+from token_bucket import TokenBucket
+from open_switch import SwitchWatcher, WATCH_MODES
+from brmdoor_spaceapi import SpaceAPIStatusThread, SPACEAPI_SINKS
+from brmdoor_audit import AuditThread, eventRow, EVENT_UNLOCKED, EVENT_DENIED, EVENT_SWITCH
+from event_spool import EventSpool
+from brmdoor_metrics import registry as metricsRegistry, MetricsServer
+from brmdoor_trace import tracer, span, TraceControl
 
-# Map request to change channel's topic to its new prefix. Prefix and rest are delimited with |
-# Channel prefix must include the | character at end, e.g. "OPEN |" or "CLOSED |"
-channelPrefixMap = {}
+SCAN_LOOPS = metricsRegistry.counter("brmdoor_scan_loops_total", "Iterations of reader's card detection loop",
+                                     ["reader"])
+NFC_ERRORS = metricsRegistry.counter("brmdoor_nfc_errors_total",
+                                     "NFCErrors in detection loop, includes empty field", ["reader"])
+# unlocked, extended (lock was already open), denied, ignored (UID still penalized)
+TAP_RESULTS = ["unlocked", "extended", "denied", "ignored"]
+TAPS = metricsRegistry.counter("brmdoor_taps_total", "Cards handled by result", ["reader", "result"])
+TAP_DURATION = metricsRegistry.histogram("brmdoor_tap_duration_seconds",
+                                         "Time from UID read to unlock or denial", ["reader"])
+IRC_CONNECTS = metricsRegistry.counter("brmdoor_irc_connects_total", "IRC connection attempts", ["result"])
+SWITCH_CHANGES = metricsRegistry.counter("brmdoor_switch_changes_total", "Changes of OPEN/CLOSED switch")
+SWITCH_OPEN = metricsRegistry.gauge("brmdoor_switch_open", "1 if OPEN/CLOSED switch is in OPEN position")
+
+# irc and ssl take long to import on Raspberry Pi, they are imported by IrcThread only when IRC is enabled
+irc = None
+ssl = None
+
+def importIrc():
+    """
+    Import irc and ssl modules once, on first use.
+    @throws ImportError if irc is not installed
+    """
+    global irc, ssl
+    if irc is None:
+        import ssl
+        import irc.client
+        import irc.connection
 
 class BrmdoorConfigError(ConfigParser.Error):
     """
@@ -30,58 +65,378 @@ class BrmdoorConfigError(ConfigParser.Error):
     """
     pass
 
-class BrmdoorConfig(object):
+class ReadOnly(object):
     """
-    Configuration parser. Holds config variables from config file.
+    Object whose attributes can't be changed after freeze(), so that
+    validated config can be shared by all threads.
+    """
+
+    def freeze(self):
+        object.__setattr__(self, "_frozen", True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("%s is read-only, can't set %s" % (type(self).__name__, name))
+        object.__setattr__(self, name, value)
+
+class ReaderConfig(ReadOnly):
+    """
+    One NFC reader driven by the daemon and unlocker it opens.
+    """
+
+    def __init__(self, name, connstring, unlockerSection):
+        """
+        :param name: reader name used in logs and thread name
+        :param connstring: libnfc connstring, empty string for default device
+        :param unlockerSection: config section of the unlocker this reader opens
+        """
+        self.name = name
+        self.connstring = connstring
+        self.unlockerSection = unlockerSection
+        self.freeze()
+
+    def __repr__(self):
+        return "<ReaderConfig: %s, connstring: %s, unlocker: %s>" % \
+            (self.name, repr(self.connstring), self.unlockerSection)
+
+class BrmdoorConfig(ReadOnly):
+    """
+    Configuration parser. Holds config variables from config file. All
+    values are read, converted and validated in constructor, so that bad
+    config is reported at startup, afterwards the object is read-only.
+    Lists of values are tuples.
     """
     
+    # Default values of optional options, per section
     _defaults = {
-        "lock_opened_secs": "5",
-        "unknown_uid_timeout_secs": "5",
-        "log_level": "info"
+        "brmdoor": {
+            "lock_opened_secs": "5",
+            "unknown_uid_timeout_secs": "5",
+            "unknown_uid_backoff_factor": "2",
+            "unknown_uid_backoff_max_secs": "60",
+            "unknown_uid_table_size": "256",
+            "log_level": "info",
+            "auth_plugins": "",
+            "desfire_cache_size": "256",
+            "desfire_cache_ttl_secs": "3600",
+            "desfire_layout_cache": "false",
+            "desfire_layout_cache_size": "64",
+            "hmac_challenge_pool_size": "64",
+            "auth_db_watch_mode": "auto",
+            "detect_mode": "list",
+            "detect_timeout_ms": "1000",
+            "detect_min_backoff_ms": "20",
+            "detect_max_backoff_ms": "250",
+        },
+        "irc": {
+            "send_rate": "1",
+            "send_burst": "5",
+            "send_queue_size": "20",
+            "reconnect_min_delay": "5",
+            "spool_filename": "",
+            "spool_size": "1000",
+        },
+        "open_switch": {
+            "watch_mode": "auto",
+            "debounce_ms": "50",
+            "poll_interval_ms": "1000",
+            "spaceapi_sinks": "sftp",
+        },
+        "audit": {
+            "retention_days": "365",
+            "batch_size": "100",
+            "flush_interval_ms": "500",
+        },
+        "metrics": {
+            "listen_address": "127.0.0.1",
+            "port": "9105",
+        },
+        "trace": {
+            "ring_size": "256",
+            "slowest_taps": "20",
+            "dump_dir": "/var/tmp/brmdoor",
+            "profile_interval_ms": "10",
+        },
     }
+
+    # Values accepted by getBool(), same as ConfigParser.getboolean() accepts
+    _booleans = {"1": True, "yes": True, "true": True, "on": True,
+                 "0": False, "no": False, "false": False, "off": False}
+
+    # Card detection modes - scanUID with sleep, reader-side polling, adaptive backoff in NFCDevice
+    _detectModes = ["list", "poll", "adaptive"]
+
+    # How changes of auth DB are noticed - by reload thread watching the file or by stat on each lookup
+    _authDbWatchModes = ["auto", "inotify", "poll", "lookup"]
     
     def __init__(self, filename):
         """
         Parse and read config from given filename.
         
-        @throws ConfigParser.Error if parsing failed
-        @throws BrmdoorConfigError if some value was missing or invalid
+        @throws ConfigParser.Error if parsing failed or some option is missing
+        @throws BrmdoorConfigError if some value was invalid or config file can't be read
         """
-        self.config = ConfigParser.SafeConfigParser(defaults=BrmdoorConfig._defaults)
-        self.config.read(filename)
+        self.filename = filename
+        self.config = ConfigParser.SafeConfigParser()
+        if not self.config.read(filename):
+            raise BrmdoorConfigError("Can't read config file %s" % filename)
         
-        self.authDbFilename = self.config.get("brmdoor", "auth_db_filename")
-        self.desfirePubkey = self.config.get("brmdoor", "desfire_ed25519_pubkey")
-        self.lockOpenedSecs = self.config.getint("brmdoor", "lock_opened_secs")
-        self.unknownUidTimeoutSecs = self.config.getint("brmdoor", "unknown_uid_timeout_secs")
-        self.logFile = self.config.get("brmdoor", "log_file")
-        self.logLevel = self.convertLoglevel(self.config.get("brmdoor", "log_level"))
-        self.unlocker = self.config.get("brmdoor", "unlocker")
-        self.useIRC = self.config.getboolean("irc", "enabled")
+        self.authDbFilename = self.get("brmdoor", "auth_db_filename")
+        self.desfirePubkey = self.get("brmdoor", "desfire_ed25519_pubkey")
+        self.desfireCacheSize = self.getInt("brmdoor", "desfire_cache_size", 0)
+        self.desfireCacheTtlSecs = self.getInt("brmdoor", "desfire_cache_ttl_secs", 0)
+        self.desfireLayoutCache = self.getBool("brmdoor", "desfire_layout_cache")
+        self.desfireLayoutCacheSize = self.getInt("brmdoor", "desfire_layout_cache_size", 0)
+        self.hmacChallengePoolSize = self.getInt("brmdoor", "hmac_challenge_pool_size", 1)
+        self.authDbWatchMode = self.get("brmdoor", "auth_db_watch_mode")
+        if self.authDbWatchMode not in BrmdoorConfig._authDbWatchModes:
+            raise BrmdoorConfigError("Unknown auth_db_watch_mode %s, use one of %s" %
+                                     (self.authDbWatchMode, ", ".join(BrmdoorConfig._authDbWatchModes)))
+        self.lockOpenedSecs = self.getInt("brmdoor", "lock_opened_secs", 1)
+        self.unknownUidTimeoutSecs = self.getInt("brmdoor", "unknown_uid_timeout_secs", 0)
+        self.unknownUidBackoffFactor = self.getFloat("brmdoor", "unknown_uid_backoff_factor", 1)
+        self.unknownUidBackoffMaxSecs = self.getInt("brmdoor", "unknown_uid_backoff_max_secs", 0)
+        self.unknownUidTableSize = self.getInt("brmdoor", "unknown_uid_table_size", 1)
+        self.logFile = self.get("brmdoor", "log_file")
+        self.logLevel = self.convertLoglevel(self.get("brmdoor", "log_level"))
+        self.unlocker = self.get("brmdoor", "unlocker")
+        self.authPlugins = tuple(self.get("brmdoor", "auth_plugins").split())
+        self.detectMode = self.get("brmdoor", "detect_mode")
+        if self.detectMode not in BrmdoorConfig._detectModes:
+            raise BrmdoorConfigError("Unknown detect_mode %s, use one of %s" %
+                                     (self.detectMode, ", ".join(BrmdoorConfig._detectModes)))
+        self.detectTimeoutMs = self.getInt("brmdoor", "detect_timeout_ms", 1)
+        self.detectMinBackoffMs = self.getInt("brmdoor", "detect_min_backoff_ms", 0)
+        self.detectMaxBackoffMs = self.getInt("brmdoor", "detect_max_backoff_ms", 0)
+        if self.detectMinBackoffMs > self.detectMaxBackoffMs:
+            raise BrmdoorConfigError("detect_min_backoff_ms must not be larger than detect_max_backoff_ms")
+        self.readers = tuple(self.parseReaders())
+        # unlocker class of each unlocker section used by readers
+        self.unlockerClasses = dict((reader.unlockerSection, self.unlockerClass(reader.unlockerSection))
+                                    for reader in self.readers)
+        # validated options of each unlocker section used by readers
+        self.unlockerOptions = dict((section, unlockerClass.readOptions(self, section))
+                                    for (section, unlockerClass) in self.unlockerClasses.items())
+        self.useIRC = self.getBool("irc", "enabled")
         if self.useIRC:
-            self.ircServer = self.config.get("irc", "server")
-            self.ircPort = self.config.getint("irc", "port")
-            self.ircNick = self.config.get("irc", "nick")
-            self.ircPassword = self.config.get("irc", "password") if self.config.has_option("irc", "password") else None
-            self.ircChannels = self.config.get("irc", "channels").split(" ")
+            self.ircServer = self.get("irc", "server")
+            self.ircPort = self.getInt("irc", "port", 1)
+            self.ircNick = self.get("irc", "nick")
+            self.ircPassword = self.get("irc", "password") if self.config.has_option("irc", "password") else None
+            self.ircChannels = tuple(self.get("irc", "channels").split())
             if len(self.ircChannels) < 1:
-                print >> sys.stderr, "You must specify at least one channel for IRC when IRC is enabled"
-                sys.exit(1)
-            self.ircUseTLS = self.config.getboolean("irc", "tls")
-            self.ircReconnectDelay = self.config.getint("irc", "reconnect_delay")
-        self.useOpenSwitch = self.config.getboolean("open_switch", "enabled")
+                raise BrmdoorConfigError("You must specify at least one channel for IRC when IRC is enabled")
+            self.ircUseTLS = self.getBool("irc", "tls")
+            self.ircReconnectDelay = self.getInt("irc", "reconnect_delay", 0)
+            self.ircReconnectMinDelay = self.getInt("irc", "reconnect_min_delay", 1)
+            self.ircSpoolFilename = self.get("irc", "spool_filename")
+            self.ircSpoolSize = self.getInt("irc", "spool_size", 1)
+            self.ircSendRate = self.getFloat("irc", "send_rate", 0.01)
+            self.ircSendBurst = self.getInt("irc", "send_burst", 1)
+            self.ircSendQueueSize = self.getInt("irc", "send_queue_size", 1)
+        self.useOpenSwitch = self.getBool("open_switch", "enabled")
         if self.useOpenSwitch:
-            self.switchStatusFile = self.config.get("open_switch", "status_file")
-            self.switchOpenValue = self.config.get("open_switch", "open_value")
-        self.useStatusUpload = self.config.getboolean("open_switch", "spaceapi_status_upload")
+            self.switchStatusFile = self.get("open_switch", "status_file")
+            self.switchOpenValue = self.get("open_switch", "open_value")
+            self.switchWatchMode = self.get("open_switch", "watch_mode")
+            if self.switchWatchMode not in WATCH_MODES:
+                raise BrmdoorConfigError("Unknown watch_mode %s, use one of %s" %
+                                         (self.switchWatchMode, ", ".join(WATCH_MODES)))
+            self.switchDebounceMs = self.getInt("open_switch", "debounce_ms", 0)
+            self.switchPollIntervalMs = self.getInt("open_switch", "poll_interval_ms", 1)
+        self.useStatusUpload = self.getBool("open_switch", "spaceapi_status_upload")
         if self.useStatusUpload:
-            self.sftpHost = self.config.get("open_switch", "spaceapi_sftp_host")
-            self.sftpPort= self.config.getint("open_switch", "spaceapi_sftp_port")
-            self.sftpUsername = self.config.get("open_switch", "spaceapi_sftp_username")
-            self.sftpKey = self.config.get("open_switch", "spaceapi_sftp_key")
-            self.sftpDestFile = self.config.get("open_switch", "spaceapi_dest_file")
-            self.sftpTemplateFile = self.config.get("open_switch", "spaceapi_template_file")
+            self.spaceApiTemplateFile = self.get("open_switch", "spaceapi_template_file")
+            self.spaceApiSinks = tuple(self.get("open_switch", "spaceapi_sinks").split())
+            for sink in self.spaceApiSinks:
+                if sink not in SPACEAPI_SINKS:
+                    raise BrmdoorConfigError("Unknown SpaceAPI sink %s, use some of %s" %
+                                             (sink, ", ".join(SPACEAPI_SINKS)))
+            if "sftp" in self.spaceApiSinks:
+                self.sftpHost = self.get("open_switch", "spaceapi_sftp_host")
+                self.sftpPort = self.getInt("open_switch", "spaceapi_sftp_port", 1)
+                self.sftpUsername = self.get("open_switch", "spaceapi_sftp_username")
+                self.sftpKey = self.get("open_switch", "spaceapi_sftp_key")
+                self.sftpDestFile = self.get("open_switch", "spaceapi_dest_file")
+            if "file" in self.spaceApiSinks:
+                self.spaceApiLocalFile = self.get("open_switch", "spaceapi_local_file")
+            if "http" in self.spaceApiSinks:
+                self.spaceApiHttpUrl = self.get("open_switch", "spaceapi_http_url")
+        # section is optional, so that configs from before audit log existed keep working
+        self.useAudit = self.config.has_section("audit") and self.getBool("audit", "enabled")
+        if self.useAudit:
+            self.auditDbFilename = self.get("audit", "db_filename")
+            self.auditRetentionDays = self.getInt("audit", "retention_days", 0)
+            self.auditBatchSize = self.getInt("audit", "batch_size", 1)
+            self.auditFlushIntervalMs = self.getInt("audit", "flush_interval_ms", 0)
+        if self.useIRC and not self.ircSpoolFilename:
+            # next to audit DB, or to auth DB if audit is off
+            dbFilename = self.auditDbFilename if self.useAudit else self.authDbFilename
+            self.ircSpoolFilename = os.path.join(os.path.dirname(os.path.abspath(dbFilename)), "irc_spool.sqlite")
+        self.useMetrics = self.config.has_section("metrics") and self.getBool("metrics", "enabled")
+        if self.useMetrics:
+            self.metricsListenAddress = self.get("metrics", "listen_address")
+            self.metricsPort = self.getInt("metrics", "port", 1)
+        self.useTrace = self.config.has_section("trace") and self.getBool("trace", "enabled")
+        if self.useTrace:
+            self.traceRingSize = self.getInt("trace", "ring_size", 1)
+            self.traceSlowestTaps = self.getInt("trace", "slowest_taps", 1)
+            self.traceDumpDir = self.get("trace", "dump_dir")
+            self.traceProfileIntervalMs = self.getInt("trace", "profile_interval_ms", 1)
+        self.freeze()
+
+    def get(self, section, option):
+        """
+        Read string option, options missing from config file get value from _defaults.
+        @raises ConfigParser.Error if section or option without default is missing
+        """
+        if not self.config.has_option(section, option):
+            default = BrmdoorConfig._defaults.get(section, {}).get(option)
+            if default is not None and self.config.has_section(section):
+                return default
+        return self.config.get(section, option)
+
+    def getInt(self, section, option, minValue):
+        """
+        Read integer option.
+        @raises BrmdoorConfigError if value is not an integer or is smaller than minValue
+        """
+        return self.getNumber(section, option, minValue, int, "an integer")
+
+    def getFloat(self, section, option, minValue):
+        """
+        Read float option.
+        @raises BrmdoorConfigError if value is not a number or is smaller than minValue
+        """
+        return self.getNumber(section, option, minValue, float, "a number")
+
+    def getNumber(self, section, option, minValue, numberType, typeName):
+        value = self.get(section, option)
+        try:
+            number = numberType(value)
+        except ValueError:
+            raise BrmdoorConfigError("Option %s in [%s] must be %s, got %r" % (option, section, typeName, value))
+        if number < minValue:
+            raise BrmdoorConfigError("Option %s in [%s] must be at least %s, got %s" % (option, section, minValue, value))
+        return number
+
+    def getBool(self, section, option):
+        """
+        Read boolean option (True/False, yes/no, on/off, 1/0).
+        @raises BrmdoorConfigError if value is not a boolean
+        """
+        value = self.get(section, option)
+        try:
+            return BrmdoorConfig._booleans[value.lower()]
+        except KeyError:
+            raise BrmdoorConfigError("Option %s in [%s] must be True or False, got %r" % (option, section, value))
+
+    def unlockerClass(self, section):
+        """
+        Returns unlocker class configured by given section. Class is taken
+        from 'class' option of the section, section name is used as class
+        name if the option is missing.
+
+        @raises BrmdoorConfigError if there is no such unlocker class
+        """
+        if self.config.has_option(section, "class"):
+            unlockerClassName = self.get(section, "class")
+        else:
+            unlockerClassName = section
+        unlockerClass = getattr(unlocker, unlockerClassName, None)
+        if not (isinstance(unlockerClass, type) and issubclass(unlockerClass, unlocker.Unlocker)):
+            raise BrmdoorConfigError("No such unlocker class %s in section [%s]" % (unlockerClassName, section))
+        return unlockerClass
+
+    def requiredModules(self):
+        """Returns names of optional modules that enabled parts of config need"""
+        modules = []
+        if self.useIRC:
+            modules.append("irc.client")
+        if self.useStatusUpload and "sftp" in self.spaceApiSinks:
+            modules.append("paramiko")
+        for unlockerClass in set(self.unlockerClasses.values()):
+            modules.extend(unlockerClass.requiredModules)
+        modules.extend(self.authPlugins)
+        return modules
+
+    def checkEnvironment(self):
+        """
+        Check that files and modules the config refers to exist, without
+        opening readers or connecting anywhere. Used by --check-config.
+
+        @returns list of problems as strings, empty if everything is fine
+        """
+        problems = []
+
+        def checkFile(path, what):
+            if not os.path.isfile(path):
+                problems.append("%s %s does not exist" % (what, path))
+            elif not os.access(path, os.R_OK):
+                problems.append("%s %s is not readable" % (what, path))
+
+        def checkDir(path, what):
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(directory):
+                problems.append("Directory %s of %s does not exist" % (directory, what))
+
+        checkFile(self.authDbFilename, "Auth DB")
+        if self.logFile != "-":
+            checkDir(self.logFile, "log file")
+        for reader in self.readers:
+            if reader.connstring.startswith(SIMULATOR_PREFIX):
+                checkFile(reader.connstring[len(SIMULATOR_PREFIX):], "Tap script of reader %s" % reader.name)
+        if self.useIRC and self.ircSpoolFilename != ":memory:":
+            checkDir(self.ircSpoolFilename, "IRC spool")
+        if self.useOpenSwitch:
+            checkFile(self.switchStatusFile, "Switch status file")
+        if self.useStatusUpload:
+            checkFile(self.spaceApiTemplateFile, "SpaceAPI template")
+            if "sftp" in self.spaceApiSinks:
+                checkFile(self.sftpKey, "SFTP key")
+            if "file" in self.spaceApiSinks:
+                checkDir(self.spaceApiLocalFile, "SpaceAPI local file")
+        if self.useAudit:
+            checkDir(self.auditDbFilename, "audit DB")
+        if self.useTrace:
+            if not os.path.exists(self.traceDumpDir):
+                # created on startup
+                checkDir(self.traceDumpDir, "trace dump directory")
+            elif not os.path.isdir(self.traceDumpDir):
+                problems.append("Trace dump directory %s is not a directory" % self.traceDumpDir)
+
+        for module in self.requiredModules():
+            try:
+                importlib.import_module(module)
+            except ImportError, e:
+                problems.append("Module %s can't be imported: %s" % (module, e))
+        return problems
+
+    def parseReaders(self):
+        """
+        Returns list of ReaderConfig from [readers] section. Each option is
+        reader name, value is libnfc connstring optionally followed by | and
+        section of unlocker to use (defaults to unlocker from [brmdoor]).
+        Without [readers] section, single default libnfc device is used.
+
+        @raises BrmdoorConfigError if reader list is empty or malformed
+        """
+        if not self.config.has_section("readers"):
+            return [ReaderConfig("default", "", self.unlocker)]
+
+        readers = []
+        for name in self.config.options("readers"):
+            parts = [part.strip() for part in self.get("readers", name).split("|")]
+            if len(parts) > 2 or parts[0] == "":
+                raise BrmdoorConfigError("Reader %s must be specified as 'connstring' or 'connstring | unlocker'" % name)
+            unlockerSection = parts[1] if len(parts) > 1 else self.unlocker
+            if not self.config.has_section(unlockerSection):
+                raise BrmdoorConfigError("Missing section [%s] of unlocker for reader %s" % (unlockerSection, name))
+            readers.append(ReaderConfig(name, parts[0], unlockerSection))
+
+        if not readers:
+            raise BrmdoorConfigError("Section [readers] must contain at least one reader")
+        return readers
 
     def convertLoglevel(self, levelString):
         """Converts string 'debug', 'info', etc. into corresponding
@@ -94,23 +449,42 @@ class BrmdoorConfig(object):
         except AttributeError:
             raise BrmdoorConfigError("No such loglevel - %s" % levelString)
 
-class NFCScanner(object):
+class NFCScanner(threading.Thread):
     """Thread reading data from NFC reader"""
             
-    def __init__(self, config, msgQueue, ircThread):
+    def __init__(self, config, reader, authIndex, uidBackoff, unlocker, eventBus):
         """Create worker reading UIDs from PN53x reader.
+
+        :param config - BrmdoorConfig object
+        :param reader - ReaderConfig of the reader this worker drives
+        :param authIndex - AuthIndex shared by all readers
+        :param uidBackoff - UidBackoff shared by all readers, so denied card is penalized on all of them
+        :param unlocker - Unlocker instance this reader opens, may be shared with other readers
+        :param eventBus: EventBus where unlocks and denials are published
         """
-        self.authenticator = UidAuthenticator(config.authDbFilename)
-        self.hmacAuthenticator = None
-        self.desfireAuthenticator = None
-        self.unknownUidTimeoutSecs = config.unknownUidTimeoutSecs
+        self.config = config
+        self.reader = reader
+        self.authIndex = authIndex
+        self.nfc = None
+        self.router = None
+        self.uidBackoff = uidBackoff
         self.lockOpenedSecs = config.lockOpenedSecs
-        self.msgQueue = msgQueue
-        self.ircThread = ircThread
-        
-        unlockerClassName = config.unlocker
-        unlockerClass = getattr(unlocker, unlockerClassName)
-        self.unlocker = unlockerClass(config)
+        self.detectMode = config.detectMode
+        self.detectTimeoutMs = config.detectTimeoutMs
+        self.eventBus = eventBus
+        self.unlocker = unlocker
+        self.stopEvent = threading.Event()
+        # metric children looked up once, so that tap path doesn't
+        self.scanLoops = SCAN_LOOPS.labels(reader=reader.name)
+        self.nfcErrors = NFC_ERRORS.labels(reader=reader.name)
+        self.taps = dict((result, TAPS.labels(reader=reader.name, result=result)) for result in TAP_RESULTS)
+        self.tapDuration = TAP_DURATION.labels(reader=reader.name)
+
+        threading.Thread.__init__(self, name="reader-%s" % reader.name)
+
+    def stop(self):
+        """Ask the thread to finish after current scan"""
+        self.stopEvent.set()
 
     def run(self):
         """
@@ -118,110 +492,196 @@ class NFCScanner(object):
         compares to database of authorized users. Unlocks lock if
         authorized.
         """
-        self.nfc = NFCDevice()
-        self.hmacAuthenticator = YubikeyHMACAuthenthicator(
-            config.authDbFilename, self.nfc
-        )
-        self.desfireAuthenticator = DesfireEd25519Authenthicator(
-            config.authDbFilename, self.nfc,
-            config.desfirePubkey.decode("hex")
-        )
+        try:
+            self.setupReader()
+        except NFCError, e:
+            logging.error("Could not open reader %s: %s", self.reader.name, e.what())
+            return
+
+        logging.info("Opened reader %s", self.reader.name)
         #self.nfc.pollNr = 0xFF #poll indefinitely
-        while True:
+        lastUid = None
+        while not self.stopEvent.is_set():
+            self.scanLoops.inc()
+            detectStart = time.time()
             try:
-                uid_hex = hexlify(self.nfc.scanUID())
+                uid_hex = hexlify(self.detectUID())
                 logging.debug("Got UID %s", uid_hex)
                 if len(uid_hex) > 0:
-                    self.actOnUid(uid_hex)
+                    tracer.begin(self.reader.name, uid_hex, self.nfc.lastScanMs)
+                    result = "error"
+                    try:
+                        result = self.actOnUid(uid_hex, inField=(uid_hex == lastUid))
+                    finally:
+                        tracer.end(result)
+                    if uid_hex == lastUid:
+                        #card left in field, don't hammer reader with scans of the same card
+                        self.stopEvent.wait(timeout=0.2)
+                    lastUid = uid_hex
                 else:
                     #prevent busy loop if reader goes awry
-                    e = threading.Event()
-                    e.wait(timeout=0.3)
+                    self.stopEvent.wait(timeout=0.3)
             except NFCError, e:
                 #this exception happens also when scanUID finds no cards
                 logging.debug("Failed to find RFID cards in reader's field: %s", e)
-                e = threading.Event()
-                e.wait(timeout=0.2)
-            except KeyboardInterrupt:
-                logging.info("Exiting on keyboard interrupt")
-                self.nfc.close()
-                self.nfc.unload()
-                self.unlocker.lock()
-                sys.exit(2)
+                self.nfcErrors.inc()
+                lastUid = None
+                #adaptive and poll modes already waited inside reader, unless it failed right away
+                if self.detectMode == "list" or time.time() - detectStart < self.detectWaitSecs() / 2:
+                    self.stopEvent.wait(timeout=0.2)
             except Exception:
-                logging.exception("Exception in main unlock thread")
+                logging.exception("Exception in reader %s thread", self.reader.name)
+                self.stopEvent.wait(timeout=0.2)
+
+        logging.info("Closing reader %s", self.reader.name)
+        self.nfc.close()
+        self.nfc.unload()
 
-    def sendIrcMessage(self, msg):
+    def setupReader(self):
         """
-        Send message to IRC bot. Message is dropped if bot is not connected
-        :param msg: message to be displayed in joined channels
+        Open the reader and create authenticators talking to the card through it.
+
+        @throws NFCError if reader can't be opened
         """
-        if not self.ircThread:
-            return
-        if self.ircThread.getConnected():
-            self.msgQueue.put(msg)
+        self.nfc = openReader(self.reader.connstring)
+        self.nfc.minBackoffMs = self.config.detectMinBackoffMs
+        self.nfc.maxBackoffMs = self.config.detectMaxBackoffMs
+        self.nfc.desfireLayoutCache = self.config.desfireLayoutCache
+        self.nfc.desfireLayoutCacheMax = self.config.desfireLayoutCacheSize
+        self.router = AuthRouter(self.config, self.nfc, self.authIndex)
+
+    def detectWaitSecs(self):
+        """How long detectUID() waits for a card in reader's field before it gives up"""
+        if self.detectMode == "adaptive":
+            return self.detectTimeoutMs / 1000.0
+        elif self.detectMode == "poll":
+            # libnfc poll period unit is 150 ms
+            return self.nfc.pollNr * self.nfc.pollPeriod * 0.15
+        return 0
 
-    def actOnUid(self, uid_hex):
+    def detectUID(self):
+        """
+        Wait for card using configured detect mode and return its binary UID.
+
+        @throws NFCError if no card was found
+        """
+        if self.detectMode == "adaptive":
+            uid = self.nfc.waitForUID(self.detectTimeoutMs)
+            logging.debug("Card detected, latency at most %.1f ms (probe %.1f ms)",
+                          self.nfc.lastDetectLatencyMs, self.nfc.lastScanMs)
+            return uid
+        elif self.detectMode == "poll":
+            return self.nfc.pollUID()
+        else:
+            return self.nfc.scanUID()
+
+    def actOnUid(self, uid_hex, inField=False):
         """
         Do something with the UID scanned. Try to authenticate it against
         database and open lock if authorized.
+
+        :param inField - card was read by previous scan too and didn't leave the field
+        :returns one of TAP_RESULTS
         """
-        record = self.authenticator.fetchUidRecord(uid_hex)
-        
-        #direct UID match
-        if record is not None:
-            logging.info("Unlocking for UID %s", record)
-            self.sendIrcMessage("Unlocking door")
-            self.unlocker.unlock()
-            return
-        
-        #test for Yubikey HMAC auth
-        record = self.hmacAuthenticator.checkHMACforUID(uid_hex)
-        
+        if self.uidBackoff.isBlocked(uid_hex):
+            logging.debug("Ignoring UID %s, it was denied recently", uid_hex)
+            self.taps["ignored"].inc()
+            return "ignored"
+
+        start = time.time()
+        # single index lookup tells which method applies, only its authenticator is run
+        (record, authenticator) = self.router.authenticate(uid_hex)
         if record is not None:
-            logging.info("Unlocking after HMAC for UID %s", record)
-            self.sendIrcMessage("Unlocking door")
-            self.unlocker.unlock()
-            return
+            self.uidBackoff.forgive(uid_hex)
+            # unlock returns immediately, relock is done by unlocker's timer
+            with span("unlock"):
+                newlyUnlocked = self.unlocker.unlock()
+            if newlyUnlocked:
+                self.taps["unlocked"].inc()
+                logging.info("Unlocking after %s check for UID %s on reader %s",
+                             authenticator.description, record, self.reader.name)
+            else:
+                self.taps["extended"].inc()
+                if inField:
+                    # same card held in field, it was already logged when it was tapped
+                    logging.debug("Card still in field, extended open time for UID %s", record)
+                    return "extended"
+                logging.info("Lock already open, extending open time after %s check for UID %s on reader %s",
+                             authenticator.description, record, self.reader.name)
+            self.tapDuration.observe(time.time() - start)
+            self.eventBus.publish(DoorUnlocked(self.reader.name, record.uid_hex, record.nick,
+                                               authenticator.description, extended=not newlyUnlocked))
+            return "unlocked" if newlyUnlocked else "extended"
 
-        #test for Desfire NDEF auth
-        record = self.desfireAuthenticator.checkUIDSignature(uid_hex)
+        # only this UID is penalized, other cards are still served
+        penalty = self.uidBackoff.recordDenial(uid_hex)
+        self.tapDuration.observe(time.time() - start)
+        self.taps["denied"].inc()
+        logging.info("Unknown UID %s on reader %s, ignoring it for %.0f s", uid_hex, self.reader.name, penalty)
+        logging.debug("Denied UID backoff stats: %s", self.uidBackoff.stats())
+        self.eventBus.publish(CardDenied(self.reader.name, uid_hex, penalty))
+        return "denied"
 
-        if record is not None:
-            logging.info("Unlocking after Desfire NDEF ed25519 check for UID %s", record)
-            self.sendIrcMessage("Unlocking door")
-            self.unlocker.unlock()
-            return
+def createUnlocker(config, section):
+    """
+    Create unlocker configured by given config section. Unlocker class was
+    already resolved when config was read.
 
-        logging.info("Unknown UID %s", uid_hex)
-        self.sendIrcMessage("Denied unauthorized card")
-        e = threading.Event()
-        e.wait(timeout=self.unknownUidTimeoutSecs)
+    :param config - BrmdoorConfig object
+    :param section - config section of the unlocker
+    """
+    return config.unlockerClasses[section](config, section)
 
 class IrcThread(threading.Thread):
     """
-    Class for showing messages about lock events and denied/accepted cards
+    Class for showing messages about lock events and denied/accepted cards.
+    Events happening while not connected to IRC are spooled and shown as one
+    summary message after reconnect.
     """
-    def __init__(self, config, msgQueue):
+    # How long to wait for IRC data or events when there is nothing to send
+    idleTimeout = 5
+
+    def __init__(self, config, eventQueue):
         """
         Create thread for IRC connection.
 
         :param config - BrmdoorConfig object
-        :param msgQueue: Queue.Queue instance where we will get messages to show
+        :param eventQueue: WakeupEventQueue with events to show in channels
+        :throws ImportError if irc module is not installed
         """
+        importIrc()
         self.server = config.ircServer
         self.port = config.ircPort
         self.nick = config.ircNick
         self.password = config.ircPassword
         self.channels = config.ircChannels
         self.useSSL = config.ircUseTLS
-        self.reconnectDelay = config.ircReconnectDelay
-        self.msgQueue = msgQueue
+        # reconnect delay doubles with each failed attempt up to reconnect_delay
+        self.reconnectMinDelay = config.ircReconnectMinDelay
+        self.reconnectMaxDelay = config.ircReconnectDelay
+        self.reconnectAttempts = 0
+        self.nextConnectAttempt = 0
+        self.eventQueue = eventQueue
         self.connection = None
         self.reactor = None
         self.connected = False
+        # events older than this happened while we were not connected and are spooled
+        self.connectedSince = None
+        self.joinedChannels = set()
+        self.spool = EventSpool(config.ircSpoolFilename, config.ircSpoolSize)
+        # spool drops already mentioned in summary
+        self.spoolDroppedReported = 0
+        # Map request to change channel's topic to its new prefix. Prefix and rest are delimited with |
+        # Channel prefix must include the | character at end, e.g. "OPEN |" or "CLOSED |"
+        self.topicPrefixes = {}
+        # message -> how many times it was queued, waiting for flood control
+        self.pendingMessages = OrderedDict()
+        self.sendQueueSize = config.ircSendQueueSize
+        self.sendBucket = TokenBucket(config.ircSendRate, config.ircSendBurst)
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
         self.threadLock = threading.Lock()
-        self.connection = None
 
         threading.Thread.__init__(self)
 
@@ -229,6 +689,10 @@ class IrcThread(threading.Thread):
         """ Set the connection status (result) of last connection attempt"""
         with self.threadLock:
             self.connected = connected
+            if connected:
+                self.connectedSince = time.time()
+            else:
+                self.joinedChannels.clear()
 
     def getConnected(self):
         """ Return whether we are connected to IRC"""
@@ -237,14 +701,15 @@ class IrcThread(threading.Thread):
 
     def connect(self):
         """
-        Connect to server.
+        Connect to server. Doesn't block waiting for retry, failed attempt
+        schedules next one.
         :returns true if connection was successful
         """
         try:
             logging.info("IRC connect attempt")
             ssl_factory = irc.connection.Factory(wrapper=ssl.wrap_socket)
-            self.reactor = irc.client.Reactor()
-            self.connection = self.reactor.server().connect(
+            # connecting again disconnects the previous session of the same connection
+            self.connection.connect(
                 self.server,
                 self.port,
                 self.nick,
@@ -254,11 +719,22 @@ class IrcThread(threading.Thread):
             )
 
             logging.info("IRC connect successful")
+            IRC_CONNECTS.labels(result="ok").inc()
+            self.setConnected(True)
             return True
         except irc.client.ServerConnectionError, e:
             logging.error("Could not connect to IRC server: %s", e)
+            IRC_CONNECTS.labels(result="failed").inc()
+            self.scheduleReconnect()
             return False
 
+    def scheduleReconnect(self):
+        """Schedule next connect attempt with exponential backoff"""
+        delay = min(self.reconnectMaxDelay, self.reconnectMinDelay * 2 ** self.reconnectAttempts)
+        self.reconnectAttempts += 1
+        self.nextConnectAttempt = time.time() + delay
+        logging.info("Next IRC connect attempt in %s seconds", delay)
+
     def getTopic(self, channel):
         """ Request topic. You need to wait in currenttopic callback for result """
         with self.threadLock:
@@ -271,40 +747,27 @@ class IrcThread(threading.Thread):
 
     def onConnect(self, connection, event):
         """ Callback when IRC server is connected. Joins channels specified in config. """
+        self.reconnectAttempts = 0
         logging.info("Joining channels: %s", self.channels)
         for channel in self.channels:
             connection.join(channel)
 
     def onDisconnect(self, connection, event):
         """
-        Disconnect handler that attempts reconnect.
+        Disconnect handler, schedules reconnect. Events are spooled until
+        channels are joined again.
         TODO: investigate reconnect and channel re-join behavior upon netsplits.
         """
-        logging.info("Disconnected, waiting for %s seconds before reconnect", self.reconnectDelay)
         self.setConnected(False)
-        time.sleep(self.reconnectDelay)
-        reconnected = self.connect()
-        logging.info("IRC reconnect attempt success: %s", reconnected)
-        self.setConnected(reconnected)
-        if reconnected:
-            try:
-                logging.info("Rejoining channels: %s", self.channels)
-                for channel in self.channels:
-                    self.connection.join(channel)
-            except:
-                logging.exception("Exception when rejoining channels")
-            try:
-                self.reactor.server().add_global_handler("notopic", partial(IrcThread.onNoTopic, self))
-                self.reactor.server().add_global_handler("currenttopic", partial(IrcThread.onTopic, self))
-            except:
-                logging.exception("Exception while reassigning topic handlers")
-
+        self.scheduleReconnect()
 
     def onJoin(self, connection, event):
         """ Callback when channel is joined """
         nick, _ = event.source.split("!", 2)
-        if (nick == config.ircNick):
+        if (nick == self.nick):
             logging.info("Joined channel, event: %s", event)
+            with self.threadLock:
+                self.joinedChannels.add(event.target)
         logging.debug("join event - source %s, target: %s, type: %s", event.source, event.target, event.type)
         #connection.privmsg(self.channels[0], "brmbot-libfc starting")
 
@@ -313,23 +776,22 @@ class IrcThread(threading.Thread):
         Callback when we see IRC topic message. It can be caused by us or other users in channel.
         Check if there was request to change topic and update it.
         """
-        global channelPrefixMap
         channel = event.arguments[0]
         topic = event.arguments[1]
         logging.info("Current topic: channel %s, topic %s", channel, topic)
         logging.info("Topic event - source %s, target: %s, type: %s", event.source, event.target, event.type)
         # if change was requested, update channel topic
-        if channelPrefixMap.get(channel):
+        if self.topicPrefixes.get(channel):
             #update topic part before |, or replace entirely if | is not present
             topicParts = topic.split("|", 1)
             restOfTopic = ""
             if (len(topicParts) > 1):
                 restOfTopic = topicParts[1]
 
-            newTopic = channelPrefixMap[channel] + restOfTopic
+            newTopic = self.topicPrefixes[channel] + restOfTopic
             logging.info("Setting new topic for channel %s: %s", channel, newTopic)
             self.setTopic(channel, newTopic)
-            del channelPrefixMap[channel] # remove request
+            del self.topicPrefixes[channel] # remove request
 
     def onNoTopic(self, connection, event):
         """ Callback on empty topic. I couldn't trigger this, so it's untested. """
@@ -338,173 +800,382 @@ class IrcThread(threading.Thread):
         logging.info("No topic: channel %s, topic %s", channel, topic)
         logging.info("No topic event - source %s, target: %s, type: %s", event.source, event.target, event.type)
 
-    def run(self):
-        logging.debug("Starting IRC thread")
-        while True:
-            try:
-                connected = self.connect()
-                logging.info("IRC connected: %s", connected)
-                self.setConnected(connected)
-                self.connection.add_global_handler("welcome", partial(IrcThread.onConnect, self))
-                self.connection.add_global_handler("disconnect", partial(IrcThread.onDisconnect, self))
-                self.connection.add_global_handler("join", partial(IrcThread.onJoin, self))
-                self.reactor.server().add_global_handler("notopic", partial(IrcThread.onNoTopic, self))
-                self.reactor.server().add_global_handler("currenttopic", partial(IrcThread.onTopic, self))
-
-                # Topic handler requires sadly completely different API to retrieve topic
-                # see https://github.com/jaraco/irc/issues/132
-
-                while self.getConnected():
-                    try:
-                        self.reactor.process_once(timeout=5)
-                        try:
-                            with self.threadLock:
-                                msg = self.msgQueue.get_nowait()
-                                self.connection.privmsg_many(self.channels, msg)
-                        except Queue.Empty:
-                            pass
-                    except UnicodeDecodeError:
-                        logging.warn("Skipped incorrectly encoded message, cannot decode to UTF-8")
-                    except UnicodeEncodeError:
-                        logging.warn("We were sending badly encoded message? maybe via topic?")
-            except Exception:
-                logging.exception("Exception in IRC thread")
-            time.sleep(self.reconnectDelay)
+    def isOnline(self):
+        """Returns true if connected and at least one channel is joined"""
+        with self.threadLock:
+            return self.connected and len(self.joinedChannels) > 0
 
-class SpaceAPIUploader(object):
-    """
-    Class for uploading JSON-formatted SpaceAPI status via SFTP
-    """
+    def handleEvent(self, event):
+        """
+        Show event in joined channels. Events that happened while we were
+        not connected are spooled.
+        """
+        if not self.isOnline() or event.timestamp < self.connectedSince:
+            row = eventRow(event)
+            if row is not None:
+                (timestamp, eventType, _, _, _, detail) = row
+                self.spool.append(timestamp, eventType, detail)
+            return
 
-    def __init__(self, config):
-        """ Create uploader with store settings, not yet connected."""
-        self.config = config
+        if isinstance(event, DoorUnlocked):
+            self.queueMessage("Extending door unlock" if event.extended else "Unlocking door")
+        elif isinstance(event, CardDenied):
+            self.queueMessage("Denied unauthorized card")
+        elif isinstance(event, SwitchChanged):
+            self.requestTopicChange(event.isOpen)
 
-    def upload(self, isOpen):
-        """
-        Upload status via SFTP. Current timestamp will be added as last change.
+    def requestTopicChange(self, isOpen):
+        """Request topic of all channels so that onTopic can change its OPEN/CLOSED prefix"""
+        strStatus = "OPEN |" if isOpen else "CLOSED |"
+        for channel in self.channels:
+            logging.info("Request topic for channel %s with intention to change it, prefix %s",
+                         channel, strStatus)
+            self.topicPrefixes[channel] = strStatus
+            self.getTopic(channel)
 
-        :param isOpen - whether space is opened.
-        :raises paramiko.ssh_exception.SSHException when upload fails (timeout, can't connect, host key mismatch...)
+    def spoolSummary(self, events):
+        """
+        Summarize spooled events into one message.
+        @param events: list of (id, ts, type, detail) as returned by EventSpool.events()
+        @returns (message, isOpen) where isOpen is the last switch state or None if switch didn't change
         """
-        import paramiko
-        dirname, targetFname = os.path.split(self.config.sftpDestFile)
+        unlocks = 0
+        denials = 0
+        switchChanges = 0
+        isOpen = None
+        for (_, _, eventType, detail) in events:
+            if eventType == EVENT_UNLOCKED:
+                unlocks += 1
+            elif eventType == EVENT_DENIED:
+                denials += 1
+            elif eventType == EVENT_SWITCH:
+                switchChanges += 1
+                isOpen = (detail == "open")
 
-        spaceApiJson = json.load(file("spaceapi_template.json"))
-        spaceApiJson["state"] = {"open": isOpen, "lastchange": time.time()}
+        parts = ["%d unlock%s" % (unlocks, "" if unlocks == 1 else "s"),
+                 "%d denial%s" % (denials, "" if denials == 1 else "s")]
+        if switchChanges:
+            parts.append("switch changed %dx, now %s" % (switchChanges, "OPEN" if isOpen else "CLOSED"))
+        dropped = self.spool.dropped - self.spoolDroppedReported
+        if dropped:
+            parts.append("%d older events not kept" % dropped)
+        since = time.strftime("%Y-%m-%d %H:%M", time.localtime(events[0][1]))
+        return ("While offline since %s: %s" % (since, ", ".join(parts)), isOpen)
 
-        with tempfile.NamedTemporaryFile() as tf:
-            log_paramiko = logging.getLogger("paramiko")
-            if log_paramiko:
-                log_paramiko.setLevel(logging.WARNING)
+    def replaySpool(self):
+        """
+        Show spooled events as one summary message, sent through flood
+        control like any other message, and set topic to last switch state.
+        """
+        events = self.spool.events()
+        (msg, isOpen) = self.spoolSummary(events)
+        logging.info("Replaying %d spooled IRC events: %s", len(events), msg)
+        self.queueMessage(msg)
+        if isOpen is not None:
+            self.requestTopicChange(isOpen)
+        self.spool.remove(events[-1][0])
+        self.spoolDroppedReported = self.spool.dropped
 
-            json.dump(spaceApiJson, tf, indent=4, ensure_ascii=True, encoding='utf-8')
-            tf.flush()
-            localFilename = tf.name
+    def queueMessage(self, msg):
+        """
+        Queue message for sending to channels. Message equal to one already
+        waiting is merged with it. If the queue is full, the oldest waiting
+        message is dropped.
+        """
+        if msg in self.pendingMessages:
+            self.pendingMessages[msg] += 1
+            self.coalesced += 1
+            return
+        if len(self.pendingMessages) >= self.sendQueueSize:
+            (droppedMsg, count) = self.pendingMessages.popitem(last=False)
+            self.dropped += count
+            logging.warning("IRC send queue full, dropped message: %s", droppedMsg)
+        self.pendingMessages[msg] = 1
 
-            pkey = None
-            ssh = None
-            sftp = None
+    def flushMessages(self):
+        """Send waiting messages as long as flood control allows"""
+        while self.pendingMessages and self.sendBucket.consume():
+            (msg, count) = self.pendingMessages.popitem(last=False)
+            if count > 1:
+                msg = "%s (%dx)" % (msg, count)
+            with self.threadLock:
+                self.connection.privmsg_many(self.channels, msg)
+            self.sent += 1
 
-            for pkey_class in (paramiko.RSAKey, paramiko.DSSKey, paramiko.ECDSAKey, paramiko.Ed25519Key):
-                try:
-                    pkey = pkey_class.from_private_key_file(self.config.sftpKey)
-                    logging.debug("Loaded SSH key of type %s", pkey_class)
-                    break
-                except paramiko.ssh_exception.SSHException:
-                    pass
+    def queueDepth(self):
+        """Returns number of events and messages waiting to be sent"""
+        return self.eventQueue.qsize() + len(self.pendingMessages)
 
-            if pkey is None:
-                logging.error("Failed to load private SSH key", self.config.sftpKey)
-                raise paramiko.ssh_exception.SSHException("Can't read private SSH key")
+    def stats(self):
+        """Returns dict with queue depth, spool size and counts of sent, coalesced and dropped messages"""
+        return {
+            "queue_depth": self.queueDepth(),
+            "spooled": len(self.spool),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped + self.eventQueue.dropped + self.spool.dropped,
+        }
 
-            try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(self.config.sftpHost, username=self.config.sftpUsername, pkey=pkey, timeout=20)
-                sftp = ssh.open_sftp()
+    def processOnce(self):
+        """
+        Wait until IRC server sends data, event is queued, flood control
+        lets waiting message out or it's time to reconnect, then handle all
+        of that. Events are handled right when they are queued, not on
+        reactor timeout.
+        """
+        if not self.getConnected() and time.time() >= self.nextConnectAttempt:
+            self.connect()
 
-                sftp.chdir(dirname)
-                sftp.put(localFilename, targetFname)
+        online = self.isOnline()
+        timeout = self.idleTimeout
+        if online and self.pendingMessages:
+            timeout = min(timeout, self.sendBucket.waitTime())
+        if not self.getConnected():
+            timeout = max(0, min(timeout, self.nextConnectAttempt - time.time()))
+        sockets = self.reactor.sockets
+        (readable, _, _) = select.select(sockets + [self.eventQueue], [], [], timeout)
 
-            finally:
-                if sftp:
-                    sftp.close()
+        self.reactor.process_data([sock for sock in readable if sock is not self.eventQueue])
+        self.reactor.process_timeout()
 
-                if ssh:
-                    ssh.close()
+        # summary of offline time goes out right after join, before messages about newer events
+        if self.isOnline() and len(self.spool) > 0:
+            self.replaySpool()
+        self.eventQueue.clearWakeup()
+        try:
+            while True:
+                self.handleEvent(self.eventQueue.get_nowait())
+        except Queue.Empty:
+            pass
+        if self.isOnline():
+            self.flushMessages()
 
+    def run(self):
+        logging.debug("Starting IRC thread")
+        # one reactor and connection reused for all reconnects, handlers are registered only once
+        self.reactor = irc.client.Reactor()
+        self.connection = self.reactor.server()
+        self.reactor.add_global_handler("welcome", partial(IrcThread.onConnect, self))
+        self.reactor.add_global_handler("disconnect", partial(IrcThread.onDisconnect, self))
+        self.reactor.add_global_handler("join", partial(IrcThread.onJoin, self))
+        # Topic handler requires sadly completely different API to retrieve topic
+        # see https://github.com/jaraco/irc/issues/132
+        self.reactor.add_global_handler("notopic", partial(IrcThread.onNoTopic, self))
+        self.reactor.add_global_handler("currenttopic", partial(IrcThread.onTopic, self))
+
+        while True:
+            try:
+                self.processOnce()
+            except UnicodeDecodeError:
+                logging.warn("Skipped incorrectly encoded message, cannot decode to UTF-8")
+            except UnicodeEncodeError:
+                logging.warn("We were sending badly encoded message? maybe via topic?")
+            except sqlite3.Error:
+                logging.exception("IRC event spool %s failed", self.spool.filename)
+                time.sleep(1)
+            except Exception:
+                logging.exception("Exception in IRC thread")
+                if not self.getConnected():
+                    self.scheduleReconnect()
+                time.sleep(1)
 
 class OpenSwitchThread(threading.Thread):
     """
-    Class for watching OPEN/CLOSED switch that
+    Class for watching OPEN/CLOSED switch that publishes its changes as SwitchChanged events.
     """
-    def __init__(self, config, ircThread):
+    def __init__(self, config, eventBus):
         """
-        Create thread for IRC connection.
+        Create thread watching the switch.
 
         :param config - BrmdoorConfig object
-        :param ircThread: IrcThread through which we can set and receive current topics
+        :param eventBus: EventBus where switch changes are published
         """
         self.statusFile = config.switchStatusFile
         self.openValue = config.switchOpenValue
-        self.ircThread = ircThread
+        self.eventBus = eventBus
         self.config = config
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name="open-switch")
 
     def run(self):
 
         lastStatus = None #Some random value so that first time it will be registered as change
+        watcher = None
         while True:
             try:
-                with open(self.statusFile) as switchFile:
-                    status = switchFile.read().rstrip()
-                if status != lastStatus:
+                if watcher is None:
+                    watcher = SwitchWatcher(self.statusFile, self.config.switchWatchMode,
+                                            self.config.switchDebounceMs, self.config.switchPollIntervalMs)
+                status = watcher.read()
+                if status is not None and status != lastStatus:
                     logging.info("Open switch status changed, new status: %s", status)
+                    if lastStatus is not None:
+                        SWITCH_CHANGES.inc()
+                    SWITCH_OPEN.set(1 if status == self.openValue else 0)
                     lastStatus = status
-                    if status == self.openValue:
-                        strStatus = "OPEN |"
-                    else:
-                        strStatus = "CLOSED |"
-
-                    try:
-                        #this will upload status always upon brmdoor start, which is better than waiting until someone
-                        #changes status with button
-                        if self.config.useStatusUpload:
-                            isOpen = (status == self.openValue)
-                            uploader = SpaceAPIUploader(self.config)
-                            logging.info("Going to upload spaceAPI status, opened: %s, status: %s", isOpen, status)
-                            uploader.upload(isOpen)
-                            logging.info("SpaceAPI json status upload finished")
-                    except Exception:
-                        #we could use retrying with @retry decorator, but it's likely that it wouldn't help with
-                        #current connection/upload/out of disk space or similar problem
-                        logging.exception("Failed to upload spaceAPI status JSON")
-
-                    if self.ircThread is not None and self.ircThread.connected:
-                        for channel in self.ircThread.channels:
-                            logging.info("Request topic for channel %s with intention to change it, prefix %s",
-                                         channel, strStatus)
-                            channelPrefixMap[channel] = strStatus
-                            self.ircThread.getTopic(channel)
+                    #this will upload status always upon brmdoor start, which is better than waiting until someone
+                    #changes status with button
+                    self.eventBus.publish(SwitchChanged(status, status == self.openValue))
+                # blocks until the switch changes, no wakeups meanwhile except in poll mode
+                watcher.wait()
             except (IOError, OSError):
                 logging.debug("Could not read switch status file %s", self.statusFile)
+                if watcher is not None:
+                    watcher.close()
+                    watcher = None
                 e = threading.Event()
                 e.wait(timeout=5)
                 pass #just log the error, but don't spam IRC
             except Exception:
                 logging.exception("Exception in open switch thread")
-            e = threading.Event()
-            e.wait(timeout=1)
+                e = threading.Event()
+                e.wait(timeout=1)
+
+class AuthReloadThread(threading.Thread):
+    """
+    Reloads auth index in background when the DB file changes or reload is
+    requested (SIGHUP). Readers keep using the old index until new one is
+    swapped in, so no tap waits for the reload.
+    """
 
+    # How often reload request is checked when the file doesn't change
+    requestCheckSecs = 1.0
+    # Writes to DB within this time are coalesced into one reload
+    settleSecs = 0.2
+
+    def __init__(self, config, authIndex, uidBackoff):
+        """
+        :param config - BrmdoorConfig object
+        :param authIndex - AuthIndex created with checkOnLookup=False
+        :param uidBackoff - UidBackoff whose penalties are forgiven after reload,
+            so that just added card isn't ignored
+        """
+        self.config = config
+        self.authIndex = authIndex
+        self.uidBackoff = uidBackoff
+        self.reloadRequested = threading.Event()
+        threading.Thread.__init__(self, name="auth-reload")
+
+    def requestReload(self):
+        """Ask for reload even if DB file looks unchanged, safe to call from signal handler"""
+        self.reloadRequested.set()
+
+    def run(self):
+        watcher = None
+        while True:
+            try:
+                if watcher is None:
+                    watcher = SwitchWatcher(self.authIndex.filename, self.config.authDbWatchMode, 0,
+                                            self.requestCheckSecs * 1000)
+                if watcher.waitForEvent(self.requestCheckSecs):
+                    # let the writer finish, e.g. import commits several pages
+                    while watcher.waitForEvent(self.settleSecs) and watcher.mode != "poll":
+                        pass
+                force = self.reloadRequested.is_set()
+                self.reloadRequested.clear()
+                if force:
+                    logging.info("Reloading auth index on request")
+                if self.authIndex.reloadIfChanged(force):
+                    self.uidBackoff.forgiveAll()
+            except (IOError, OSError), e:
+                logging.error("Can't watch auth DB %s: %s", self.authIndex.filename, e)
+                if watcher is not None:
+                    watcher.close()
+                    watcher = None
+                self.reloadRequested.wait(5)
+            except Exception:
+                logging.exception("Exception in auth reload thread")
+                self.reloadRequested.wait(1)
+
+def collectDaemonMetrics(authIndex, uidBackoff, unlockers, scanners, eventQueues, sinkThreads):
+    """
+    Metrics collector reading state that components already keep, called
+    only when metrics are scraped.
+
+    :returns list of (name, type, help, [(labels dict, value)])
+    """
+    backoffStats = uidBackoff.stats()
+    families = [
+        ("brmdoor_lock_unlocked", "gauge", "1 while the lock is held open",
+         [({"unlocker": name}, int(lockUnlocker.isUnlocked())) for (name, lockUnlocker) in unlockers.items()]),
+        ("brmdoor_auth_index_uids", "gauge", "UIDs in auth index", [({}, len(authIndex.records))]),
+        ("brmdoor_uid_backoff_denials_total", "counter", "Denied cards", [({}, backoffStats["denials"])]),
+        ("brmdoor_uid_backoff_suppressed_total", "counter", "Taps of penalized UIDs that were ignored",
+         [({}, backoffStats["suppressed"])]),
+        ("brmdoor_uid_backoff_tracked", "gauge", "Penalized UIDs remembered", [({}, backoffStats["tracked"])]),
+        ("brmdoor_uid_backoff_evictions_total", "counter", "Penalized UIDs evicted from full table",
+         [({}, backoffStats["evictions"])]),
+        ("brmdoor_event_queue_depth", "gauge", "Events waiting in sink's queue",
+         [({"queue": queue.name}, queue.qsize()) for queue in eventQueues]),
+        ("brmdoor_event_queue_dropped_total", "counter", "Events dropped because sink's queue was full",
+         [({"queue": queue.name}, queue.dropped) for queue in eventQueues]),
+    ]
+
+    layoutHits = []
+    layoutMisses = []
+    signatureCache = dict((key, []) for key in ("hits", "misses", "evictions"))
+    for scanner in scanners:
+        labels = {"reader": scanner.reader.name}
+        if scanner.nfc is not None:
+            layoutHits.append((labels, scanner.nfc.desfireLayoutHits))
+            layoutMisses.append((labels, scanner.nfc.desfireLayoutMisses))
+        if scanner.router is not None:
+            for authenticator in scanner.router.authenticators.values():
+                stats = authenticator.cacheStats() if hasattr(authenticator, "cacheStats") else None
+                if stats is not None:
+                    for key in signatureCache:
+                        signatureCache[key].append((labels, stats[key]))
+    families.append(("brmdoor_desfire_layout_cache_hits_total", "counter",
+                     "Desfire reads using cached NDEF layout", layoutHits))
+    families.append(("brmdoor_desfire_layout_cache_misses_total", "counter",
+                     "Desfire reads discovering NDEF layout", layoutMisses))
+    for key in sorted(signatureCache):
+        families.append(("brmdoor_desfire_signature_cache_%s_total" % key, "counter",
+                         "Desfire signature verification cache %s" % key, signatureCache[key]))
+
+    for sinkThread in sinkThreads:
+        if isinstance(sinkThread, IrcThread):
+            ircStats = sinkThread.stats()
+            families.append(("brmdoor_irc_connected", "gauge", "1 while connected to IRC",
+                             [({}, int(sinkThread.getConnected()))]))
+            families.append(("brmdoor_irc_queue_depth", "gauge", "IRC events and messages waiting to be sent",
+                             [({}, ircStats["queue_depth"])]))
+            families.append(("brmdoor_irc_spooled_events", "gauge", "Events spooled while not connected to IRC",
+                             [({}, ircStats["spooled"])]))
+            families.append(("brmdoor_irc_messages_total", "counter", "IRC messages by result",
+                             [({"result": key}, ircStats[key]) for key in ("sent", "coalesced", "dropped")]))
+        elif isinstance(sinkThread, AuditThread):
+            families.append(("brmdoor_audit_events_written_total", "counter", "Events written to audit DB",
+                             [({}, sinkThread.written)]))
+    return families
 
 if __name__  == "__main__":
-    
-    if len(sys.argv) < 2:
-        print >> sys.stderr, "Syntax: brmdoor_nfc_daemon.py brmdoor_nfc.config"
+    parser = OptionParser(usage="%prog [--check-config] brmdoor_nfc.config")
+    parser.add_option("-c", "--check-config", action="store_true", dest="checkConfig", default=False,
+        help="Validate config, check that files and modules it needs exist and exit")
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
         sys.exit(1)
-    
-    config = BrmdoorConfig(sys.argv[1])
+
+    try:
+        config = BrmdoorConfig(args[0])
+    except ConfigParser.Error, e:
+        print >> sys.stderr, "Invalid config %s: %s" % (args[0], e)
+        sys.exit(1)
+
+    if opts.checkConfig:
+        problems = config.checkEnvironment()
+        for problem in problems:
+            print >> sys.stderr, problem
+        if problems:
+            sys.exit(1)
+        print "Config %s is OK" % args[0]
+        for reader in config.readers:
+            print "Reader %s: connstring %r, unlocker %s (%s)" % (reader.name, reader.connstring,
+                reader.unlockerSection, config.unlockerClasses[reader.unlockerSection].__name__)
+        sys.exit(0)
+
     fmt="%(asctime)s %(levelname)s %(message)s [%(pathname)s:%(lineno)d]"
 
     if config.logFile == "-":
@@ -519,19 +1190,83 @@ if __name__  == "__main__":
 
     logging.info("Starting brmdoor-libnfc")
 
-    ircMsgQueue = Queue.Queue()
-    ircThread = None
-    openSwitchThread = None
+    if config.useTrace:
+        tracer.setSize(config.traceRingSize)
+        tracer.enabled = True
+        TraceControl(config.traceDumpDir, config.traceSlowestTaps, config.traceProfileIntervalMs).install()
+
+    # components talk only through events, each sink consumes its own queue
+    eventBus = EventBus()
+    sinkThreads = []
+    eventQueues = []
 
     if config.useIRC:
-        ircThread = IrcThread(config, ircMsgQueue)
-        ircThread.setDaemon(True)
-        ircThread.start()
+        ircQueue = WakeupEventQueue("irc")
+        eventBus.subscribe(ircQueue, DoorUnlocked, CardDenied, SwitchChanged)
+        eventQueues.append(ircQueue)
+        sinkThreads.append(IrcThread(config, ircQueue))
+    if config.useOpenSwitch and config.useStatusUpload:
+        spaceApiQueue = EventQueue("spaceapi")
+        eventBus.subscribe(spaceApiQueue, SwitchChanged)
+        eventQueues.append(spaceApiQueue)
+        sinkThreads.append(SpaceAPIStatusThread(config, spaceApiQueue))
+    if config.useAudit:
+        auditQueue = EventQueue("audit", 1000)
+        eventBus.subscribe(auditQueue, DoorUnlocked, CardDenied, SwitchChanged)
+        eventQueues.append(auditQueue)
+        sinkThreads.append(AuditThread(config, auditQueue))
     if config.useOpenSwitch:
-        openSwitchThread = OpenSwitchThread(config, ircThread)
-        openSwitchThread.setDaemon(True)
-        openSwitchThread.start()
+        sinkThreads.append(OpenSwitchThread(config, eventBus))
+
+    for sinkThread in sinkThreads:
+        sinkThread.setDaemon(True)
+        sinkThread.start()
+
+    # modules with additional authenticators register them on import
+    for pluginModule in config.authPlugins:
+        logging.info("Loading auth plugin %s", pluginModule)
+        importlib.import_module(pluginModule)
+
+    # all readers share one auth index, denied-UID table and event bus
+    authIndex = AuthIndex(config.authDbFilename, checkOnLookup=(config.authDbWatchMode == "lookup"))
+    uidBackoff = UidBackoff(config.unknownUidTimeoutSecs, config.unknownUidBackoffFactor,
+                            config.unknownUidBackoffMaxSecs, config.unknownUidTableSize)
+    if config.authDbWatchMode != "lookup":
+        authReloader = AuthReloadThread(config, authIndex, uidBackoff)
+        authReloader.setDaemon(True)
+        authReloader.start()
+        signal.signal(signal.SIGHUP, lambda signum, frame: authReloader.requestReload())
+    unlockers = {}
+    scanners = []
+
+    for reader in config.readers:
+        if reader.unlockerSection not in unlockers:
+            unlockers[reader.unlockerSection] = createUnlocker(config, reader.unlockerSection)
+        nfcScanner = NFCScanner(config, reader, authIndex, uidBackoff, unlockers[reader.unlockerSection],
+                                eventBus)
+        nfcScanner.setDaemon(True)
+        nfcScanner.start()
+        scanners.append(nfcScanner)
+
+    if config.useMetrics:
+        metricsRegistry.registerCollector(partial(collectDaemonMetrics, authIndex, uidBackoff, unlockers,
+                                                  scanners, eventQueues, sinkThreads))
+        MetricsServer(config.metricsListenAddress, config.metricsPort).start()
 
-    nfcScanner = NFCScanner(config, ircMsgQueue, ircThread)
-    nfcScanner.run()
+    try:
+        # main thread only waits, so that it can receive KeyboardInterrupt
+        while any(scanner.isAlive() for scanner in scanners):
+            time.sleep(1)
+        logging.error("All reader threads ended, exiting")
+        exitCode = 1
+    except KeyboardInterrupt:
+        logging.info("Exiting on keyboard interrupt")
+        exitCode = 2
 
+    for scanner in scanners:
+        scanner.stop()
+    for scanner in scanners:
+        scanner.join(5)
+    for lockUnlocker in unlockers.values():
+        lockUnlocker.lock()
+    sys.exit(exitCode)
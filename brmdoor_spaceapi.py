@@ -0,0 +1,421 @@
+"""
+Publishing of SpaceAPI-formatted status (see https://spaceapi.io/) to
+places serving it over web.
+
+SpaceAPIPublisher renders status document from template and hands it to
+sinks - SFTP upload, local file, HTTP POST. Template is serialized once and
+only the state block is spliced in; it's re-read when the template file
+changes. Sink that already has identical document (by hash) is skipped.
+
+SFTPUploader keeps one SSH/SFTP session open between uploads, parses the
+private key only once and reconnects when the session breaks. Document is
+uploaded from memory. SpaceAPIStatusThread publishes status on switch
+changes, rapid toggles are coalesced so that only the newest state is sent.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+import Queue
+
+from brmdoor_metrics import registry as metricsRegistry
+
+from StringIO import StringIO
+
+# only needed by SFTP sink and slow to import on Raspberry Pi, imported by SFTPUploader on first use
+paramiko = None
+
+def importParamiko():
+    """
+    Import paramiko once, on first use.
+    @throws ImportError if paramiko is not installed
+    """
+    global paramiko
+    if paramiko is None:
+        import paramiko
+
+def loadPrivateKey(filename):
+    """
+    Load SSH private key of any type paramiko supports.
+
+    @throws paramiko.ssh_exception.SSHException if key can't be read
+    """
+    for pkeyClass in (paramiko.RSAKey, paramiko.DSSKey, paramiko.ECDSAKey, paramiko.Ed25519Key):
+        try:
+            pkey = pkeyClass.from_private_key_file(filename)
+            logging.debug("Loaded SSH key of type %s", pkeyClass)
+            return pkey
+        except paramiko.ssh_exception.SSHException:
+            pass
+
+    logging.error("Failed to load private SSH key %s", filename)
+    raise paramiko.ssh_exception.SSHException("Can't read private SSH key")
+
+UPLOAD_DURATION = metricsRegistry.histogram("brmdoor_spaceapi_upload_duration_seconds",
+    "Time to publish SpaceAPI status to sink, including failed attempts", ["sink"])
+UPLOADS = metricsRegistry.counter("brmdoor_spaceapi_uploads_total",
+    "SpaceAPI publish attempts by sink and result (ok, failed, unchanged)", ["sink", "result"])
+
+class SpaceAPITemplate(object):
+    """
+    SpaceAPI document template serialized once, with a hole for the state block.
+    """
+
+    # Placeholder of state in serialized template
+    statePlaceholder = "__brmdoor_state__"
+
+    def __init__(self, filename):
+        """
+        Loads template from given JSON file.
+
+        :raises IOError, ValueError if template can't be read or parsed
+        """
+        self.filename = filename
+        self.fileId = None
+        self.head = None
+        self.tail = None
+        self.load()
+
+    def fileIdentity(self):
+        """Returns tuple identifying current version of template file"""
+        st = os.stat(self.filename)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def load(self):
+        """Parse and serialize template, split around the state block"""
+        fileId = self.fileIdentity()
+        with open(self.filename) as f:
+            spaceApiJson = json.load(f)
+        spaceApiJson["state"] = self.statePlaceholder
+        serialized = json.dumps(spaceApiJson, indent=4, ensure_ascii=True, encoding='utf-8')
+        (self.head, self.tail) = serialized.split('"%s"' % self.statePlaceholder, 1)
+        self.fileId = fileId
+        logging.info("Loaded SpaceAPI template %s", self.filename)
+
+    def reloadIfChanged(self):
+        """
+        Reloads template if the file changed. Broken template is logged and
+        old one kept.
+
+        :returns True if template was reloaded
+        """
+        try:
+            if self.fileIdentity() == self.fileId:
+                return False
+            self.load()
+            return True
+        except (IOError, OSError, ValueError), e:
+            logging.error("Could not reload SpaceAPI template %s, keeping old one: %s", self.filename, e)
+            return False
+
+    def render(self, state):
+        """Returns JSON document with given state block"""
+        return self.head + json.dumps(state, sort_keys=True) + self.tail
+
+class LocalFileSink(object):
+    """
+    Writes document to local file, e.g. in web server's root. File is
+    replaced atomically, so web server never serves half-written document.
+    """
+
+    name = "file"
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.spaceApiLocalFile)
+
+    def upload(self, data):
+        """
+        :raises IOError, OSError if file can't be written
+        """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        (fd, tmpFilename) = tempfile.mkstemp(dir=dirname, prefix=".spaceapi")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.chmod(tmpFilename, 0644)
+            os.rename(tmpFilename, self.filename)
+        except:
+            os.unlink(tmpFilename)
+            raise
+
+    def close(self):
+        pass
+
+class HTTPPostSink(object):
+    """
+    POSTs document as application/json to given URL.
+    """
+
+    name = "http"
+
+    def __init__(self, url, timeoutSecs=10):
+        # urllib2 pulls in ssl and httplib, so it's imported only when this sink is used
+        import urllib2
+        self.urllib2 = urllib2
+        self.url = url
+        self.timeoutSecs = timeoutSecs
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.spaceApiHttpUrl)
+
+    def upload(self, data):
+        """
+        :raises urllib2.URLError if request fails or server doesn't answer 2xx
+        """
+        request = self.urllib2.Request(self.url, data, {"Content-Type": "application/json"})
+        response = self.urllib2.urlopen(request, timeout=self.timeoutSecs)
+        try:
+            response.read()
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+class SFTPUploader(object):
+    """
+    Uploads files via SFTP over persistent SSH session.
+    """
+
+    name = "sftp"
+
+    # Seconds between SSH keepalives, so that dead session is noticed and NAT keeps it
+    keepaliveSecs = 60
+
+    def __init__(self, host, port, username, keyFilename, destFile):
+        """
+        Create uploader, key is loaded now, but connection is made on first upload.
+
+        :param destFile - path relative to SFTP root, including the filename
+        :raises paramiko.ssh_exception.SSHException if key can't be read
+        """
+        try:
+            importParamiko()
+        except ImportError:
+            raise ImportError("paramiko is required for SFTP upload")
+        self.host = host
+        self.port = port
+        self.username = username
+        (self.destDir, self.destFilename) = os.path.split(destFile)
+        self.pkey = loadPrivateKey(keyFilename)
+        self.ssh = None
+        self.sftp = None
+
+        log_paramiko = logging.getLogger("paramiko")
+        if log_paramiko:
+            log_paramiko.setLevel(logging.WARNING)
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Create uploader from BrmdoorConfig open_switch settings"""
+        return cls(config.sftpHost, config.sftpPort, config.sftpUsername, config.sftpKey, config.sftpDestFile)
+
+    def connect(self):
+        """
+        Open SSH session and SFTP channel in destination directory.
+
+        :raises paramiko.ssh_exception.SSHException, socket.error when connection fails
+        """
+        self.close()
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.host, port=self.port, username=self.username, pkey=self.pkey, timeout=20)
+        ssh.get_transport().set_keepalive(self.keepaliveSecs)
+        self.ssh = ssh
+        self.sftp = ssh.open_sftp()
+        if self.destDir:
+            self.sftp.chdir(self.destDir)
+        logging.info("Connected SFTP session to %s:%d", self.host, self.port)
+
+    def healthy(self):
+        """Returns true iff session is open and SSH transport is alive"""
+        if self.ssh is None or self.sftp is None:
+            return False
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def put(self, data):
+        """Upload data over current session"""
+        self.sftp.putfo(StringIO(data), self.destFilename)
+
+    def upload(self, data):
+        """
+        Upload data to destination file. Broken session is reconnected and
+        upload retried once.
+
+        :raises paramiko.ssh_exception.SSHException, socket.error, IOError, EOFError
+            when upload fails (timeout, can't connect, host key mismatch, disk full...)
+        """
+        if not self.healthy():
+            self.connect()
+        try:
+            self.put(data)
+        except (paramiko.ssh_exception.SSHException, socket.error, EOFError), e:
+            # session died between uploads, e.g. server restarted
+            logging.warning("SFTP upload failed, reconnecting: %s", e)
+            self.connect()
+            self.put(data)
+
+    def close(self):
+        """Close SFTP channel and SSH session"""
+        if self.sftp:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+            self.sftp = None
+        if self.ssh:
+            self.ssh.close()
+            self.ssh = None
+
+# Sink classes by name used in spaceapi_sinks config option. Each has name,
+# classmethod fromConfig(config), upload(data) and close().
+sinkTypes = {
+    SFTPUploader.name: SFTPUploader,
+    LocalFileSink.name: LocalFileSink,
+    HTTPPostSink.name: HTTPPostSink,
+}
+
+SPACEAPI_SINKS = sorted(sinkTypes.keys())
+
+class SpaceAPIPublisher(object):
+    """
+    Renders SpaceAPI status and uploads it to all sinks that don't have it yet.
+    """
+
+    def __init__(self, template, sinks):
+        """
+        :param template - SpaceAPITemplate
+        :param sinks - list of sink objects
+        """
+        self.template = template
+        self.sinks = sinks
+        self.state = None
+        # sink name -> hash of document it has
+        self.uploadedHashes = {}
+
+    @classmethod
+    def fromConfig(cls, config):
+        """
+        Create publisher with template and sinks from open_switch settings.
+
+        :raises IOError, ValueError if template can't be loaded
+        """
+        return cls(SpaceAPITemplate(config.spaceApiTemplateFile),
+                   [sinkTypes[name].fromConfig(config) for name in config.spaceApiSinks])
+
+    def setOpen(self, isOpen):
+        """
+        Set status of the space. Time of last change is updated only if the
+        status really changed, so repeated status gives identical document.
+        """
+        if self.state is None or self.state["open"] != isOpen:
+            self.state = {"open": isOpen, "lastchange": int(time.time())}
+
+    def publish(self):
+        """
+        Upload current status to sinks whose document differs. Failed sinks
+        are logged and retried by next publish().
+
+        :returns True if all sinks have current document
+        """
+        if self.state is None:
+            return True
+        self.template.reloadIfChanged()
+        document = self.template.render(self.state)
+        documentHash = hashlib.sha256(document).hexdigest()
+
+        allDone = True
+        for sink in self.sinks:
+            if self.uploadedHashes.get(sink.name) == documentHash:
+                logging.debug("SpaceAPI %s sink already has current status", sink.name)
+                UPLOADS.labels(sink=sink.name, result="unchanged").inc()
+                continue
+            start = time.time()
+            try:
+                sink.upload(document)
+                self.uploadedHashes[sink.name] = documentHash
+                logging.info("SpaceAPI status uploaded to %s sink", sink.name)
+                UPLOADS.labels(sink=sink.name, result="ok").inc()
+            except Exception:
+                #we could use retrying with @retry decorator, but it's likely that it wouldn't help with
+                #current connection/upload/out of disk space or similar problem
+                logging.exception("Failed to upload spaceAPI status JSON to %s sink", sink.name)
+                UPLOADS.labels(sink=sink.name, result="failed").inc()
+                sink.close()
+                allDone = False
+            UPLOAD_DURATION.labels(sink=sink.name).observe(time.time() - start)
+        return allDone
+
+class SpaceAPIStatusThread(threading.Thread):
+    """
+    Publishes SpaceAPI status whenever OPEN/CLOSED switch changes. Failed
+    uploads and template changes are handled every retrySecs.
+    """
+
+    retrySecs = 60
+
+    def __init__(self, config, eventQueue):
+        """
+        Create thread publishing status.
+
+        :param config - BrmdoorConfig object
+        :param eventQueue: EventQueue with SwitchChanged events
+        """
+        self.config = config
+        self.eventQueue = eventQueue
+        self.publisher = None
+        threading.Thread.__init__(self, name="spaceapi")
+
+    def run(self):
+        event = None
+        while True:
+            try:
+                event = self.eventQueue.get(timeout=self.retrySecs)
+                # only the newest state matters if switch was flipped while we were uploading
+                while True:
+                    event = self.eventQueue.get_nowait()
+            except Queue.Empty:
+                pass
+
+            try:
+                if self.publisher is None:
+                    self.publisher = SpaceAPIPublisher.fromConfig(self.config)
+                if event is not None:
+                    logging.info("Going to publish spaceAPI status, opened: %s, status: %s",
+                                 event.isOpen, event.status)
+                    self.publisher.setOpen(event.isOpen)
+                    event = None
+                self.publisher.publish()
+            except Exception:
+                logging.exception("Failed to publish spaceAPI status JSON")
+
+# manual test - publishes status to sinks configured in open_switch section,
+# point them to a local sshd/web server to try it out
+if __name__ == "__main__":
+    from brmdoor_nfc_daemon import BrmdoorConfig
+
+    if len(sys.argv) < 3 or sys.argv[2] not in ("open", "closed"):
+        print >> sys.stderr, "Syntax: brmdoor_spaceapi.py brmdoor_nfc.config open|closed"
+        sys.exit(1)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    publisher = SpaceAPIPublisher.fromConfig(BrmdoorConfig(sys.argv[1]))
+    publisher.setOpen(sys.argv[2] == "open")
+    for i in xrange(2):
+        start = time.time()
+        publisher.publish()
+        print "Publish %d took %.3f s" % (i + 1, time.time() - start)
+    for sink in publisher.sinks:
+        sink.close()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python2
+
+"""
+Tracing of tap handling and sampling profiler.
+
+Reader thread begins a trace when a card is detected and stages of the
+tap (index lookup, APDU exchanges, Desfire NDEF read steps, Ed25519
+verification, unlock) record spans into it. Finished traces are kept in a
+ring buffer. When tracing is disabled, span() returns shared no-op object.
+
+Daemon with [trace] section enabled dumps the slowest recent taps on
+SIGUSR1 and starts/stops sampling profiler on SIGUSR2. Both are written as
+folded stacks that flamegraph.pl (https://github.com/brendangregg/FlameGraph)
+or speedscope read. Run this file as script to trigger the dumps:
+
+    brmdoor_trace.py taps -p PID -d /var/tmp/brmdoor > taps.folded
+    brmdoor_trace.py profile -p PID -d /var/tmp/brmdoor -s 30 > profile.folded
+"""
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import logging
+import threading
+import collections
+
+from optparse import OptionParser
+
+# Names of dump files written to dump directory
+TAPS_DUMP_FILE = "slowest_taps.folded"
+PROFILE_DUMP_FILE = "profile.folded"
+
+class TapTrace(object):
+    """Spans of one tap. Span is (path tuple, duration in ms)"""
+
+    def __init__(self, readerName, uid_hex):
+        self.readerName = readerName
+        self.uid_hex = uid_hex
+        self.timestamp = time.time()
+        self.stack = []
+        self.spans = []
+        self.totalMs = 0
+        self.result = None
+
+    def rootName(self):
+        """Name of root frame - one tap per root in flame graph"""
+        return "%s %s %s %s %.1fms" % (time.strftime("%H:%M:%S", time.localtime(self.timestamp)),
+                                       self.readerName, self.uid_hex, self.result, self.totalMs)
+
+    def folded(self):
+        """
+        Returns lines of folded stacks with self time of each stage in
+        microseconds. Repeated spans of the same stage (e.g. APDUs) are summed.
+        """
+        totals = collections.OrderedDict()
+        for (path, durationMs) in self.spans:
+            totals[path] = totals.get(path, 0) + durationMs
+        childTotals = {}
+        for (path, durationMs) in totals.items():
+            if path:
+                childTotals[path[:-1]] = childTotals.get(path[:-1], 0) + durationMs
+
+        lines = []
+        root = self.rootName().replace(";", ",")
+        for (path, durationMs) in totals.items():
+            selfUs = int(round((durationMs - childTotals.get(path, 0)) * 1000))
+            if selfUs > 0:
+                lines.append("%s %d" % (";".join((root,) + path), selfUs))
+        return lines
+
+class Span(object):
+    """Context manager timing a stage of current tap"""
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.trace.stack.append(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        durationMs = (time.time() - self.start) * 1000
+        self.trace.spans.append((tuple(self.trace.stack), durationMs))
+        self.trace.stack.pop()
+        return False
+
+class NoSpan(object):
+    """Span used when no tap is traced, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+NO_SPAN = NoSpan()
+
+class Tracer(object):
+    """
+    Keeps trace of tap handled by each thread and ring buffer of finished traces.
+    """
+
+    def __init__(self, size=256):
+        self.enabled = False
+        self.finished = collections.deque(maxlen=size)
+        self.local = threading.local()
+
+    def setSize(self, size):
+        """Change ring buffer size, keeping newest traces"""
+        self.finished = collections.deque(self.finished, maxlen=size)
+
+    def begin(self, readerName, uid_hex, scanMs=0):
+        """
+        Start tracing tap in current thread, does nothing if tracing is disabled.
+        @param scanMs: duration of probe that found the card, counted as first stage
+        """
+        if self.enabled:
+            trace = TapTrace(readerName, uid_hex)
+            trace.timestamp -= scanMs / 1000.0
+            if scanMs > 0:
+                trace.spans.append((("scan",), scanMs))
+            self.local.trace = trace
+
+    def end(self, result):
+        """Finish trace of current thread's tap and store it in ring buffer"""
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return
+        self.local.trace = None
+        trace.result = result
+        trace.totalMs = (time.time() - trace.timestamp) * 1000
+        trace.spans.append(((), trace.totalMs))
+        self.finished.append(trace)
+
+    def span(self, name):
+        """Returns context manager timing stage of current tap"""
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return NO_SPAN
+        return Span(trace, name)
+
+    def addSpan(self, name, durationMs):
+        """Record stage measured elsewhere (e.g. by the reader) as child of current stage"""
+        trace = getattr(self.local, "trace", None)
+        if trace is not None and durationMs > 0:
+            trace.spans.append((tuple(trace.stack) + (name,), durationMs))
+
+    def slowest(self, count):
+        """Returns count slowest traces from ring buffer"""
+        return sorted(list(self.finished), key=lambda trace: trace.totalMs, reverse=True)[:count]
+
+    def foldedSlowest(self, count):
+        """Returns folded stacks of count slowest recent taps as single string"""
+        lines = []
+        for trace in self.slowest(count):
+            lines.extend(trace.folded())
+        return "\n".join(lines) + "\n"
+
+# Tracer shared by all reader threads
+tracer = Tracer()
+
+def span(name):
+    """Shortcut for tracer.span()"""
+    return tracer.span(name)
+
+def addSpan(name, durationMs):
+    """Shortcut for tracer.addSpan()"""
+    tracer.addSpan(name, durationMs)
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples stacks of all other threads every interval and counts them as
+    folded stacks. Costs nothing when not running, while running the cost
+    is one walk of all thread stacks per interval.
+    """
+
+    def __init__(self, intervalMs):
+        self.intervalSecs = intervalMs / 1000.0
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.stopEvent = threading.Event()
+        threading.Thread.__init__(self, name="profiler")
+        self.setDaemon(True)
+
+    @staticmethod
+    def frameName(frame):
+        code = frame.f_code
+        return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+    def sample(self):
+        """Take one sample of all threads except profiler itself"""
+        threadNames = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for (ident, frame) in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frameName(frame))
+                frame = frame.f_back
+            stack.append(threadNames.get(ident, str(ident)))
+            self.counts[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        while not self.stopEvent.wait(self.intervalSecs):
+            self.sample()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+    def folded(self):
+        """Returns folded stacks with sample counts as single string"""
+        return "".join("%s %d\n" % (stack, count) for (stack, count) in sorted(self.counts.items()))
+
+def writeDump(dumpDir, filename, data):
+    """
+    Atomically replace dump file, so that CLI never reads half-written one.
+    Dumps contain card UIDs, so they are readable only by owner. Temporary
+    file has unpredictable name, so that nobody can plant symlink in its place.
+    """
+    path = os.path.join(dumpDir, filename)
+    (fd, tmpPath) = tempfile.mkstemp(prefix=filename + ".", dir=dumpDir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.rename(tmpPath, path)
+    except:
+        os.unlink(tmpPath)
+        raise
+    return path
+
+class TraceControl(object):
+    """
+    Signal handlers of the daemon - SIGUSR1 dumps slowest recent taps,
+    SIGUSR2 starts profiler or stops it and dumps its samples.
+    """
+
+    def __init__(self, dumpDir, slowestCount, profileIntervalMs):
+        self.dumpDir = dumpDir
+        self.slowestCount = slowestCount
+        self.profileIntervalMs = profileIntervalMs
+        self.profiler = None
+
+    def install(self):
+        """Create private dump directory if it doesn't exist and install signal handlers"""
+        if not os.path.isdir(self.dumpDir):
+            try:
+                os.makedirs(self.dumpDir, 0700)
+            except OSError, e:
+                logging.error("Could not create trace dump directory: %s", e)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.dumpTaps())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggleProfiler())
+
+    def dumpTaps(self):
+        try:
+            path = writeDump(self.dumpDir, TAPS_DUMP_FILE, tracer.foldedSlowest(self.slowestCount))
+            logging.info("Dumped %d slowest of %d recent taps to %s",
+                         min(self.slowestCount, len(tracer.finished)), len(tracer.finished), path)
+        except (IOError, OSError), e:
+            logging.error("Could not dump tap traces: %s", e)
+
+    def toggleProfiler(self):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(self.profileIntervalMs)
+            self.profiler.start()
+            logging.info("Sampling profiler started, interval %d ms", self.profileIntervalMs)
+            return
+
+        profiler = self.profiler
+        self.profiler = None
+        profiler.stop()
+        try:
+            path = writeDump(self.dumpDir, PROFILE_DUMP_FILE, profiler.folded())
+            logging.info("Sampling profiler stopped, %d samples dumped to %s", profiler.samples, path)
+        except (IOError, OSError), e:
+            logging.error("Could not dump profile: %s", e)
+
+def mtimeOrZero(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
+
+def signalAndWait(pid, signum, path, timeoutSecs):
+    """
+    Send signal to daemon and wait until it rewrites dump file.
+    @returns True if file was rewritten within timeout
+    """
+    before = mtimeOrZero(path)
+    os.kill(pid, signum)
+    deadline = time.time() + timeoutSecs
+    while time.time() < deadline:
+        if mtimeOrZero(path) != before:
+            return True
+        time.sleep(0.05)
+    return False
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog taps|profile -p PID -d DUMP_DIR [options]")
+    parser.add_option("-p", "--pid", action="store", type="int", dest="pid",
+        help="PID of brmdoor_nfc_daemon.py")
+    parser.add_option("-d", "--dump-dir", action="store", type="string", dest="dumpDir",
+        help="dump_dir from [trace] section of daemon's config")
+    parser.add_option("-s", "--seconds", action="store", type="float", dest="seconds", default=10,
+        help="How long to profile, default 10")
+    parser.add_option("-o", "--output", action="store", type="string", dest="output", default="-",
+        help="Output file, default - for stdout")
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 1 or args[0] not in ("taps", "profile") or opts.pid is None or opts.dumpDir is None:
+        parser.print_help()
+        sys.exit(1)
+
+    if args[0] == "taps":
+        path = os.path.join(opts.dumpDir, TAPS_DUMP_FILE)
+        ok = signalAndWait(opts.pid, signal.SIGUSR1, path, 5)
+    else:
+        path = os.path.join(opts.dumpDir, PROFILE_DUMP_FILE)
+        os.kill(opts.pid, signal.SIGUSR2)
+        print >> sys.stderr, "Profiling for %g s" % opts.seconds
+        time.sleep(opts.seconds)
+        ok = signalAndWait(opts.pid, signal.SIGUSR2, path, 5)
+
+    if not ok:
+        print >> sys.stderr, "Daemon didn't write %s, is tracing enabled in its config?" % path
+        sys.exit(1)
+
+    with open(path) as f:
+        data = f.read()
+    if opts.output == "-":
+        sys.stdout.write(data)
+    else:
+        with open(opts.output, "w") as f:
+            f.write(data)
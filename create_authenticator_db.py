@@ -3,41 +3,123 @@
 """
 Creates and empty sqlite database file for brmdoor_authenticator.UidAuthenticator.
 
-Give filename as first argument.
+Give filename as first argument. With --migrate option, existing database
+is upgraded in place to current schema version instead.
 """
 
 import sys
 import sqlite3
 
+from optparse import OptionParser
+
+# Version of schema created by createTables()
+SCHEMA_VERSION = 2
+
+# Tables holding authorized UIDs, one per authentication method
+AUTH_TABLES = ["authorized_uids", "authorized_hmac_keys", "authorized_desfires"]
+
+def createIndexes(cursor):
+    """Create UNIQUE indexes on uid_hex column of each auth table.
+    UIDs are stored as uppercase hex, so lookup is simple equality.
+    @:param cursor cursor to sqlite DB
+    """
+    for table in AUTH_TABLES:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_uid_hex ON %s(uid_hex)" % (table, table))
+
+def setSchemaVersion(cursor, version):
+    """Record schema version in schema_version table, creating it if necessary
+    @:param cursor cursor to sqlite DB
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER NOT NULL)")
+    cursor.execute("DELETE FROM schema_version")
+    cursor.execute("INSERT INTO schema_version(version) VALUES (?)", (version,))
+
+def getSchemaVersion(cursor):
+    """Return schema version of the DB. Databases created before
+    schema_version table existed are version 1.
+    @:param cursor cursor to sqlite DB
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'")
+    if cursor.fetchone() is None:
+        return 1
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    return cursor.fetchone()[0] or 1
+
 def createTables(cursor):
     """Create DB tables in an empty database
     @:param cursor cursor to sqlite DB
     """
     cursor.execute("""CREATE TABLE authorized_uids(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        uid_hex TEXT,
+        uid_hex TEXT NOT NULL,
         nick TEXT)
     """)
     cursor.execute("""CREATE TABLE authorized_hmac_keys(
                id INTEGER PRIMARY KEY AUTOINCREMENT,
-               uid_hex TEXT,
+               uid_hex TEXT NOT NULL,
                key_hex TEXT,
                nick TEXT)
     """)
     cursor.execute("""CREATE TABLE authorized_desfires(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        uid_hex TEXT,
+        uid_hex TEXT NOT NULL,
         nick TEXT)
     """)
+    createIndexes(cursor)
+    setSchemaVersion(cursor, SCHEMA_VERSION)
+
+def migrateTables(cursor):
+    """Upgrade tables of existing database to SCHEMA_VERSION. UIDs are
+    converted to uppercase hex, duplicate UIDs within a table are removed
+    (first inserted one is kept). Does nothing if DB is already current.
+    @:param cursor cursor to sqlite DB
+    @:returns schema version the DB had before migration
+    """
+    oldVersion = getSchemaVersion(cursor)
+    if oldVersion >= SCHEMA_VERSION:
+        return oldVersion
+
+    for table in AUTH_TABLES:
+        cursor.execute("UPDATE %s SET uid_hex=UPPER(TRIM(uid_hex))" % table)
+        cursor.execute("""SELECT uid_hex, nick FROM %s WHERE id NOT IN
+            (SELECT MIN(id) FROM %s GROUP BY uid_hex)""" % (table, table))
+        for (uid_hex, nick) in cursor.fetchall():
+            print >> sys.stderr, "Removing duplicate UID %s (nick %s) from %s" % (uid_hex, nick, table)
+        cursor.execute("DELETE FROM %s WHERE id NOT IN (SELECT MIN(id) FROM %s GROUP BY uid_hex)" % (table, table))
+
+    createIndexes(cursor)
+    setSchemaVersion(cursor, SCHEMA_VERSION)
+    return oldVersion
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    parser = OptionParser(usage="%prog [--migrate] filename.sqlite")
+    parser.add_option("-m", "--migrate", action="store_true", dest="migrate", default=False,
+        help="Upgrade existing database to current schema instead of creating new one")
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 1:
         print >> sys.stderr, "You must specify filename as arg1 where the DB is to be created"
-    
-    filename = sys.argv[1]
-    conn = sqlite3.connect(filename)
+        sys.exit(1)
+
+    filename = args[0]
+
+    # autocommit mode with explicit transaction, so that DDL is part of it
+    conn = sqlite3.connect(filename, isolation_level=None)
     cursor = conn.cursor()
-    createTables(cursor)
-    
-    conn.commit()
-    conn.close()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        if opts.migrate:
+            oldVersion = migrateTables(cursor)
+            if oldVersion >= SCHEMA_VERSION:
+                print "Database %s already has schema version %d" % (filename, oldVersion)
+            else:
+                print "Database %s migrated from schema version %d to %d" % (filename, oldVersion, SCHEMA_VERSION)
+        else:
+            createTables(cursor)
+        cursor.execute("COMMIT")
+    except sqlite3.Error, e:
+        cursor.execute("ROLLBACK")
+        print >> sys.stderr, "Failed to update database %s: %s" % (filename, e)
+        sys.exit(1)
+    finally:
+        conn.close()
@@ -0,0 +1,56 @@
+import sqlite3
+
+class EventSpool(object):
+    """
+    Bounded spool of events that could not be delivered yet, e.g. while IRC
+    is disconnected. Spool is sqlite file, so that events survive restart
+    of the daemon. When full, oldest events are dropped.
+    """
+
+    def __init__(self, filename, maxEvents):
+        """
+        @param filename: sqlite file, ":memory:" for spool that doesn't survive restart
+        @param maxEvents: maximum number of spooled events
+        @throws sqlite3.Error if the spool can't be opened
+        """
+        self.filename = filename
+        self.maxEvents = maxEvents
+        # count of events dropped because spool was full
+        self.dropped = 0
+        # spool is created in main thread and then used only by one sink thread
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS spool(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            type TEXT NOT NULL,
+            detail TEXT)
+        """)
+        self.cursor.execute("SELECT COUNT(*) FROM spool")
+        self.size = self.cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, eventType, detail=None):
+        """Spool event, dropping the oldest ones if spool is full"""
+        self.cursor.execute("INSERT INTO spool(ts, type, detail) VALUES (?, ?, ?)", (timestamp, eventType, detail))
+        self.size += 1
+        if self.size > self.maxEvents:
+            self.cursor.execute("DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)",
+                                (self.size - self.maxEvents,))
+            self.dropped += self.cursor.rowcount
+            self.size -= self.cursor.rowcount
+
+    def events(self):
+        """
+        Returns spooled events, oldest first.
+        @returns list of (id, ts, type, detail)
+        """
+        self.cursor.execute("SELECT id, ts, type, detail FROM spool ORDER BY id")
+        return self.cursor.fetchall()
+
+    def remove(self, lastId):
+        """Remove events up to and including given id, after they were delivered"""
+        self.cursor.execute("DELETE FROM spool WHERE id <= ?", (lastId,))
+        self.size -= self.cursor.rowcount
@@ -0,0 +1,175 @@
+/**
+ * Fake libnfc and libfreefare for testing nfc_smartcard extension without
+ * reader hardware, see "make test-fake-libnfc".
+ *
+ * Device is opened with connstring "fake:LATENCY_MS". Reader's field is
+ * always empty, each call that would talk to the reader blocks in C for
+ * LATENCY_MS, like a slow SPI/UART bus does. APDUs are answered with 90 00.
+ * Tests use it to check that wrapped calls release the GIL while blocked.
+ */
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/types.h>
+
+#include <nfc/nfc.h>
+#include <freefare.h>
+
+#define FAKE_CONNSTRING_PREFIX "fake:"
+
+struct nfc_context {
+    int openedDevices;
+};
+
+struct nfc_device {
+    nfc_context *context;
+    unsigned latencyMs;
+};
+
+/** Simulate bus transfer of the reader */
+static void blockOnBus(const nfc_device *pnd)
+{
+    usleep(pnd->latencyMs * 1000);
+}
+
+void nfc_init(nfc_context **context)
+{
+    *context = calloc(1, sizeof(nfc_context));
+}
+
+void nfc_exit(nfc_context *context)
+{
+    free(context);
+}
+
+nfc_device *nfc_open(nfc_context *context, const char *connstring)
+{
+    nfc_device *pnd;
+
+    if (connstring == NULL || strncmp(connstring, FAKE_CONNSTRING_PREFIX, strlen(FAKE_CONNSTRING_PREFIX)) != 0) {
+        return NULL;
+    }
+
+    pnd = calloc(1, sizeof(nfc_device));
+    if (pnd == NULL) {
+        return NULL;
+    }
+    pnd->context = context;
+    pnd->latencyMs = strtoul(connstring + strlen(FAKE_CONNSTRING_PREFIX), NULL, 10);
+    context->openedDevices++;
+    return pnd;
+}
+
+void nfc_close(nfc_device *pnd)
+{
+    pnd->context->openedDevices--;
+    free(pnd);
+}
+
+int nfc_initiator_init(nfc_device *pnd)
+{
+    return 0;
+}
+
+int nfc_initiator_list_passive_targets(nfc_device *pnd, const nfc_modulation nm, nfc_target ant[], const size_t szTargets)
+{
+    blockOnBus(pnd);
+    return 0;
+}
+
+int nfc_initiator_poll_target(nfc_device *pnd, const nfc_modulation *pnmTargetTypes, const size_t szTargetTypes,
+                              const uint8_t uiPollNr, const uint8_t uiPeriod, nfc_target *pnt)
+{
+    blockOnBus(pnd);
+    return 0;
+}
+
+int nfc_initiator_select_passive_target(nfc_device *pnd, const nfc_modulation nm, const uint8_t *pbtInitData,
+                                        const size_t szInitData, nfc_target *pnt)
+{
+    blockOnBus(pnd);
+    return 0;
+}
+
+int nfc_initiator_deselect_target(nfc_device *pnd)
+{
+    return 0;
+}
+
+int nfc_initiator_transceive_bytes(nfc_device *pnd, const uint8_t *pbtTx, const size_t szTx, uint8_t *pbtRx,
+                                   const size_t szRx, int timeout)
+{
+    blockOnBus(pnd);
+    if (szRx < 2) {
+        return NFC_EOVFLOW;
+    }
+    pbtRx[0] = 0x90;
+    pbtRx[1] = 0x00;
+    return 2;
+}
+
+/* libfreefare - there is never a tag, so these are only needed for linking */
+
+MifareTag *freefare_get_tags(nfc_device *device)
+{
+    blockOnBus(device);
+    return NULL;
+}
+
+void freefare_free_tags(MifareTag *tags)
+{
+}
+
+enum mifare_tag_type freefare_get_tag_type(MifareTag tag)
+{
+    return DESFIRE;
+}
+
+char *freefare_get_tag_uid(MifareTag tag)
+{
+    return NULL;
+}
+
+int mifare_desfire_connect(MifareTag tag)
+{
+    return -1;
+}
+
+int mifare_desfire_disconnect(MifareTag tag)
+{
+    return -1;
+}
+
+int mifare_desfire_get_version(MifareTag tag, struct mifare_desfire_version_info *version_info)
+{
+    return -1;
+}
+
+MifareDESFireKey mifare_desfire_des_key_new_with_version(uint8_t value[8])
+{
+    return NULL;
+}
+
+void mifare_desfire_key_free(MifareDESFireKey key)
+{
+}
+
+MifareDESFireAID mifare_desfire_aid_new(uint32_t aid)
+{
+    return NULL;
+}
+
+int mifare_desfire_select_application(MifareTag tag, MifareDESFireAID aid)
+{
+    return -1;
+}
+
+int mifare_desfire_authenticate(MifareTag tag, uint8_t key_no, MifareDESFireKey key)
+{
+    return -1;
+}
+
+ssize_t mifare_desfire_read_data(MifareTag tag, uint8_t file_no, off_t offset, size_t length, void *data)
+{
+    return -1;
+}
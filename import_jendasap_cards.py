@@ -1,63 +1,148 @@
 #!/usr/bin/env python2
 
+"""
+Imports cards file (lines "nick uid_hex") into UID or Desfire auth table.
+
+Table is made equal to the cards file, but only the difference is applied -
+cards missing from file are deleted, new ones inserted, all in a single
+transaction, so running daemon never sees half-imported or empty table.
+With --dry-run the difference is only printed. Database with old schema
+must be upgraded first with create_authenticator_db.py --migrate.
+"""
+
 import sys
 import os
 import os.path
 import sqlite3
 
-from brmdoor_adduser import addUidAuth, addNdefAuth
-from create_authenticator_db import createTables
+from create_authenticator_db import createTables, getSchemaVersion, SCHEMA_VERSION
 
 from optparse import OptionParser
 
+def parseCards(lines):
+    """
+    Lazily parse lines of cards file. Malformed lines, invalid hex UIDs and
+    duplicate UIDs are skipped with warning on stderr.
+
+    @param lines: iterable of lines, e.g. opened file
+    @returns generator of (uid_hex, nick) tuples, UID in uppercase as stored in DB
+    """
+    seenUids = set()
+    lineNo = 0
+    for line in lines:
+        lineNo += 1
+        line = line.rstrip()
+        if line == "":
+            continue
+        parts = line.split(" ")
+        if len(parts) != 2:
+            print >> sys.stderr, "Skipping line %d, expected two parts - nick, uid, got: %s" % (lineNo, repr(parts))
+            continue
+        (nick, uid_hex) = parts
+        uid_hex = uid_hex.upper()
+        try:
+            uid_hex.decode("hex")
+        except TypeError:
+            print >> sys.stderr, "Skipping line %d, UID %s is not proper hex" % (lineNo, parts[1])
+            continue
+        # table has UNIQUE index on uppercase UID
+        if uid_hex in seenUids:
+            print >> sys.stderr, "Skipping line %d, duplicate UID %s" % (lineNo, parts[1])
+            continue
+        seenUids.add(uid_hex)
+        yield (uid_hex, nick)
+
+def diffCards(cursor, table, cards):
+    """
+    Compare cards with content of the table.
+
+    @param cards: iterable of (uid_hex, nick)
+    @returns (toInsert, toDelete) - sets of (uid_hex, nick); card whose nick
+        changed is in both
+    """
+    cursor.execute("SELECT uid_hex, nick FROM %s" % table)
+    current = set(cursor.fetchall())
+    wanted = set(cards)
+    return (wanted - current, current - wanted)
+
+def applyDiff(cursor, table, toInsert, toDelete):
+    """
+    Delete and insert given cards. Deletes go first, so that card with
+    changed nick doesn't collide with its old row on UNIQUE index.
+    """
+    cursor.executemany("DELETE FROM %s WHERE uid_hex=? AND nick IS ?" % table, toDelete)
+    cursor.executemany("INSERT INTO %s (uid_hex, nick) VALUES (?, ?)" % table, toInsert)
+
+def printDiff(toInsert, toDelete):
+    """Print cards to be removed and added, sorted by nick"""
+    for (uid_hex, nick) in sorted(toDelete, key=lambda card: (card[1], card[0])):
+        print "- %s %s" % (nick, uid_hex)
+    for (uid_hex, nick) in sorted(toInsert, key=lambda card: (card[1], card[0])):
+        print "+ %s %s" % (nick, uid_hex)
+
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-d", "--desfire", dest="use_desfire",
                       help="import Desfire table", action="store_true", default=False)
+    parser.add_option("-n", "--dry-run", dest="dry_run",
+                      help="only show what would change, don't modify the DB", action="store_true", default=False)
 
     (options, args) = parser.parse_args()
 
     if len(args) < 2:
-        print "import_jendasap_cards.py [--desfire] <cards_from_sap.txt> <destination.sqlite>"
-        print "This will generate and COMPLETELY OVERWRITE the UID/Desfire table in destination.sqlite"
-        print "This is useful for initial import, but for individual cards use brmdoor_adduser.py"
+        print "import_jendasap_cards.py [--desfire] [--dry-run] <cards_from_sap.txt> <destination.sqlite>"
+        print "This will make the UID/Desfire table in destination.sqlite contain exactly the cards from the file"
+        print "This is useful for syncing with member database, but for individual cards use brmdoor_adduser.py"
         sys.exit(1)
 
     if options.use_desfire:
         destTable = "authorized_desfires"
-        importFunc = addNdefAuth
     else:
         destTable = "authorized_uids"
-        importFunc = addUidAuth
 
     destSqliteFname = args[1]
     srcCardsFname = args[0]
-    nickUidList = []
-    with file(srcCardsFname) as f:
-        lineNo = 0
-        for line in f:
-            lineNo += 1
-            line = line.rstrip()
-            if line == "":
-                continue
-            parts = line.rstrip().split(" ")
-            if len(parts) != 2:
-                print "Skipping line %d, expected two parts - nick, uid, got: %s" % (lineNo, repr(parts))
-                continue
-            nickUidList.append(parts)
-
-    dbExists =  os.path.isfile(destSqliteFname)
-    conn = sqlite3.connect(destSqliteFname)
+
+    dbExists = os.path.isfile(destSqliteFname)
+    if options.dry_run and not dbExists:
+        print >> sys.stderr, "Database %s does not exist, all cards would be imported" % destSqliteFname
+
+    # autocommit mode with explicit transaction, so that DDL is part of it
+    conn = sqlite3.connect(destSqliteFname if dbExists or not options.dry_run else ":memory:", isolation_level=None)
+    # nicks are compared and stored as UTF-8 bytes from the cards file
+    conn.text_factory = str
     cursor = conn.cursor()
-    if dbExists:
-        cursor.execute("DELETE FROM %s" % destTable)
-    else:
-        createTables(cursor)
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        if not dbExists:
+            createTables(cursor)
+        elif getSchemaVersion(cursor) < SCHEMA_VERSION:
+            cursor.execute("ROLLBACK")
+            print >> sys.stderr, "Database has old schema, upgrade it first with:"
+            print >> sys.stderr, "create_authenticator_db.py --migrate %s" % destSqliteFname
+            sys.exit(1)
 
-    for (nick, uid) in nickUidList:
-        importFunc(cursor, uid, nick)
+        with open(srcCardsFname) as f:
+            (toInsert, toDelete) = diffCards(cursor, destTable, parseCards(f))
 
-    conn.commit()
-    conn.close()
-    print "Converted %d nick-uid pairs into %s table" % (len(nickUidList), destTable)
+        if options.dry_run:
+            printDiff(toInsert, toDelete)
+            cursor.execute("ROLLBACK")
+        else:
+            applyDiff(cursor, destTable, toInsert, toDelete)
+            cursor.execute("COMMIT")
+    except (sqlite3.Error, IOError), e:
+        try:
+            cursor.execute("ROLLBACK")
+        except sqlite3.Error:
+            # BEGIN itself failed, e.g. database locked by another writer
+            pass
+        print >> sys.stderr, "Failed to import cards into %s: %s" % (destSqliteFname, e)
+        sys.exit(1)
+    finally:
+        conn.close()
 
+    if options.dry_run:
+        print "Would add %d and remove %d nick-uid pairs in %s table" % (len(toInsert), len(toDelete), destTable)
+    else:
+        print "Added %d and removed %d nick-uid pairs in %s table" % (len(toInsert), len(toDelete), destTable)
@@ -0,0 +1,80 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    Thread-safe dictionary with bounded number of items. When full, least
+    recently used item is evicted. Items can optionally expire after
+    ttlSecs since they were stored.
+    """
+
+    def __init__(self, maxSize, ttlSecs=0):
+        """
+        @param maxSize: maximum number of items kept
+        @param ttlSecs: how long item stays valid after put(), 0 means forever
+        """
+        self.maxSize = maxSize
+        self.ttlSecs = ttlSecs
+        # key -> (value, expiry time or None)
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns value for key and marks it as most recently used.
+        Returns default if key is not present or has expired.
+        """
+        with self.lock:
+            try:
+                (value, expiry) = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiry is not None and time.time() >= expiry:
+                self.misses += 1
+                return default
+            self.items[key] = (value, expiry)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores value for key as most recently used, evicting least recently
+        used item if cache is full.
+        """
+        expiry = time.time() + self.ttlSecs if self.ttlSecs > 0 else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, expiry)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key):
+        """Removes key if present"""
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        """Removes all items"""
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Returns dict with hits, misses, evictions and current size"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.items),
+            }
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
@@ -0,0 +1,57 @@
+"""
+Reader backends used by the daemon and authenticators.
+
+PN53x readers are driven by nfc_smartcard.NFCDevice implemented in C++,
+nfc_simulator.SimulatedReader replays scripted taps without any hardware.
+Use openReader() to get a reader for a connstring from config.
+
+Both have the same methods, all of them throw NFCError on failure:
+
+    scanUID()               binary UID of card in field, NFCError if there's none
+    pollUID()               like scanUID(), but reader waits for card (pollNr times pollPeriod)
+    waitForUID(timeoutMs)   like scanUID(), but wait up to timeoutMs milliseconds for a card
+    sendAPDU(apdu)          send binary command APDU to selected card, returns response APDU
+                            object with valid(), sw(), sw1(), sw2() and data() methods
+    readDesfireNDEF()       NDEF message of Desfire card in field
+    clearDesfireLayoutCache(), desfireLayoutCacheSize()
+                            forget cached Desfire layouts, number of cards with cached layout
+    open(), opened(), close(), unload()
+                            open device explicitly, whether it's opened, close it, free resources
+
+and attributes pollNr, pollPeriod, apduTimeout, minBackoffMs, maxBackoffMs,
+desfireLayoutCache, desfireLayoutCacheMax (tunables) and lastDetectLatencyMs,
+lastScanMs, desfireLayoutHits, desfireLayoutMisses, lastDesfireTiming,
+apduCount, lastApduMs (measurements), see nfc_smartcard.h.
+"""
+
+try:
+    from nfc_smartcard import NFCDevice, NFCError
+except ImportError:
+    # Extension not built (e.g. CI without libnfc) - only simulated readers work.
+    NFCDevice = None
+
+    class NFCError(Exception):
+        """Same interface as NFCError from nfc_smartcard extension"""
+
+        def what(self):
+            """Returns reason why this was thrown."""
+            return self.args[0] if self.args else ""
+
+# Connstrings starting with this prefix open simulated reader, rest is path to tap script
+SIMULATOR_PREFIX = "sim:"
+
+def openReader(connstring):
+    """
+    Open reader for given connstring. Connstrings starting with "sim:" open
+    SimulatedReader with tap script from the rest of connstring, others are
+    passed to libnfc (empty string for default device).
+
+    @throws NFCError if reader can't be opened
+    """
+    if connstring.startswith(SIMULATOR_PREFIX):
+        from nfc_simulator import SimulatedReader
+        return SimulatedReader.fromFile(connstring[len(SIMULATOR_PREFIX):])
+
+    if NFCDevice is None:
+        raise NFCError("nfc_smartcard extension is not built, only simulated readers are available")
+    return NFCDevice(connstring)
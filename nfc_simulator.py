@@ -0,0 +1,291 @@
+"""
+Simulated reader replaying scripted card taps, for running the daemon's
+hot path without PN53x hardware (load tests, benchmarks, CI).
+
+Script is a JSON file like:
+
+    {
+        "interval_ms": 1000,
+        "scan_latency_ms": 5,
+        "apdu_latency_ms": 20,
+        "ndef_latency_ms": 150,
+        "repeat": 1,
+        "taps": [
+            {"uid": "34795FAD"},
+            {"uid": "04372ED2A52E80", "hmac_key_hex": "8a2c9e2104f58e8f173af61e7f062389ea433922"},
+            {"uid": "04631982CC2280", "private_key_hex": "10ee85f987e7682d9acf24ab07ff0e302ee4cdd426f83a055d3a337a4f01314b"}
+        ]
+    }
+
+Taps are presented every interval_ms, each card stays in field for one
+scan. Card with hmac_key_hex answers Yubikey HMAC-SHA1 challenges once the
+applet was selected since the card was detected, card
+with ndef (NDEF message), signature_hex or private_key_hex (signature is
+computed when script is loaded) is a Desfire with signed UID. repeat is
+number of passes through the taps, 0 repeats forever.
+
+ndef_latency_ms is duration of full Desfire NDEF read (7 commands). With
+desfireLayoutCache enabled, repeated read of the same card takes 3 of 7
+parts of it, like NFCDevice skipping GetVersion and CC reads.
+"""
+
+import json
+import time
+import hmac
+import hashlib
+
+from collections import OrderedDict
+
+from nfc_reader import NFCError
+from brmdoor_authenticator import YUBIKEY_SELECT_APDU, YUBIKEY_HMAC_SLOT2_HEADER
+
+# Desfire commands of NDEF read without and with cached layout, see NFCDevice::readDesfireNDEF
+DESFIRE_FULL_READ_COMMANDS = 7
+DESFIRE_CACHED_READ_COMMANDS = 3
+
+class SimulatedCard(object):
+    """Card presented by SimulatedReader"""
+
+    def __init__(self, uid, hmacKey=None, ndef=None):
+        """
+        @param uid: binary UID
+        @param hmacKey: binary Yubikey HMAC-SHA1 key, None if card is not a Yubikey
+        @param ndef: NDEF message, None if card is not a Desfire with NDEF
+        """
+        self.uid = uid
+        self.hmacKey = hmacKey
+        self.ndef = ndef
+
+    @classmethod
+    def fromDict(cls, tap):
+        """Create card from tap description in script"""
+        uid = tap["uid"].decode("hex")
+        hmacKey = tap["hmac_key_hex"].decode("hex") if "hmac_key_hex" in tap else None
+        ndef = tap.get("ndef")
+        if ndef is None and "signature_hex" in tap:
+            ndef = json.dumps({"brmdoorSignature": tap["signature_hex"]})
+        if ndef is None and "private_key_hex" in tap:
+            from sign_uid import signUid
+            signature = signUid(tap["private_key_hex"].decode("hex"), uid)
+            ndef = json.dumps({"brmdoorSignature": signature.encode("hex")})
+        return cls(uid, hmacKey, ndef)
+
+class SimulatedResponseAPDU(object):
+    """Response APDU with the same interface as nfc_smartcard.ResponseAPDU"""
+
+    def __init__(self, data):
+        """Parse response APDU from raw data"""
+        self._valid = len(data) >= 2
+        self._sw = (ord(data[-2]) << 8) | ord(data[-1]) if self._valid else 0
+        self._data = data[:-2]
+
+    def sw(self):
+        return self._sw
+
+    def sw1(self):
+        return self._sw >> 8
+
+    def sw2(self):
+        return self._sw & 0xFF
+
+    def valid(self):
+        return self._valid
+
+    def data(self):
+        return self._data
+
+class SimulatedDesfireTiming(object):
+    """Step durations of NDEF read with the same attributes as nfc_smartcard.DesfireReadTiming"""
+
+    def __init__(self):
+        self.getTagsMs = 0
+        self.connectMs = 0
+        self.versionMs = 0
+        self.selectMs = 0
+        self.authMs = 0
+        self.ccReadMs = 0
+        self.ndefReadMs = 0
+        self.totalMs = 0
+        self.roundTrips = 0
+        self.cacheHit = False
+
+class SimulatedReader(object):
+    """
+    Reader presenting scripted cards at configured rate, with configured
+    latencies of field probing, APDU exchange and Desfire NDEF read.
+    """
+
+    def __init__(self, cards, intervalMs=1000, scanLatencyMs=0, apduLatencyMs=0, ndefLatencyMs=0, repeat=1):
+        """
+        @param cards: list of SimulatedCard presented in this order
+        @param intervalMs: time between taps
+        @param scanLatencyMs: duration of each field probe
+        @param apduLatencyMs: duration of each APDU exchange
+        @param ndefLatencyMs: duration of whole Desfire NDEF read
+        @param repeat: number of passes through cards, 0 means forever
+        """
+        self.cards = cards
+        self.intervalMs = intervalMs
+        self.scanLatencyMs = scanLatencyMs
+        self.apduLatencyMs = apduLatencyMs
+        self.ndefLatencyMs = ndefLatencyMs
+        self.repeat = repeat
+
+        # same tunables and measurements as NFCDevice has
+        self.pollNr = 20
+        self.pollPeriod = 2
+        self.apduTimeout = 500
+        self.minBackoffMs = 20
+        self.maxBackoffMs = 250
+        self.lastDetectLatencyMs = 0
+        self.lastScanMs = 0
+        self.desfireLayoutCache = False
+        self.desfireLayoutCacheMax = 64
+        self.desfireLayoutHits = 0
+        self.desfireLayoutMisses = 0
+        self.lastDesfireTiming = SimulatedDesfireTiming()
+        self.apduCount = 0
+        self.lastApduMs = 0
+
+        # UIDs of cards whose layout would be cached by NFCDevice, least recently used first
+        self.desfireLayouts = OrderedDict()
+        self.tapIndex = 0
+        self.nextTapTime = time.time()
+        self.currentCard = None
+        # whether Yubikey applet was selected since current card was detected
+        self.appletSelected = False
+        # time when current card entered field
+        self.lastTapTime = None
+        self._opened = True
+
+    @classmethod
+    def fromDict(cls, script):
+        """Create reader from parsed JSON script"""
+        cards = [SimulatedCard.fromDict(tap) for tap in script["taps"]]
+        return cls(cards,
+                   intervalMs=script.get("interval_ms", 1000),
+                   scanLatencyMs=script.get("scan_latency_ms", 0),
+                   apduLatencyMs=script.get("apdu_latency_ms", 0),
+                   ndefLatencyMs=script.get("ndef_latency_ms", 0),
+                   repeat=script.get("repeat", 1))
+
+    @classmethod
+    def fromFile(cls, filename):
+        """
+        Create reader from JSON script file.
+
+        @throws NFCError if script can't be read
+        """
+        try:
+            with open(filename) as f:
+                return cls.fromDict(json.load(f))
+        except (IOError, ValueError, KeyError, TypeError), e:
+            raise NFCError("Can't load simulated reader script %s: %s" % (filename, e))
+
+    def exhausted(self):
+        """Returns True when all scripted taps were presented"""
+        return self.repeat > 0 and self.tapIndex >= len(self.cards) * self.repeat
+
+    def checkOpened(self):
+        if not self._opened:
+            raise NFCError("NFC device not opened")
+
+    def simulateLatency(self, latencyMs):
+        if latencyMs > 0:
+            time.sleep(latencyMs / 1000.0)
+
+    def scanUID(self):
+        self.checkOpened()
+        self.simulateLatency(self.scanLatencyMs)
+
+        if self.exhausted() or time.time() < self.nextTapTime:
+            self.currentCard = None
+            raise NFCError("No card in reader's field")
+
+        self.currentCard = self.cards[self.tapIndex % len(self.cards)]
+        self.appletSelected = False
+        self.lastTapTime = self.nextTapTime
+        self.tapIndex += 1
+        self.nextTapTime += self.intervalMs / 1000.0
+        self.lastScanMs = self.scanLatencyMs
+        return self.currentCard.uid
+
+    def waitForUID(self, timeoutMs):
+        self.checkOpened()
+        deadline = time.time() + timeoutMs / 1000.0
+        if not self.exhausted():
+            time.sleep(max(0, min(self.nextTapTime, deadline) - time.time()))
+        uid = self.scanUID()
+        self.lastDetectLatencyMs = (time.time() - self.lastTapTime) * 1000
+        return uid
+
+    def pollUID(self):
+        return self.waitForUID(self.pollNr * self.pollPeriod * 150)
+
+    def sendAPDU(self, apdu):
+        self.checkOpened()
+        card = self.currentCard
+        if card is None or card.hmacKey is None:
+            raise NFCError("Failed to transceive APDU")
+
+        start = time.time()
+        self.simulateLatency(self.apduLatencyMs)
+        self.lastApduMs = (time.time() - start) * 1000
+        self.apduCount += 1
+        if apdu == YUBIKEY_SELECT_APDU:
+            self.appletSelected = True
+            return SimulatedResponseAPDU("\x90\x00")
+        if apdu[:4] == YUBIKEY_HMAC_SLOT2_HEADER and len(apdu) > 5 and self.appletSelected:
+            challenge = apdu[5:5 + ord(apdu[4])]
+            response = hmac.new(card.hmacKey, challenge, hashlib.sha1).digest()
+            return SimulatedResponseAPDU(response + "\x90\x00")
+        # INS not supported
+        return SimulatedResponseAPDU("\x6D\x00")
+
+    def readDesfireNDEF(self):
+        self.checkOpened()
+        card = self.currentCard
+        if card is None:
+            raise NFCError("No tags detected")
+        if card.ndef is None:
+            raise NFCError("Tag is not a Desfire tag")
+
+        timing = SimulatedDesfireTiming()
+        timing.cacheHit = self.desfireLayoutCache and card.uid in self.desfireLayouts
+        if timing.cacheHit:
+            self.desfireLayoutHits += 1
+            # mark as most recently used
+            self.desfireLayouts[card.uid] = self.desfireLayouts.pop(card.uid)
+            timing.roundTrips = DESFIRE_CACHED_READ_COMMANDS
+        else:
+            timing.roundTrips = DESFIRE_FULL_READ_COMMANDS
+            if self.desfireLayoutCache:
+                self.desfireLayoutMisses += 1
+                if self.desfireLayoutCacheMax > 0:
+                    # evict least recently used like NFCDevice
+                    while len(self.desfireLayouts) >= self.desfireLayoutCacheMax:
+                        self.desfireLayouts.popitem(last=False)
+                    self.desfireLayouts[card.uid] = True
+
+        timing.totalMs = self.ndefLatencyMs * timing.roundTrips / DESFIRE_FULL_READ_COMMANDS
+        self.simulateLatency(timing.totalMs)
+        self.lastDesfireTiming = timing
+        return card.ndef
+
+    def clearDesfireLayoutCache(self):
+        self.desfireLayouts.clear()
+
+    def desfireLayoutCacheSize(self):
+        return len(self.desfireLayouts)
+
+    def opened(self):
+        return self._opened
+
+    def open(self):
+        self._opened = True
+
+    def close(self):
+        self._opened = False
+
+    def unload(self):
+        self._opened = False
@@ -8,11 +8,17 @@
 #include <nfc/nfc-types.h>
 #include <freefare.h>
 #include <functional>
+#include <chrono>
+#include <algorithm>
+
+#include <unistd.h>
 
 #include "nfc_smartcard.h"
 
 using namespace std;
 
+typedef std::chrono::steady_clock Clock;
+
 ResponseAPDU::ResponseAPDU(const string &data)
 {
     size_t len = data.size();
@@ -26,10 +32,21 @@ ResponseAPDU::ResponseAPDU(const string &data)
     _data = data.substr(0, len-2);
 }
 
-NFCDevice::NFCDevice() throw(NFCError):
+NFCDevice::NFCDevice(const std::string& connstring) throw(NFCError):
     pollNr(20),
     pollPeriod(2),
     apduTimeout(500),
+    minBackoffMs(20),
+    maxBackoffMs(250),
+    lastDetectLatencyMs(0),
+    lastScanMs(0),
+    desfireLayoutCache(false),
+    desfireLayoutCacheMax(64),
+    desfireLayoutHits(0),
+    desfireLayoutMisses(0),
+    apduCount(0),
+    lastApduMs(0),
+    _connstring(connstring),
     _nfcContext(NULL),
     _nfcDevice(NULL),
     _opened(false),
@@ -55,10 +72,10 @@ void NFCDevice::open() throw(NFCError)
         return;
     }
 
-    _nfcDevice = nfc_open(_nfcContext, NULL);
+    _nfcDevice = nfc_open(_nfcContext, _connstring.empty() ? NULL : _connstring.c_str());
 
     if (_nfcDevice == NULL) {
-        throw NFCError("Unable to open NFC device.");
+        throw NFCError("Unable to open NFC device " + (_connstring.empty() ? string("(default)") : _connstring));
     }
 
     _opened = true;
@@ -109,7 +126,9 @@ std::string NFCDevice::scanUID() throw(NFCError)
      * but causes 100% CPU usage on SPI-connected PN532
      */
     //res = nfc_initiator_poll_target(_nfcDevice, _modulations, _modulationsLen, pollNr, pollPeriod, &nt);
+    Clock::time_point probeStart = Clock::now();
     res = nfc_initiator_list_passive_targets(_nfcDevice, _modulations[0], &nt, 1);
+    Clock::time_point probeEnd = Clock::now();
 
     if (res < 0) {
         throw NFCError("NFC list passive targets error");
@@ -117,6 +136,7 @@ std::string NFCDevice::scanUID() throw(NFCError)
         throw NFCError("No card in reader's field");
     }
 
+    lastScanMs = std::chrono::duration<double, std::milli>(probeEnd - probeStart).count();
     const nfc_iso14443a_info& nai = nt.nti.nai;
     uid = string((const char*)nai.abtUid, nai.szUidLen);
 
@@ -125,6 +145,71 @@ std::string NFCDevice::scanUID() throw(NFCError)
     return uid;
 }
 
+std::string NFCDevice::pollUID() throw(NFCError)
+{
+    int res;
+    nfc_target nt;
+
+    if (!opened()) {
+        throw NFCError("NFC device not opened");
+    }
+
+    Clock::time_point probeStart = Clock::now();
+    res = nfc_initiator_poll_target(_nfcDevice, _modulations, _modulationsLen, pollNr, pollPeriod, &nt);
+    Clock::time_point probeEnd = Clock::now();
+
+    if (res < 0) {
+        throw NFCError("NFC poll target error");
+    } else if (res == 0) {
+        throw NFCError("No card in reader's field");
+    }
+
+    // includes time reader waited for the card
+    lastScanMs = std::chrono::duration<double, std::milli>(probeEnd - probeStart).count();
+    const nfc_iso14443a_info& nai = nt.nti.nai;
+    return string((const char*)nai.abtUid, nai.szUidLen);
+}
+
+std::string NFCDevice::waitForUID(unsigned timeoutMs) throw(NFCError)
+{
+    int res;
+    nfc_target nt;
+
+    if (!opened()) {
+        throw NFCError("NFC device not opened");
+    }
+
+    const Clock::time_point deadline = Clock::now() + std::chrono::milliseconds(timeoutMs);
+    unsigned sleptMs = 0;
+    unsigned backoffMs = minBackoffMs;
+
+    while (true) {
+        Clock::time_point probeStart = Clock::now();
+        res = nfc_initiator_list_passive_targets(_nfcDevice, _modulations[0], &nt, 1);
+        Clock::time_point probeEnd = Clock::now();
+
+        if (res < 0) {
+            throw NFCError("NFC list passive targets error");
+        } else if (res > 0) {
+            lastScanMs = std::chrono::duration<double, std::milli>(probeEnd - probeStart).count();
+            lastDetectLatencyMs = sleptMs + lastScanMs;
+
+            const nfc_iso14443a_info& nai = nt.nti.nai;
+            return string((const char*)nai.abtUid, nai.szUidLen);
+        }
+
+        if (probeEnd >= deadline) {
+            throw NFCError("No card in reader's field");
+        }
+
+        // grow interval by half, at least by 1 ms, while field is empty, but never sleep past deadline
+        backoffMs = std::max(minBackoffMs, std::min(maxBackoffMs, std::max(backoffMs + 1, backoffMs * 3 / 2)));
+        unsigned remainingMs = std::chrono::duration_cast<std::chrono::milliseconds>(deadline - probeEnd).count();
+        sleptMs = std::min(backoffMs, remainingMs);
+        usleep(sleptMs * 1000);
+    }
+}
+
 void NFCDevice::selectPassiveTarget() throw(NFCError)
 {
     nfc_target nt;
@@ -136,8 +221,13 @@ ResponseAPDU NFCDevice::sendAPDU(const string &apdu) throw(NFCError)
     int res;
     uint8_t rapdu[512];
     
-    if ((res = nfc_initiator_transceive_bytes(_nfcDevice, (uint8_t*)apdu.data(), apdu.size(),  
-                                              rapdu, 512, apduTimeout)) < 0) {
+    Clock::time_point start = Clock::now();
+    res = nfc_initiator_transceive_bytes(_nfcDevice, (uint8_t*)apdu.data(), apdu.size(),
+                                         rapdu, 512, apduTimeout);
+    lastApduMs = std::chrono::duration<double, std::milli>(Clock::now() - start).count();
+    apduCount++;
+
+    if (res < 0) {
 	if (res == NFC_EOVFLOW) {
 	    throw NFCError("Response APDU too long");
 	}
@@ -155,79 +245,94 @@ ResponseAPDU NFCDevice::sendAPDU(const string &apdu) throw(NFCError)
     }
 }
 
-std::string NFCDevice::readDesfireNDEF() throw(NFCError)
+/** Milliseconds elapsed since start */
+static double msSince(const Clock::time_point& start)
+{
+    return std::chrono::duration<double, std::milli>(Clock::now() - start).count();
+}
+
+/**
+ * Select NDEF Tag Application of the layout and authenticate with its master key.
+ */
+static void selectNdefApplication(MifareTag tag, const DesfireLayout& layout, DesfireReadTiming& timing) throw(NFCError)
 {
     uint8_t key_data_app[8]  = { 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00 }; //auth key
     int res;
-    uint16_t  ndef_msg_len;
 
-    std::unique_ptr<MifareTag, std::function<void(MifareTag*)> > tags = {freefare_get_tags (_nfcDevice), freefare_free_tags};
-    if (!tags) {
-        throw NFCError("No tags detected");
-    }
-    // freefare_get_tags() returns a NULL-terminated list of MifareTag
-    if (!*tags) {
-        throw NFCError("Empty array tag, bailing out");
-    }
-    MifareTag& tag = *tags; //only first one is used
+    std::unique_ptr<mifare_desfire_key, std::function<void(MifareDESFireKey)> > key_app{mifare_desfire_des_key_new_with_version (key_data_app),
+                                                                                      mifare_desfire_key_free};
 
-    if (DESFIRE != freefare_get_tag_type (tag)) {
-        throw NFCError("Tag is not a Desfire tag");
-    }
+    // Mifare DESFire SelectApplication (Select application)
+    Clock::time_point start = Clock::now();
+    MifareDESFireAID aid = mifare_desfire_aid_new(layout.aid);
+    res = mifare_desfire_select_application(tag, aid);
+    free (aid);
+    timing.selectMs = msSince(start);
+    timing.roundTrips++;
+    if (res < 0)
+        throw NFCError("Application selection failed. NDEF message might not have been created yet.");
 
-    res = mifare_desfire_connect (tag);
-    if (res < 0) {
-        throw NFCError("Can't connect to Mifare DESFire target.");
-    }
+    // Authentication with NDEF Tag Application master key (Authentication with key 0)
+    start = Clock::now();
+    res = mifare_desfire_authenticate (tag, 0, key_app.get());
+    timing.authMs = msSince(start);
+    timing.roundTrips++;
+    if (res < 0)
+        throw NFCError("Authentication with NDEF Tag Application master key failed");
+}
+
+/**
+ * Find out layout of NDEF application from card version and CC file. NDEF
+ * application is selected and authenticated afterwards.
+ */
+static DesfireLayout readDesfireLayout(MifareTag tag, DesfireReadTiming& timing) throw(NFCError)
+{
+    DesfireLayout layout;
+    int res;
 
     // We've to track DESFire version as NDEF mapping is different
     struct mifare_desfire_version_info info;
+    Clock::time_point start = Clock::now();
     res = mifare_desfire_get_version (tag, &info);
+    timing.versionMs = msSince(start);
+    timing.roundTrips++;
     if (res < 0) {
         throw NFCError("Error getting Desfire version");
     }
 
-    std::unique_ptr<mifare_desfire_key, std::function<void(MifareDESFireKey)> > key_app{mifare_desfire_des_key_new_with_version (key_data_app),
-                                                                                      mifare_desfire_key_free};
-
-    // Mifare DESFire SelectApplication (Select application)
-    MifareDESFireAID aid;
-    if (info.software.version_major==0) {
-        aid = mifare_desfire_aid_new(0xEEEE10);
+    layout.versionMajor = info.software.version_major;
+    if (layout.versionMajor==0) {
+        layout.aid = 0xEEEE10;
     } else {
         // There is no more relationship between DESFire AID and ISO AID...
         // Let's assume it's in AID 000001h as proposed in the spec
-        aid = mifare_desfire_aid_new(0x000001);
+        layout.aid = 0x000001;
     }
 
-    res = mifare_desfire_select_application(tag, aid);
-    if (res < 0)
-        throw NFCError("Application selection failed. NDEF message might not have been created yet.");
-    free (aid);
-
-    // Authentication with NDEF Tag Application master key (Authentication with key 0)
-    res = mifare_desfire_authenticate (tag, 0, key_app.get());
-    if (res < 0)
-        throw NFCError("Authentication with NDEF Tag Application master key failed");
+    selectNdefApplication(tag, layout, timing);
 
     // Read Capability Container file E103
+    start = Clock::now();
     uint8_t lendata[20]; // cf FIXME in mifare_desfire.c read_data()
-    if (info.software.version_major==0)
+    if (layout.versionMajor==0)
         res = mifare_desfire_read_data (tag, 0x03, 0, 2, lendata);
     else
         // There is no more relationship between DESFire FID and ISO FileID...
         // Let's assume it's in FID 01h as proposed in the spec
         res = mifare_desfire_read_data (tag, 0x01, 0, 2, lendata);
+    timing.roundTrips++;
     if (res < 0)
         throw NFCError("Read CC len failed");
     uint16_t cclen = (((uint16_t) lendata[0]) << 8) + ((uint16_t) lendata[1]);
     if (cclen < 15)
         throw NFCError("CC too short IMHO");
     std::unique_ptr<uint8_t[]> cc_data{new uint8_t[cclen+20]};
-    if (info.software.version_major==0)
+    if (layout.versionMajor==0)
         res = mifare_desfire_read_data (tag, 0x03, 0, cclen, cc_data.get());
     else
         res = mifare_desfire_read_data (tag, 0x01, 0, cclen, cc_data.get());
+    timing.ccReadMs = msSince(start);
+    timing.roundTrips++;
     if (res < 0)
         throw NFCError("Read CC data failed");
     // Search NDEF File Control TLV
@@ -240,28 +345,161 @@ std::string NFCDevice::readDesfireNDEF() throw(NFCError)
         throw NFCError("CC does not contain expected NDEF File Control TLV");
     if (cc_data[off+2] != 0xE1)
         throw NFCError("Unknown NDEF File reference in CC");
-    uint8_t file_no;
-    if (info.software.version_major==0)
-        file_no = cc_data[off+3];
+    if (layout.versionMajor==0)
+        layout.fileNo = cc_data[off+3];
     else
         // There is no more relationship between DESFire FID and ISO FileID...
         // Let's assume it's in FID 02h as proposed in the spec
-        file_no = 2;
-    uint16_t ndefmaxlen = (((uint16_t) cc_data[off+4]) << 8) + ((uint16_t) cc_data[off+5]);
-    std::unique_ptr<uint8_t[]> ndef_msg{new uint8_t[ndefmaxlen+20]}; // cf FIXME in mifare_desfire.c read_data()
+        layout.fileNo = 2;
+    layout.ndefMaxLen = (((uint16_t) cc_data[off+4]) << 8) + ((uint16_t) cc_data[off+5]);
+    layout.lastMsgLen = 0;
 
-    res = mifare_desfire_read_data (tag, file_no, 0, 2, lendata);
+    return layout;
+}
+
+/**
+ * Read NDEF length and then NDEF message from selected NDEF application.
+ * Length of the message is stored in layout.
+ */
+static std::string readNdefFile(MifareTag tag, DesfireLayout& layout, DesfireReadTiming& timing) throw(NFCError)
+{
+    uint8_t lendata[20]; // cf FIXME in mifare_desfire.c read_data()
+    uint16_t ndef_msg_len;
+    int res;
+
+    std::unique_ptr<uint8_t[]> ndef_msg{new uint8_t[layout.ndefMaxLen+20]}; // cf FIXME in mifare_desfire.c read_data()
+
+    Clock::time_point start = Clock::now();
+    res = mifare_desfire_read_data (tag, layout.fileNo, 0, 2, lendata);
+    timing.roundTrips++;
     if (res < 0)
         throw NFCError("Read NDEF len failed");
     ndef_msg_len = (((uint16_t) lendata[0]) << 8) + ((uint16_t) lendata[1]);
-    if (ndef_msg_len + 2 > ndefmaxlen)
+    if (ndef_msg_len + 2 > layout.ndefMaxLen)
         throw NFCError("Declared NDEF size larger than max NDEF size");
-    res = mifare_desfire_read_data (tag, file_no, 2, ndef_msg_len, ndef_msg.get());
+    res = mifare_desfire_read_data (tag, layout.fileNo, 2, ndef_msg_len, ndef_msg.get());
+    timing.ndefReadMs = msSince(start);
+    timing.roundTrips++;
     if (res < 0)
         throw NFCError("Read data failed");
-    std::string result{(char*)ndef_msg.get(), ndef_msg_len};
+
+    layout.lastMsgLen = ndef_msg_len;
+    return std::string{(char*)ndef_msg.get(), ndef_msg_len};
+}
+
+/**
+ * Read NDEF length together with message of the length read last time by
+ * single command. Only if the message grew, rest of it is read by another one.
+ */
+static std::string readNdefFileCached(MifareTag tag, DesfireLayout& layout, DesfireReadTiming& timing) throw(NFCError)
+{
+    uint16_t ndef_msg_len;
+    int res;
+
+    size_t readLen = std::min<size_t>(layout.lastMsgLen + 2, layout.ndefMaxLen);
+    std::unique_ptr<uint8_t[]> ndef_file{new uint8_t[layout.ndefMaxLen+20]}; // cf FIXME in mifare_desfire.c read_data()
+
+    Clock::time_point start = Clock::now();
+    res = mifare_desfire_read_data (tag, layout.fileNo, 0, readLen, ndef_file.get());
+    timing.roundTrips++;
+    if (res < 2)
+        throw NFCError("Read NDEF len and data failed");
+    ndef_msg_len = (((uint16_t) ndef_file[0]) << 8) + ((uint16_t) ndef_file[1]);
+    if (ndef_msg_len + 2 > layout.ndefMaxLen)
+        throw NFCError("Declared NDEF size larger than max NDEF size");
+    if (ndef_msg_len + 2u > readLen) {
+        res = mifare_desfire_read_data (tag, layout.fileNo, readLen, ndef_msg_len + 2 - readLen, ndef_file.get() + readLen);
+        timing.roundTrips++;
+        if (res < 0)
+            throw NFCError("Read data failed");
+    }
+    timing.ndefReadMs = msSince(start);
+
+    layout.lastMsgLen = ndef_msg_len;
+    return std::string{(char*)ndef_file.get() + 2, ndef_msg_len};
+}
+
+std::string NFCDevice::readDesfireNDEF() throw(NFCError)
+{
+    Clock::time_point callStart = Clock::now();
+    int res;
+
+    lastDesfireTiming = DesfireReadTiming();
+    DesfireReadTiming& timing = lastDesfireTiming;
+
+    std::unique_ptr<MifareTag, std::function<void(MifareTag*)> > tags = {freefare_get_tags (_nfcDevice), freefare_free_tags};
+    timing.getTagsMs = msSince(callStart);
+    if (!tags) {
+        throw NFCError("No tags detected");
+    }
+    // freefare_get_tags() returns a NULL-terminated list of MifareTag
+    if (!*tags) {
+        throw NFCError("Empty array tag, bailing out");
+    }
+    MifareTag& tag = *tags; //only first one is used
+
+    if (DESFIRE != freefare_get_tag_type (tag)) {
+        throw NFCError("Tag is not a Desfire tag");
+    }
+
+    Clock::time_point start = Clock::now();
+    res = mifare_desfire_connect (tag);
+    timing.connectMs = msSince(start);
+    if (res < 0) {
+        throw NFCError("Can't connect to Mifare DESFire target.");
+    }
+
+    std::string uid;
+    std::map<std::string, std::list<std::pair<std::string, DesfireLayout> >::iterator>::iterator cached = _desfireLayouts.end();
+    if (desfireLayoutCache) {
+        std::unique_ptr<char, std::function<void(char*)> > uidHex{freefare_get_tag_uid (tag), free};
+        if (uidHex) {
+            uid = uidHex.get();
+            cached = _desfireLayouts.find(uid);
+        }
+    }
+
+    std::string result;
+    if (cached != _desfireLayouts.end()) {
+        DesfireLayout& layout = cached->second->second;
+        try {
+            selectNdefApplication(tag, layout, timing);
+            result = readNdefFileCached(tag, layout, timing);
+            timing.cacheHit = true;
+            desfireLayoutHits++;
+            // mark as most recently used
+            _desfireLayoutLru.splice(_desfireLayoutLru.begin(), _desfireLayoutLru, cached->second);
+        } catch (NFCError&) {
+            // Card was reformatted since its layout was cached, start over in new session
+            _desfireLayoutLru.erase(cached->second);
+            _desfireLayouts.erase(cached);
+            mifare_desfire_disconnect (tag);
+            if (mifare_desfire_connect (tag) < 0) {
+                throw NFCError("Can't connect to Mifare DESFire target.");
+            }
+        }
+    }
+
+    if (!timing.cacheHit) {
+        DesfireLayout layout = readDesfireLayout(tag, timing);
+        result = readNdefFile(tag, layout, timing);
+
+        if (desfireLayoutCache) {
+            desfireLayoutMisses++;
+            if (!uid.empty() && desfireLayoutCacheMax > 0) {
+                // evict least recently used
+                while (_desfireLayoutLru.size() >= desfireLayoutCacheMax) {
+                    _desfireLayouts.erase(_desfireLayoutLru.back().first);
+                    _desfireLayoutLru.pop_back();
+                }
+                _desfireLayoutLru.push_front(std::make_pair(uid, layout));
+                _desfireLayouts[uid] = _desfireLayoutLru.begin();
+            }
+        }
+    }
 
     mifare_desfire_disconnect (tag);
+    timing.totalMs = msSince(callStart);
     return result;
 }
 
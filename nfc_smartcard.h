@@ -1,6 +1,8 @@
 #pragma once
 
 #include <string>
+#include <map>
+#include <list>
 #include <inttypes.h>
 #include <stdexcept>
 
@@ -69,8 +71,73 @@ private:
 };
 
 /**
- * Represents one PN532 reader device. Config is taken from default
- * libnfc-specified location. That usually means first device found is used.
+ * Where NDEF message is stored on a Desfire card. Remembered per card UID,
+ * so that next read of the same card can skip version and CC file reads.
+ */
+struct DesfireLayout
+{
+    /** Major software version of the card, NDEF mapping differs for 0 */
+    uint8_t versionMajor;
+
+    /** Application ID of NDEF Tag Application */
+    uint32_t aid;
+
+    /** File number of NDEF file */
+    uint8_t fileNo;
+
+    /** Maximum NDEF file size from CC file, including 2-byte length */
+    uint16_t ndefMaxLen;
+
+    /** Length of NDEF message read last time, used to read length and data at once */
+    uint16_t lastMsgLen;
+};
+
+/**
+ * Durations of steps of last readDesfireNDEF() in milliseconds. Steps that
+ * were skipped thanks to layout cache are 0.
+ */
+struct DesfireReadTiming
+{
+    DesfireReadTiming():
+        getTagsMs(0), connectMs(0), versionMs(0), selectMs(0), authMs(0),
+        ccReadMs(0), ndefReadMs(0), totalMs(0), roundTrips(0), cacheHit(false)
+    {}
+
+    /** Tag enumeration by libfreefare */
+    double getTagsMs;
+
+    /** Connect to Desfire */
+    double connectMs;
+
+    /** GetVersion command */
+    double versionMs;
+
+    /** SelectApplication command */
+    double selectMs;
+
+    /** Authentication with NDEF application master key */
+    double authMs;
+
+    /** Both reads of CC file */
+    double ccReadMs;
+
+    /** NDEF length and data reads */
+    double ndefReadMs;
+
+    /** Whole readDesfireNDEF() call */
+    double totalMs;
+
+    /** Number of Desfire commands sent after connect */
+    unsigned roundTrips;
+
+    /** Whether cached layout was used successfully */
+    bool cacheHit;
+};
+
+/**
+ * Represents one PN532 reader device. Unless connstring is given, config is
+ * taken from default libnfc-specified location. That usually means first
+ * device found is used.
  *
  * Config resides in /etc/nfc/libnfc.conf if installed from packages or
  * /usr/local/etc/nfc/libnfc.conf if installed from source.
@@ -81,6 +148,13 @@ private:
  * device.connstring = "pn532_spi:/dev/spidev0.0"
  *
  * Refer to libnfc documentation for setting up devices.
+ *
+ * Threading: the Python binding releases the GIL for the whole duration of
+ * every method call, so blocking calls (scanUID(), pollUID(), waitForUID(),
+ * sendAPDU(), readDesfireNDEF(), open()) don't stop other Python threads.
+ * A single NFCDevice instance is not thread-safe - calls on one instance must
+ * not overlap, i.e. use each device from one thread only. Separate instances
+ * have separate libnfc contexts and can be used concurrently.
  */
 class NFCDevice
 {
@@ -91,9 +165,12 @@ public:
      * Initializes PN53x libnfc device and opens it, so you don't need to call
      * open() after constructor.
      *
+     * @param connstring libnfc connstring of device to open, e.g.
+     *        "pn532_spi:/dev/spidev0.0"; empty string opens the default
+     *        device from libnfc config
      * @throws NFCError if no device found or communication failed
      */
-    NFCDevice() throw(NFCError);
+    NFCDevice(const std::string& connstring = "") throw(NFCError);
     
     /** Destructor frees internal libnfc structures */
     virtual ~NFCDevice();
@@ -108,6 +185,30 @@ public:
      * @throws NFCError if no cards in reader's field
      */
     std::string scanUID() throw(NFCError);
+
+    /**
+     * Read UID of a card using nfc_initiator_poll_target, so the reader itself
+     * waits for card (pollNr times pollPeriod). Efficient for USB-connected
+     * PN532, but causes 100% CPU usage with SPI-connected PN532.
+     *
+     * @returns binary string containing UID
+     * @throws NFCError if no card appeared before polling ended
+     */
+    std::string pollUID() throw(NFCError);
+
+    /**
+     * Wait for card in field up to timeoutMs milliseconds, probing the field
+     * with adaptive backoff. Probing interval starts at minBackoffMs at the
+     * beginning of each wait and grows by half (at least by 1 ms) up to
+     * maxBackoffMs while field is empty, so reader responds quickly to
+     * consecutive taps, but wakes rarely when idle.
+     *
+     * Detection latency is stored in lastDetectLatencyMs.
+     *
+     * @returns binary string containing UID
+     * @throws NFCError if no card appeared in timeoutMs or communication failed
+     */
+    std::string waitForUID(unsigned timeoutMs) throw(NFCError);
     
     /**
      * Wait for one passive or emulated target and select it by reader.
@@ -127,14 +228,29 @@ public:
     /**
      * Read NDEF message from Desfire.
      *
+     * If desfireLayoutCache is enabled, layout of the card's NDEF application
+     * is remembered by UID and next read of the same card skips GetVersion and
+     * CC file reads and reads NDEF length and data with one command. If the
+     * cached read fails (card was reformatted, message grew), the layout is
+     * dropped and the full read is done. Step durations are in lastDesfireTiming.
+     *
      * @returns NDEF message or empty string if there wasn't message
      * @throws NFCError if there was problem communication with card or couldn't authenticate
      */
     std::string readDesfireNDEF() throw(NFCError);
 
+    /** Forget all cached Desfire layouts */
+    void clearDesfireLayoutCache() {_desfireLayouts.clear(); _desfireLayoutLru.clear();}
+
+    /** Returns number of cards with cached Desfire layout */
+    size_t desfireLayoutCacheSize() const {return _desfireLayouts.size();}
+
     /** Open device explicitly. May be useful after explicit close */
     void open() throw(NFCError);
 
+    /** Returns connstring this device was created with, empty for default device */
+    const std::string& connstring() const {return _connstring;}
+
     /** Returns true iff device was opened and not unloaded. */
     bool opened() const {return _opened && !_unloaded;}
 
@@ -164,14 +280,63 @@ public:
      */
     int apduTimeout;
 
+    /** Shortest interval between probes of field in waitForUID(), in milliseconds */
+    unsigned minBackoffMs;
+
+    /** Longest interval between probes of field in waitForUID(), in milliseconds */
+    unsigned maxBackoffMs;
+
+    /**
+     * Upper bound of time between card entering field and its UID being read
+     * by last successful waitForUID() - last probing interval plus duration
+     * of the successful probe. In milliseconds.
+     */
+    double lastDetectLatencyMs;
+
+    /**
+     * Duration of last successful field probe by scanUID(), pollUID() or
+     * waitForUID() in milliseconds. For pollUID() it includes waiting for the card.
+     */
+    double lastScanMs;
+
+    /** Whether readDesfireNDEF() caches layout of cards, off by default */
+    bool desfireLayoutCache;
+
+    /** Maximum number of cards whose layout is cached, least recently used is evicted when full */
+    unsigned desfireLayoutCacheMax;
+
+    /** Number of readDesfireNDEF() calls that used cached layout successfully */
+    unsigned desfireLayoutHits;
+
+    /** Number of readDesfireNDEF() calls with cache enabled that needed full read */
+    unsigned desfireLayoutMisses;
+
+    /** Step durations of last readDesfireNDEF() */
+    DesfireReadTiming lastDesfireTiming;
+
+    /** Number of APDUs sent by sendAPDU() */
+    unsigned apduCount;
+
+    /** Duration of last sendAPDU() exchange on reader bus in milliseconds */
+    double lastApduMs;
+
 protected:
 
+    /** Cached Desfire layouts as (UID in hex, layout), most recently used first */
+    std::list<std::pair<std::string, DesfireLayout> > _desfireLayoutLru;
+
+    /** Index of _desfireLayoutLru by UID in hex */
+    std::map<std::string, std::list<std::pair<std::string, DesfireLayout> >::iterator> _desfireLayouts;
+
     /** Modulations that specify cards accepted by reader */
     static const nfc_modulation _modulations[5];
 
     /** Number of modulations in _modulations array */
     static const size_t _modulationsLen;
 
+    /** libnfc connstring of the device, empty for default device */
+    std::string _connstring;
+
     /** libnfc-specific opaque context */
     nfc_context *_nfcContext;
 
@@ -1,4 +1,7 @@
-%module nfc_smartcard
+// threads="1" makes SWIG release the GIL around every wrapped call, so that
+// other Python threads (IRC, open switch) run while we wait on the reader bus.
+// The GIL is re-acquired before a C++ exception is translated to Python.
+%module(threads="1") nfc_smartcard
 
 %{
 #include "nfc_smartcard.h"
@@ -9,5 +12,3 @@
 %include stdint.i
 
 %include "nfc_smartcard.h"
-
-
@@ -0,0 +1,268 @@
+"""
+Watcher of OPEN/CLOSED switch status file that wakes up only when the
+status may have changed.
+
+Supported watch modes:
+
+    gpio - sysfs GPIO value file, waits for interrupt with poll(POLLPRI)
+           after setting the pin's edge file to "both"
+    inotify - regular file, waits for inotify event on its directory
+           (so that files replaced by rename are noticed too)
+    fifo - named pipe, each line written to it is new status
+    poll - reads the file periodically, works everywhere
+    auto - picks one of the above by the type of status file
+
+Mechanical switches bounce, so after each wakeup the watcher waits
+debounce time and only then reads the settled status.
+"""
+
+import os
+import sys
+import stat
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+WATCH_MODES = ["auto", "gpio", "inotify", "fifo", "poll"]
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+def loadInotify():
+    """
+    Returns libc with inotify functions.
+    @throws OSError if inotify is not available on this platform
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError(errno.ENOSYS, "inotify not available")
+    return libc
+
+class SwitchWatcher(object):
+    """
+    Reads status of the switch and blocks until it may have changed.
+    """
+
+    def __init__(self, statusFile, mode="auto", debounceMs=50, pollIntervalMs=1000):
+        """
+        @param statusFile: file with status value, e.g. /sys/class/gpio/gpio22/value
+        @param mode: one of WATCH_MODES
+        @param debounceMs: how long status has to settle after change is noticed
+        @param pollIntervalMs: read interval in poll mode
+        @throws ValueError for unknown mode
+        @throws IOError, OSError if status file can't be opened
+        """
+        if mode not in WATCH_MODES:
+            raise ValueError("Unknown watch mode %s, use one of %s" % (mode, ", ".join(WATCH_MODES)))
+        self.statusFile = statusFile
+        self.debounceSecs = debounceMs / 1000.0
+        self.pollIntervalSecs = pollIntervalMs / 1000.0
+        self.fd = None
+        self.inotifyFd = None
+        self.libc = None
+        self.poller = None
+        # last line read from FIFO, FIFO can't be re-read
+        self.fifoStatus = None
+        self.fifoBuffer = ""
+
+        if mode == "auto":
+            mode = self.detectMode()
+        self.mode = mode
+        try:
+            if mode == "gpio":
+                self.setupGpio()
+            elif mode == "inotify":
+                self.setupInotify()
+            elif mode == "fifo":
+                self.setupFifo()
+        except (IOError, OSError), e:
+            if mode in ("gpio", "inotify"):
+                logging.warning("Can't watch %s in %s mode, falling back to polling: %s", statusFile, mode, e)
+                self.close()
+                self.mode = "poll"
+            else:
+                raise
+        logging.info("Watching %s in %s mode", statusFile, self.mode)
+
+    def detectMode(self):
+        """Pick watch mode by type of status file"""
+        if stat.S_ISFIFO(os.stat(self.statusFile).st_mode):
+            return "fifo"
+        realPath = os.path.realpath(self.statusFile)
+        if realPath.startswith("/sys/"):
+            if os.path.exists(os.path.join(os.path.dirname(realPath), "edge")):
+                return "gpio"
+            return "poll"
+        return "inotify"
+
+    def setupGpio(self):
+        """Enable interrupts on both edges of the pin and poll value file for POLLPRI"""
+        edgeFile = os.path.join(os.path.dirname(os.path.realpath(self.statusFile)), "edge")
+        try:
+            with open(edgeFile, "w") as f:
+                f.write("both")
+        except IOError:
+            # may be set up already by whoever exported the pin
+            with open(edgeFile) as f:
+                edge = f.read().strip()
+            if edge != "both":
+                raise IOError(errno.EACCES, "Can't set %s to both, it's %s" % (edgeFile, edge))
+        self.fd = os.open(self.statusFile, os.O_RDONLY)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+
+    def setupInotify(self):
+        """Watch directory of status file, so that both rewrite and rename are noticed"""
+        self.libc = loadInotify()
+        self.inotifyFd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.inotifyFd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        dirname = os.path.dirname(os.path.abspath(self.statusFile))
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self.libc.inotify_add_watch(self.inotifyFd, dirname, mask) < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch on %s failed" % dirname)
+        self.poller = select.poll()
+        self.poller.register(self.inotifyFd, select.POLLIN)
+
+    def setupFifo(self):
+        """Open FIFO without blocking until writer appears"""
+        self.fd = os.open(self.statusFile, os.O_RDONLY | os.O_NONBLOCK)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def read(self):
+        """
+        Returns current status, stripped of whitespace. In FIFO mode it's the
+        last line written so far, None if nothing was written yet.
+        """
+        if self.mode == "gpio":
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            return os.read(self.fd, 64).strip()
+        elif self.mode == "fifo":
+            self.readFifo()
+            return self.fifoStatus
+        else:
+            with open(self.statusFile) as f:
+                return f.read().strip()
+
+    def readFifo(self):
+        """Read all lines available in FIFO, reopen it when writer closed it"""
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                # writer went away, poll would report POLLHUP forever
+                self.poller.unregister(self.fd)
+                os.close(self.fd)
+                self.setupFifo()
+                return
+            self.fifoBuffer += data
+            lines = self.fifoBuffer.split("\n")
+            self.fifoBuffer = lines.pop()
+            for line in lines:
+                if line.strip():
+                    self.fifoStatus = line.strip()
+
+    def waitForEvent(self, timeoutSecs):
+        """
+        Block until the file may have changed or timeout passes.
+        @param timeoutSecs: None to wait forever
+        @returns True if there was an event
+        """
+        if self.mode == "poll":
+            time.sleep(self.pollIntervalSecs if timeoutSecs is None else min(timeoutSecs, self.pollIntervalSecs))
+            return True
+
+        timeoutMs = None if timeoutSecs is None else int(timeoutSecs * 1000)
+        events = self.poller.poll(timeoutMs)
+        if not events:
+            return False
+        if self.mode == "gpio":
+            # POLLPRI stays pending until the value is read again, poll would return immediately
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.read(self.fd, 64)
+        elif self.mode == "inotify":
+            return self.readInotifyEvents()
+        return True
+
+    def readInotifyEvents(self):
+        """
+        Consume queued inotify events.
+        @returns True if some event concerned the status file
+        """
+        targetName = os.path.basename(self.statusFile)
+        relevant = False
+        while True:
+            try:
+                buf = os.read(self.inotifyFd, 4096)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return relevant
+                raise
+            offset = 0
+            while offset + IN_EVENT_HEADER.size <= len(buf):
+                (wd, mask, cookie, nameLen) = IN_EVENT_HEADER.unpack_from(buf, offset)
+                offset += IN_EVENT_HEADER.size
+                name = buf[offset:offset + nameLen].rstrip("\0")
+                offset += nameLen
+                if name == targetName:
+                    relevant = True
+
+    def wait(self):
+        """
+        Block until the status may have changed and settled. Bounces within
+        debounce time after first event are swallowed.
+        """
+        while not self.waitForEvent(None):
+            pass
+        if self.mode == "poll" or self.debounceSecs <= 0:
+            return
+        deadline = time.time() + self.debounceSecs
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self.mode == "fifo":
+                # keep lines arriving during debounce, so that last one wins
+                self.readFifo()
+            self.waitForEvent(remaining)
+
+    def close(self):
+        """Release file descriptors"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.inotifyFd is not None:
+            os.close(self.inotifyFd)
+            self.inotifyFd = None
+        self.poller = None
+
+# manual test - prints status whenever it changes
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print >> sys.stderr, "Syntax: open_switch.py status_file [%s]" % "|".join(WATCH_MODES)
+        sys.exit(1)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    watcher = SwitchWatcher(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "auto")
+    lastStatus = None
+    while True:
+        status = watcher.read()
+        if status != lastStatus:
+            print "%.3f %s" % (time.time(), status)
+            sys.stdout.flush()
+            lastStatus = status
+        watcher.wait()
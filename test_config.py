@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+
+"""
+Tests of config validation in BrmdoorConfig. Run with:
+
+    python -m unittest test_config
+"""
+
+import os
+import shutil
+import ConfigParser
+import tempfile
+import unittest
+
+from brmdoor_nfc_daemon import BrmdoorConfig, BrmdoorConfigError
+
+CONFIG_TEMPLATE = """
+[brmdoor]
+auth_db_filename = %(db)s
+desfire_ed25519_pubkey = 00
+log_file = -
+unlocker = Unlocker
+%(extra)s
+
+[Unlocker]
+
+[irc]
+enabled = False
+%(irc)s
+
+[open_switch]
+enabled = False
+spaceapi_status_upload = False
+"""
+
+class BrmdoorConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def loadConfig(self, extra="", irc="", sections=""):
+        """
+        Write config with extra lines in [brmdoor] and [irc] sections and
+        extra sections at the end, then parse it
+        """
+        configFname = os.path.join(self.tmpDir, "brmdoor.config")
+        with open(configFname, "w") as f:
+            f.write(CONFIG_TEMPLATE % {"db": os.path.join(self.tmpDir, "auth.sqlite"), "extra": extra, "irc": irc})
+            f.write(sections)
+        return BrmdoorConfig(configFname)
+
+    def testDefaults(self):
+        config = self.loadConfig()
+        self.assertEqual(config.desfireCacheSize, 256)
+        self.assertEqual(config.desfireLayoutCacheSize, 64)
+
+    def testZeroDisablesDesfireCaches(self):
+        config = self.loadConfig("desfire_cache_size = 0\ndesfire_layout_cache_size = 0")
+        self.assertEqual(config.desfireCacheSize, 0)
+        self.assertEqual(config.desfireLayoutCacheSize, 0)
+
+    def testNegativeCacheSizeRejected(self):
+        self.assertRaises(BrmdoorConfigError, self.loadConfig, "desfire_cache_size = -1")
+        self.assertRaises(BrmdoorConfigError, self.loadConfig, "desfire_layout_cache_size = -1")
+
+    def testZeroDetectTimeoutRejected(self):
+        self.assertRaises(BrmdoorConfigError, self.loadConfig, "detect_timeout_ms = 0")
+
+    def testNonIntegerRejected(self):
+        self.assertRaises(BrmdoorConfigError, self.loadConfig, "lock_opened_secs = abc")
+
+    def testDefaultsDontLeakIntoOtherSections(self):
+        # metrics port has default, IRC port doesn't
+        irc = "enabled = True\nserver = irc.example.com\nnick = bot\nchannels = #test\ntls = False\nreconnect_delay = 60"
+        self.assertRaises(ConfigParser.NoOptionError, self.loadConfig, irc=irc)
+        config = self.loadConfig(irc=irc + "\nport = 6667")
+        self.assertEqual(config.ircPort, 6667)
+
+    def testIrcSpoolNextToAuthDb(self):
+        irc = "enabled = True\nserver = irc.example.com\nport = 6667\nnick = bot\nchannels = #test\ntls = False\nreconnect_delay = 60"
+        config = self.loadConfig(irc=irc)
+        self.assertEqual(config.ircSpoolFilename, os.path.join(self.tmpDir, "irc_spool.sqlite"))
+        config = self.loadConfig(irc=irc + "\nspool_filename = :memory:")
+        self.assertEqual(config.ircSpoolFilename, ":memory:")
+
+    def testReaderNamedLikeOption(self):
+        config = self.loadConfig(sections="\n[readers]\nport = pn532_uart:/dev/ttyS0\nenabled = pn532_uart:/dev/ttyS1\n")
+        self.assertEqual(sorted(reader.name for reader in config.readers), ["enabled", "port"])
+
+    def testUnlockerOptionsValidated(self):
+        readers = "\n[readers]\ndoor = pn532_uart:/dev/ttyS0 | UnlockerWiringPi\n"
+        self.assertRaises(BrmdoorConfigError, self.loadConfig,
+                          sections=readers + "\n[UnlockerWiringPi]\nlock_pin = abc\n")
+        self.assertRaises(ConfigParser.NoOptionError, self.loadConfig,
+                          sections=readers + "\n[UnlockerWiringPi]\n")
+        config = self.loadConfig(sections=readers + "\n[UnlockerWiringPi]\nlock_pin = 17\n")
+        self.assertEqual(config.unlockerOptions["UnlockerWiringPi"], {"lockPin": 17})
+
+    def testReadOnly(self):
+        config = self.loadConfig()
+        self.assertRaises(AttributeError, setattr, config, "lockOpenedSecs", 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+
+"""
+Stress test showing that other threads (IRC, switch watcher, ...) keep
+running while a reader thread is blocked in slow card communication.
+Runs against SimulatedReader with injected latency; set BRMDOOR_TEST_READER
+to libnfc connstring (or "default") to also run it against real NFCDevice,
+whose calls must release the GIL. Run with:
+
+    python -m unittest test_reader_threads
+
+Without reader hardware, NFCDevice tests run against extension linked with
+fake_libnfc.c, whose calls block in C like a slow reader bus:
+
+    make test-fake-libnfc
+"""
+
+import os
+import time
+import threading
+import unittest
+
+from nfc_reader import NFCError, openReader, NFCDevice
+from nfc_simulator import SimulatedReader
+
+# Injected duration of each blocking reader call
+BLOCK_MS = 300
+
+# BRMDOOR_TEST_READER value selecting reader of fake_libnfc.c
+FAKE_READER = "fake"
+
+class BusyThread(threading.Thread):
+    """
+    Pure Python loop standing in for IRC thread. It needs the GIL for every
+    iteration, so it only progresses if the blocked reader call released it.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.iterations = 0
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            sum(xrange(100))
+            self.iterations += 1
+
+class ReaderThreadsTest(unittest.TestCase):
+
+    def progressDuring(self, blockingCall):
+        """
+        Run blockingCall in reader thread while BusyThread runs.
+        @returns (iterations of busy thread during the call, duration of the call in s)
+        """
+        busy = BusyThread()
+        busy.start()
+        try:
+            # let busy thread get going
+            time.sleep(0.05)
+            result = {}
+
+            def readerMain():
+                start = time.time()
+                before = busy.iterations
+                try:
+                    blockingCall()
+                except NFCError:
+                    pass
+                result["iterations"] = busy.iterations - before
+                result["duration"] = time.time() - start
+
+            reader = threading.Thread(target=readerMain)
+            reader.start()
+            reader.join(10)
+            self.assertFalse(reader.isAlive(), "Reader call didn't finish")
+            return (result["iterations"], result["duration"])
+        finally:
+            busy.stopEvent.set()
+            busy.join()
+
+    def assertProgress(self, blockingCall, minDuration):
+        (iterations, duration) = self.progressDuring(blockingCall)
+        self.assertGreaterEqual(duration, minDuration)
+        # busy thread makes ~100k iterations per second on Raspberry Pi, require a small fraction of it
+        self.assertGreater(iterations, 100 * duration)
+
+    def simulatedReader(self):
+        return SimulatedReader.fromDict({
+            "interval_ms": 0,
+            "scan_latency_ms": BLOCK_MS,
+            "ndef_latency_ms": BLOCK_MS,
+            "repeat": 0,
+            "taps": [{"uid": "04631982CC2280", "ndef": "{}"}],
+        })
+
+    def testSimulatedScanUID(self):
+        nfc = self.simulatedReader()
+        self.assertProgress(nfc.scanUID, BLOCK_MS / 1000.0 * 0.9)
+
+    def testSimulatedReadDesfireNDEF(self):
+        nfc = self.simulatedReader()
+        nfc.scanUID()
+        self.assertProgress(nfc.readDesfireNDEF, BLOCK_MS / 1000.0 * 0.9)
+
+    def nfcDevice(self):
+        """Open NFCDevice given by BRMDOOR_TEST_READER"""
+        connstring = os.environ["BRMDOOR_TEST_READER"]
+        if connstring == "default":
+            connstring = ""
+        elif connstring == FAKE_READER:
+            connstring = "fake:%d" % BLOCK_MS
+        nfc = openReader(connstring)
+        nfc.open()
+        return nfc
+
+    @unittest.skipUnless(NFCDevice is not None and os.environ.get("BRMDOOR_TEST_READER"),
+                         "needs nfc_smartcard extension and BRMDOOR_TEST_READER connstring")
+    def testNFCDeviceWaitForUID(self):
+        nfc = self.nfcDevice()
+        try:
+            # with empty field the call blocks for whole timeout inside libnfc
+            self.assertProgress(lambda: nfc.waitForUID(1000), 0.9)
+        finally:
+            nfc.close()
+            nfc.unload()
+
+    @unittest.skipUnless(NFCDevice is not None and os.environ.get("BRMDOOR_TEST_READER") == FAKE_READER,
+                         "needs nfc_smartcard extension linked with fake_libnfc.c, real card answers too fast")
+    def testNFCDeviceSendAPDU(self):
+        nfc = self.nfcDevice()
+        try:
+            self.assertProgress(lambda: nfc.sendAPDU("\x00\xa4\x04\x00\x00"), BLOCK_MS / 1000.0 * 0.9)
+        finally:
+            nfc.close()
+            nfc.unload()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+
+"""
+Timing tests of Unlocker with fake GPIO. Run with:
+
+    python -m unittest test_unlocker
+"""
+
+import time
+import threading
+import unittest
+
+from unlocker import Unlocker
+
+class FakeConfig(object):
+    """Just the part of BrmdoorConfig that Unlocker uses"""
+
+    def __init__(self, lockOpenedSecs):
+        self.lockOpenedSecs = lockOpenedSecs
+        self.unlockerOptions = {"RecordingUnlocker": {}}
+
+class RecordingUnlocker(Unlocker):
+    """Unlocker recording each drive of fake GPIO pin as (time, unlocked)"""
+
+    def __init__(self, config):
+        Unlocker.__init__(self, config)
+        self.drives = []
+        self.relocked = threading.Event()
+
+    def driveLock(self, unlocked):
+        self.drives.append((time.time(), unlocked))
+        if not unlocked:
+            self.relocked.set()
+
+class UnlockerTimingTest(unittest.TestCase):
+
+    lockOpenedSecs = 0.2
+
+    def setUp(self):
+        self.unlocker = RecordingUnlocker(FakeConfig(self.lockOpenedSecs))
+
+    def tearDown(self):
+        self.unlocker.lock()
+
+    def testUnlockReturnsImmediately(self):
+        start = time.time()
+        self.assertTrue(self.unlocker.unlock())
+        self.assertLess(time.time() - start, self.lockOpenedSecs / 2)
+        self.assertTrue(self.unlocker.isUnlocked())
+        self.assertEqual([unlocked for (_, unlocked) in self.unlocker.drives], [True])
+
+    def testRelockAfterConfiguredTime(self):
+        self.unlocker.unlock()
+        self.assertTrue(self.unlocker.relocked.wait(self.lockOpenedSecs * 5))
+        ((unlockTime, _), (relockTime, unlocked)) = self.unlocker.drives
+        self.assertFalse(unlocked)
+        self.assertGreaterEqual(relockTime - unlockTime, self.lockOpenedSecs * 0.9)
+        self.assertLess(relockTime - unlockTime, self.lockOpenedSecs * 3)
+        self.assertFalse(self.unlocker.isUnlocked())
+
+    def testRetapExtendsOpenWindow(self):
+        self.unlocker.unlock()
+        time.sleep(self.lockOpenedSecs / 2)
+        retapTime = time.time()
+        # lock is already open, only the window is extended
+        self.assertFalse(self.unlocker.unlock())
+        self.assertTrue(self.unlocker.relocked.wait(self.lockOpenedSecs * 5))
+        # wait past the first timer's deadline too, so that a stale relock would show up
+        time.sleep(self.lockOpenedSecs)
+
+        self.assertEqual([unlocked for (_, unlocked) in self.unlocker.drives], [True, False])
+        relockTime = self.unlocker.drives[1][0]
+        self.assertGreaterEqual(relockTime - retapTime, self.lockOpenedSecs * 0.9)
+
+    def testLockOnShutdown(self):
+        self.unlocker.unlock()
+        self.unlocker.lock()
+        self.assertFalse(self.unlocker.isUnlocked())
+        self.assertEqual([unlocked for (_, unlocked) in self.unlocker.drives], [True, False])
+        # cancelled relock timer must not drive the pin again
+        time.sleep(self.lockOpenedSecs * 1.5)
+        self.assertEqual(len(self.unlocker.drives), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import time
+import threading
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing bursts of up to burst actions, refilled at rate
+    actions per second.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        @param rate: tokens added per second
+        @param burst: maximum number of tokens, bucket starts full
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.lastRefill = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """Add tokens for time since last refill. Called with lock held."""
+        self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+
+    def consume(self):
+        """
+        Take one token if available.
+        @returns True if action may proceed
+        """
+        with self.lock:
+            self.refill(time.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def waitTime(self):
+        """Returns seconds until next token is available, 0 if there is one now"""
+        with self.lock:
+            self.refill(time.time())
+            if self.tokens >= 1 or self.rate <= 0:
+                return 0
+            return (1 - self.tokens) / self.rate
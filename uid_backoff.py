@@ -0,0 +1,92 @@
+import time
+import threading
+
+from lru_cache import LRUCache
+
+class BackoffEntry(object):
+    """Penalty state of one denied UID"""
+
+    def __init__(self):
+        self.failures = 0
+        self.blockedUntil = 0
+        self.lastDenial = 0
+        self.suppressed = 0
+
+class UidBackoff(object):
+    """
+    Per-UID penalty for denied cards. After a denial the UID is ignored for
+    a penalty time which grows by factor with each further denial up to
+    maxSecs. Other UIDs are not affected. UIDs not denied for maxSecs are
+    forgiven. Number of remembered UIDs is bounded, least recently seen
+    are evicted.
+    """
+
+    def __init__(self, baseSecs, factor, maxSecs, tableSize):
+        """
+        @param baseSecs: penalty after first denial
+        @param factor: multiplier of penalty for each subsequent denial
+        @param maxSecs: penalty upper bound and time after which UID is forgiven
+        @param tableSize: maximum number of remembered UIDs
+        """
+        self.baseSecs = baseSecs
+        self.factor = factor
+        self.maxSecs = maxSecs
+        self.table = LRUCache(tableSize)
+        self.lock = threading.Lock()
+        self.denials = 0
+        self.suppressed = 0
+
+    def isBlocked(self, uid_hex):
+        """
+        Returns True if UID is still serving its penalty. Such attempt is
+        counted as suppressed.
+        """
+        entry = self.table.get(uid_hex)
+        if entry is None:
+            return False
+        with self.lock:
+            if time.time() >= entry.blockedUntil:
+                return False
+            entry.suppressed += 1
+            self.suppressed += 1
+            return True
+
+    def recordDenial(self, uid_hex):
+        """
+        Starts penalty for denied UID.
+        @returns penalty length in seconds
+        """
+        now = time.time()
+        entry = self.table.get(uid_hex)
+        if entry is None:
+            entry = BackoffEntry()
+            self.table.put(uid_hex, entry)
+        with self.lock:
+            if now - entry.lastDenial > self.maxSecs:
+                entry.failures = 0
+            penalty = min(self.maxSecs, self.baseSecs * (self.factor ** entry.failures))
+            entry.failures += 1
+            entry.lastDenial = now
+            entry.blockedUntil = now + penalty
+            self.denials += 1
+            return penalty
+
+    def forgive(self, uid_hex):
+        """Forget penalty of UID, e.g. after it was authorized"""
+        self.table.remove(uid_hex)
+
+    def forgiveAll(self):
+        """Forget all penalties, e.g. after card DB was reloaded"""
+        self.table.clear()
+
+    def stats(self):
+        """
+        Returns dict with number of denials, suppressed attempts, currently
+        tracked UIDs and evictions from the table.
+        """
+        return {
+            "denials": self.denials,
+            "suppressed": self.suppressed,
+            "tracked": len(self.table),
+            "evictions": self.table.evictions,
+        }
@@ -1,31 +1,106 @@
-import time
+import threading
 
 class Unlocker(object):
     """Abstract class/interface for Unlocker object.
     Unlocker useful for simulation, but does not actually unlock any lock.
+
+    Unlocking does not block - unlock() disengages the lock and schedules
+    relock after lockOpenedSecs on a timer thread. Subclasses only implement
+    driveLock() which switches the actual hardware.
     """
-    def __init__(self, config):
+    # Optional modules the unlocker needs, checked by --check-config
+    requiredModules = ()
+
+    def __init__(self, config, section=None):
         """
         Creates unlocked instance from config, where section named after
         the class is supposed to exist.
-        
+
         @param config: BrmdoorConfig instance
+        @param section: config section of this unlocker, defaults to class
+            name; allows multiple unlockers of the same class
         """
-        self.config = config.config
         self.lockOpenedSecs = config.lockOpenedSecs
-        self.unlockerName = type(self).__name__
-    
+        self.unlockerName = section or type(self).__name__
+        self.options = config.unlockerOptions[self.unlockerName]
+        self.stateLock = threading.Lock()
+        self.unlocked = False
+        self.relockTimer = None
+        # incremented on every unlock/lock, so that stale relock timer does nothing
+        self.generation = 0
+
+    @classmethod
+    def readOptions(cls, config, section):
+        """
+        Read and validate options of unlocker's config section. Called when
+        config is read, so that bad options are reported at startup.
+
+        @param config: BrmdoorConfig being read, use its get/getInt/getBool
+        @param section: config section of the unlocker
+        @returns dict of options, available as self.options of the unlocker
+        @raises BrmdoorConfigError or ConfigParser.Error if some option is bad or missing
+        """
+        return {}
+
     def unlock(self):
-        """Unlock lock for given self.lockOpenedSecs.
-        In this class case, it's only simulated
+        """Unlock lock for given self.lockOpenedSecs and return immediately.
+        If the lock is already unlocked, the open window is extended to
+        lockOpenedSecs from now.
+
+        @returns True if lock was unlocked by this call, False if it was
+            already unlocked and only the open window was extended
         """
-        time.sleep(self.lockOpenedSecs)
+        with self.stateLock:
+            if self.relockTimer is not None:
+                self.relockTimer.cancel()
+            self.generation += 1
+
+            newlyUnlocked = not self.unlocked
+            if newlyUnlocked:
+                self.driveLock(True)
+                self.unlocked = True
+
+            self.relockTimer = threading.Timer(self.lockOpenedSecs, self.relock, [self.generation])
+            self.relockTimer.setDaemon(True)
+            self.relockTimer.start()
+            return newlyUnlocked
+
+    def relock(self, generation):
+        """
+        Timer callback locking the lock after open window passed. Does nothing
+        if the lock was unlocked or locked again since the timer was started.
+        """
+        with self.stateLock:
+            if generation != self.generation:
+                return
+            self.driveLock(False)
+            self.unlocked = False
+            self.relockTimer = None
 
     def lock(self):
         """
         Lock the lock back. Meant to be used when program is shut down
         so that lock is not left disengaged.
         """
+        with self.stateLock:
+            if self.relockTimer is not None:
+                self.relockTimer.cancel()
+                self.relockTimer = None
+            self.generation += 1
+            self.driveLock(False)
+            self.unlocked = False
+
+    def isUnlocked(self):
+        """Returns True while the lock is held open"""
+        with self.stateLock:
+            return self.unlocked
+
+    def driveLock(self, unlocked):
+        """Switch the actual lock. Called with stateLock held.
+        In this class case, it's only simulated.
+
+        @param unlocked: True to disengage the lock, False to engage it
+        """
         pass
 
 
@@ -33,28 +108,24 @@ class UnlockerWiringPi(Unlocker):
     """Uses configured pings via WiringPi to open lock.
     """
 
-    def __init__(self, config):
+    requiredModules = ("wiringpi",)
+
+    @classmethod
+    def readOptions(cls, config, section):
+        return {"lockPin": config.getInt(section, "lock_pin", 0)}
+
+    def __init__(self, config, section=None):
+        # imported here, so that other unlockers work without wiringpi installed
         import wiringpi
-        Unlocker.__init__(self, config)
+        self.wiringpi = wiringpi
+        Unlocker.__init__(self, config, section)
         # PIN numbers follow P1 header BCM GPIO numbering, see https://projects.drogon.net/raspberry-pi/wiringpi/pins/
         # Local copy of the P1 in repo mapping see gpio_vs_wiringpi_numbering_scheme.png.
         wiringpi.wiringPiSetupGpio()
-        self.lockPin = self.config.getint("UnlockerWiringPi", "lock_pin")
+        self.lockPin = self.options["lockPin"]
         wiringpi.pinMode(self.lockPin, wiringpi.OUTPUT) #output
-    
-    def unlock(self):
-        """Unlocks lock at configured pin by pulling it high.
-        """
-        import wiringpi
-        wiringpi.digitalWrite(self.lockPin, 1)
-        time.sleep(self.lockOpenedSecs)
-        wiringpi.digitalWrite(self.lockPin, 0)
 
-    def lock(self):
+    def driveLock(self, unlocked):
+        """Unlocks lock at configured pin by pulling it high, locks by pulling it low.
         """
-        Lock the lock back. Meant to be used when program is shut down
-        so that lock is not left disengaged.
-        """
-        import wiringpi
-        wiringpi.digitalWrite(self.lockPin, 0)
-
+        self.wiringpi.digitalWrite(self.lockPin, 1 if unlocked else 0)